@@ -1,9 +1,21 @@
+import bisect
 import csv
+import hashlib
 import json
+import mmap
+import multiprocessing
+import multiprocessing.util
 import os
+import pickle
 import random
+import shutil
+import sys
+import tempfile
+import time
 import timeit
+import weakref
 from abc import abstractmethod
+from collections import OrderedDict
 from copy import copy
 from typing import List, Tuple, Callable, Union
 
@@ -19,7 +31,8 @@ from torch.utils.data import DataLoader
 from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm
 
-from parseq.grammar import lisp_to_pas, pas_to_tree, tree_size, tree_to_lisp, tree_to_lisp_tokens, lisp_to_tree
+from parseq.grammar import lisp_to_pas, pas_to_tree, tree_size, tree_to_lisp, tree_to_lisp_tokens, lisp_to_tree, \
+    sample_tree_permutation
 from parseq.vocab import SequenceEncoder, Vocab
 from transformers import BartTokenizer
 
@@ -71,15 +84,25 @@ class Dataset(object):
                 else:
                     keep = keep and (f[k] == ex[k])
             if keep:
-                True
+                return True
         return False
 
+    def _filter_indexes(self, f, indexes=None):
+        """
+        :param f:           filter (callable, tuple or dict, see filter())
+        :param indexes:     positions to consider (default: all)
+        :return:            the positions among indexes whose examples fit the filter f
+        """
+        indexes = range(len(self)) if indexes is None else indexes
+        return [i for i in indexes if self._example_fits_filter(self[i], f)]
+
     def filter(self, f):
-        ret = []
-        for ex in self._examples:
-            if self._example_fits_filter(ex, f):
-                ret.append(ex)
-        ret = Dataset(ret)
+        """
+        Create a FilteredDataset: a view on the examples that fit the filter f (f is evaluated right away).
+        f can be a callable returning a bool, a tuple with one callable/value/None per element of tuple examples,
+        or a dict with callables/values for some keys of dict examples.
+        """
+        ret = FilteredDataset(self, f)
         return ret
 
     def __getitem__(self, item):
@@ -90,30 +113,317 @@ class Dataset(object):
             ret = self._examples[item]
             return ret
 
-    def map(self, f):
+    def map(self, f, passthrough=None):
         """
         Create a MappedDataset that will apply given function f on an example on __getitem__
+        :param passthrough:     fields of the examples returned by f that are copied unchanged from f's input,
+                                as a dict {output field: input field} (or list of fields copied to the same place).
+                                Filters that only look at these fields are evaluated without calling f.
         """
-        ret = MappedDataset(self, f)
+        ret = MappedDataset(self, f, passthrough=passthrough)
         return ret
 
+    def materialize(self, workers=0):
+        """
+        Eagerly computes all examples of this dataset (e.g. a chain of filters and maps) and stores them in a new Dataset.
+        :param workers:     number of processes to compute examples in (0: compute in this process).
+                            Workers are forked, so the maps don't need to be picklable but the examples do.
+        """
+        if workers <= 0 or len(self) < 2:
+            return Dataset(self.examples)
+        global _MATERIALIZE_DS
+        _MATERIALIZE_DS = self
+        try:
+            chunksize = int(np.ceil(len(self) / (workers * 4)))
+            chunks = [(i, min(i + chunksize, len(self))) for i in range(0, len(self), chunksize)]
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                ret = pool.map(_materialize_chunk, chunks)
+        finally:
+            _MATERIALIZE_DS = None
+        return Dataset([ex for chunk in ret for ex in chunk])
+
+
+_MATERIALIZE_DS = None      # dataset being materialized, inherited by forked workers
+
+
+def _materialize_chunk(x):
+    return [_MATERIALIZE_DS[i] for i in range(*x)]
+
+
+class FilteredDataset(Dataset):
+    """
+    View on the examples of baseds that fit a filter: only the positions of the matching examples are stored.
+    The filter is evaluated when the view is created (so it sees the values its closure has at that time),
+    on the unmapped base examples where possible (see MappedDataset._filter_indexes()).
+    """
+    def __init__(self, baseds:Dataset, f, **kw):
+        super(FilteredDataset, self).__init__(**kw)
+        self.baseds = baseds
+        self.f = f
+        self.indexes = self.baseds._filter_indexes(self.f)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def _filter_indexes(self, f, indexes=None):
+        indexes = range(len(self)) if indexes is None else indexes
+        baseindexes = [self.indexes[i] for i in indexes]
+        kept = set(self.baseds._filter_indexes(f, baseindexes))     # evaluated (and pushed down) by the base
+        return [i for i, j in zip(indexes, baseindexes) if j in kept]
+
+    def __getitem__(self, item):
+        if isinstance(item, (Callable, tuple, dict)):
+            return self.filter(item)
+        elif isinstance(item, slice):
+            return [self.baseds[j] for j in self.indexes[item]]
+        else:
+            return self.baseds[self.indexes[item]]
+
+
+class _ArrayRef(object):
+    """ Placeholder for the i-th array of an example stored in a _SpillStore. """
+    def __init__(self, i, istorch):
+        self.i, self.istorch = i, istorch
+
+
+def _strip_arrays(x, arrays):
+    # replaces tensors and (non-object) numpy arrays in (nested tuples/lists/dicts of) x by _ArrayRefs
+    if isinstance(x, torch.Tensor):
+        arrays.append(x.detach().cpu().contiguous().numpy())
+        return _ArrayRef(len(arrays) - 1, True)
+    elif isinstance(x, np.ndarray) and x.dtype != object:
+        arrays.append(np.ascontiguousarray(x))
+        return _ArrayRef(len(arrays) - 1, False)
+    elif isinstance(x, (tuple, list)):
+        return type(x)([_strip_arrays(xe, arrays) for xe in x])
+    elif isinstance(x, dict):
+        return type(x)([(k, _strip_arrays(v, arrays)) for k, v in x.items()])
+    else:
+        return x
+
+
+def _restore_arrays(x, arrays):
+    if isinstance(x, _ArrayRef):
+        return torch.from_numpy(arrays[x.i]) if x.istorch else arrays[x.i]
+    elif isinstance(x, (tuple, list)):
+        return type(x)([_restore_arrays(xe, arrays) for xe in x])
+    elif isinstance(x, dict):
+        return type(x)([(k, _restore_arrays(v, arrays)) for k, v in x.items()])
+    else:
+        return x
+
+
+def _example_nbytes(x):
+    """ Rough estimate of the memory used by an example. """
+    if isinstance(x, torch.Tensor):
+        return x.element_size() * x.nelement() + 72
+    elif isinstance(x, np.ndarray):
+        return x.nbytes + 112
+    elif isinstance(x, (tuple, list)):
+        return sys.getsizeof(x) + sum([_example_nbytes(xe) for xe in x])
+    elif isinstance(x, dict):
+        return sys.getsizeof(x) + sum([_example_nbytes(k) + _example_nbytes(v) for k, v in x.items()])
+    else:
+        return sys.getsizeof(x)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _remove_dir(path, pid):
+    # only the process that created path removes it (not forked workers)
+    if os.getpid() == pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class _SpillStore(object):
+    """
+    On-disk store for examples evicted from an ExampleCache.
+    The tensors and arrays of an example are appended to a data file and read back through a memory map,
+    the rest of the example is pickled in an in-memory index.
+    Every process writes to its own data file, so a store can be shared with (forked) DataLoader workers:
+    they can read what was stored before they were started and store their own examples.
+    """
+    def __init__(self, path=None, **kw):
+        super(_SpillStore, self).__init__(**kw)
+        self._owndir = path is None
+        self.path = tempfile.mkdtemp(prefix="parseq_cache_") if path is None else path
+        os.makedirs(self.path, exist_ok=True)
+        self.index = {}     # item -> (data file, pickled example without arrays, [(offset, dtype, shape)])
+        self._pid, self._file, self._filepath, self._maps = None, None, None, {}
+        self._files = set()     # data files created by this store in this process
+        self._creatorpid = os.getpid()
+        if self._owndir:
+            weakref.finalize(self, _remove_dir, self.path, os.getpid())
+
+    def _check_process(self):
+        if self._pid != os.getpid():    # new process: own data file, don't use the parent's handles and maps
+            self._pid = os.getpid()
+            self._file, self._maps, self._files = None, {}, set()
+
+    def __contains__(self, item):
+        return item in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def put(self, item, x):
+        self._check_process()
+        if self._file is None:
+            self._filepath = os.path.join(self.path, f"spill-{self._pid}-{id(self)}.bin")
+            self._file = open(self._filepath, "ab")
+            self._files.add(self._filepath)
+            if self._pid != self._creatorpid:
+                # worker process: its examples are only seen by itself, remove them when it exits
+                multiprocessing.util.Finalize(None, _remove_file, args=(self._filepath,), exitpriority=0)
+        arrays = []
+        skeleton = pickle.dumps(_strip_arrays(x, arrays), protocol=pickle.HIGHEST_PROTOCOL)
+        entries = []
+        for array in arrays:
+            offset = self._file.tell()
+            self._file.write(array.tobytes())
+            entries.append((offset, array.dtype.str, array.shape))
+        self._file.flush()
+        self.index[item] = (self._filepath, skeleton, entries)
+
+    def get(self, item):
+        self._check_process()
+        filepath, skeleton, entries = self.index[item]
+        arrays = []
+        if len(entries) > 0:
+            end = max([offset + int(np.prod(shape)) * np.dtype(dtype).itemsize for offset, dtype, shape in entries])
+            mm = self._map(filepath, end) if end > 0 else b""
+            for offset, dtype, shape in entries:
+                array = np.frombuffer(mm, dtype=dtype, count=int(np.prod(shape)), offset=offset)
+                arrays.append(array.reshape(shape).copy())      # copy: examples must not point into the map
+        return _restore_arrays(pickle.loads(skeleton), arrays)
+
+    def _map(self, filepath, end):
+        # (re)maps a data file if it has grown beyond the mapped part
+        if filepath not in self._maps or len(self._maps[filepath]) < end:
+            with open(filepath, "rb") as f:
+                self._maps[filepath] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[filepath]
+
+    def clear(self):
+        """ Forgets all stored examples and removes the data files this store created in this process. """
+        self._check_process()
+        self.index = {}
+        if self._file is not None:
+            self._file.close()
+        self._file, self._maps = None, {}
+        for fp in self._files:
+            _remove_file(fp)
+        self._files = set()
+
+    def __getstate__(self):     # e.g. for spawned DataLoader workers: handles and maps are reopened
+        state = copy(self.__dict__)
+        state["_pid"], state["_file"], state["_maps"], state["_owndir"] = None, None, {}, False
+        state["_files"] = set()
+        state["_creatorpid"] = None
+        return state
+
+
+class ExampleCache(object):
+    """
+    LRU cache of examples by index, optionally bounded in the number of examples and in (estimated) memory.
+    Examples evicted from memory can be spilled to disk (see _SpillStore) instead of being dropped.
+    Supports the dict operations used by CachedDataset (in, [], []=) and keeps hit/miss/eviction counts.
+    In DataLoader worker processes, every worker works on its own copy of the in-memory part (and its own counts).
+    """
+    def __init__(self, maxsize=None, maxbytes=None, spill=None, **kw):
+        """
+        :param maxsize:     maximum number of examples kept in memory (None: unbounded)
+        :param maxbytes:    maximum (estimated) number of bytes of the examples kept in memory (None: unbounded)
+        :param spill:       None: evicted examples are dropped, True: spill to a temporary directory (removed at exit),
+                            str: spill to files in this directory
+        """
+        super(ExampleCache, self).__init__(**kw)
+        self.maxsize, self.maxbytes = maxsize, maxbytes
+        self.spillstore = None if spill is None or spill is False else _SpillStore(None if spill is True else spill)
+        self._mem = OrderedDict()       # item -> (example, nbytes)
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions, self.spill_hits = 0, 0, 0, 0
+
+    def __contains__(self, item):
+        return item in self._mem or (self.spillstore is not None and item in self.spillstore)
+
+    def __len__(self):
+        return len(self._mem)
+
+    def __getitem__(self, item):
+        if item in self._mem:
+            self.hits += 1
+            self._mem.move_to_end(item)
+            return self._mem[item][0]
+        if self.spillstore is not None and item in self.spillstore:
+            self.spill_hits += 1
+            ret = self.spillstore.get(item)
+            self._put(item, ret)
+            return ret
+        raise KeyError(item)
+
+    def __setitem__(self, item, x):
+        self.misses += 1
+        self._put(item, x)
+
+    def _put(self, item, x):
+        if item in self._mem:
+            self.nbytes -= self._mem.pop(item)[1]
+        nbytes = _example_nbytes(x) if self.maxbytes is not None else 0
+        self._mem[item] = (x, nbytes)
+        self.nbytes += nbytes
+        while len(self._mem) > 0 and ((self.maxsize is not None and len(self._mem) > self.maxsize)
+                                      or (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            k, (v, vbytes) = self._mem.popitem(last=False)
+            self.nbytes -= vbytes
+            self.evictions += 1
+            if self.spillstore is not None and k not in self.spillstore:
+                self.spillstore.put(k, v)
+
+    def clear(self):
+        self._mem = OrderedDict()
+        self.nbytes = 0
+        if self.spillstore is not None:
+            self.spillstore.clear()
+        self.hits, self.misses, self.evictions, self.spill_hits = 0, 0, 0, 0
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "spill_hits": self.spill_hits,
+                "size": len(self._mem), "maxsize": self.maxsize, "nbytes": self.nbytes, "maxbytes": self.maxbytes,
+                "spilled": len(self.spillstore) if self.spillstore is not None else 0}
+
 
 class CachedDataset(object):
-    def __init__(self, use_cache=False, **kw):
+    def __init__(self, use_cache=False, cache_size=None, cache_bytes=None, cache_spill=None, **kw):
+        """
+        :param cache_size:      maximum number of cached examples kept in memory (least recently used are evicted)
+        :param cache_bytes:     maximum (estimated) memory used by cached examples
+        :param cache_spill:     if True or a directory, evicted examples are stored on disk (see ExampleCache)
+        """
         super(CachedDataset, self).__init__(**kw)
         self.use_cache = use_cache
-        self._examples_cache = {}
+        self._examples_cache = ExampleCache(cache_size, cache_bytes, cache_spill)
         self.baseds = None
 
-    def cache(self):
-        """ Enable cache at this level. """
+    def cache(self, maxsize=None, maxbytes=None, spill=None):
+        """ Enable cache at this level. If any of the arguments is given, the cache is replaced by one with these limits. """
+        if maxsize is not None or maxbytes is not None or spill is not None:
+            self._examples_cache = ExampleCache(maxsize, maxbytes, spill)
         self.enable_cache()
         return self
 
     def clear_cache(self):
-        self._examples_cache = {}
+        self._examples_cache.clear()
         return self
 
+    def cache_info(self):
+        return self._examples_cache.info()
+
     def disable_cache(self):
         self.use_cache = False
         return self
@@ -135,12 +445,80 @@ class CachedDataset(object):
         return self
 
 
+class _FusedMap(object):
+    """ Applies a chain of maps in one call. """
+    def __init__(self, fs, **kw):
+        super(_FusedMap, self).__init__(**kw)
+        self.fs = fs
+
+    def __call__(self, x):
+        for f in self.fs:
+            x = f(x)
+        return x
+
+
+class _PassthroughExample(object):
+    """
+    Stand-in for the output of a map, given to filters to evaluate them on the map's input where possible:
+    fields passed through by the map are read from the input, anything else computes the map (once).
+    """
+    __slots__ = ("ex", "f", "passthrough", "_mapped")
+
+    def __init__(self, ex, f, passthrough):
+        self.ex, self.f, self.passthrough = ex, f, passthrough
+        self._mapped = None
+
+    def mapped(self):
+        if self._mapped is None:
+            self._mapped = (self.f(self.ex),)
+        return self._mapped[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, str)) and item in self.passthrough:
+            return self.ex[self.passthrough[item]]
+        return self.mapped()[item]
+
+    def __len__(self):
+        return len(self.mapped())
+
+    def __iter__(self):
+        return iter(self.mapped())
+
+    def __contains__(self, item):
+        return item in self.mapped()
+
+    def __eq__(self, other):
+        return self.mapped() == other
+
+    def __hash__(self):
+        return hash(self.mapped())
+
+    def __getattr__(self, item):
+        return getattr(self.mapped(), item)
+
+
+def _filter_to_callable(f):
+    # tuple and dict filters as callables that only index the fields they constrain
+    if isinstance(f, (tuple, dict)):
+        items = [(k, fe) for k, fe in (enumerate(f) if isinstance(f, tuple) else f.items()) if fe is not None]
+        def _f(ex):
+            for k, fe in items:
+                if not (fe(ex[k]) if isinstance(fe, Callable) else fe == ex[k]):
+                    return False
+            return True
+        return _f
+    return f
+
+
 class MappedDataset(Dataset, CachedDataset):
-    def __init__(self, baseds:Dataset, f, use_cache=False, **kw):
+    def __init__(self, baseds:Dataset, f, use_cache=False, passthrough=None, **kw):
         self._kw = copy(kw)
         super(MappedDataset, self).__init__(use_cache=use_cache, **kw)
         self.baseds = baseds
         self.f = f
+        if isinstance(passthrough, (list, tuple, set)):
+            passthrough = {k: k for k in passthrough}
+        self.passthrough = passthrough
 
     def __len__(self):
         return len(self.baseds)
@@ -154,10 +532,26 @@ class MappedDataset(Dataset, CachedDataset):
     def rootds(self):
         return self.baseds.rootds
 
-    def filter(self, f):
-        newbase = self.baseds.filter(lambda ex: self._example_fits_filter(self.f(ex), f))
-        ret = newbase.map(self.f)
-        return ret
+    def _filter_indexes(self, f, indexes=None):
+        if self.passthrough is None:
+            return super(MappedDataset, self)._filter_indexes(f, indexes)
+        # predicate pushdown: evaluate f on the unmapped examples of the base, only mapping when f needs it
+        cf = _filter_to_callable(f)
+        return self.baseds._filter_indexes(
+            lambda ex: self._example_fits_filter(_PassthroughExample(ex, self.f, self.passthrough), cf), indexes)
+
+    def map(self, f, passthrough=None):
+        """ Maps on an uncached MappedDataset are fused with it into one MappedDataset applying both functions. """
+        if self.use_cache:
+            return type(self)(self, f, passthrough=passthrough)
+        fs = (self.f.fs if isinstance(self.f, _FusedMap) else [self.f]) + [f]
+        if self.passthrough is not None and passthrough is not None:
+            passthrough = {k: self.passthrough[v] for k, v in passthrough.items() if v in self.passthrough} \
+                if isinstance(passthrough, dict) else \
+                {k: self.passthrough[k] for k in passthrough if k in self.passthrough}
+        else:
+            passthrough = None
+        return type(self)(self.baseds, _FusedMap(fs), passthrough=passthrough, **self._kw)
 
     def __getitem__(self, item):
         if isinstance(item, (Callable, tuple, dict)):
@@ -222,8 +616,14 @@ class GeneratedDataset(Dataset, CachedDataset):
     @abstractmethod
     def generate(self, rng=None): pass
 
-    def map(self, f):
-        return GeneratedMappedDataset(self, f)
+    def map(self, f, passthrough=None):
+        return GeneratedMappedDataset(self, f, passthrough=passthrough)
+
+    def shard(self, workers=None, shardsize=None, path=None):
+        """
+        Generates all examples up front in a pool of worker processes (see ShardedGeneratedDataset).
+        """
+        return ShardedGeneratedDataset(self, workers=workers, shardsize=shardsize, path=path)
 
 
 class GeneratedMappedDataset(MappedDataset):
@@ -246,8 +646,155 @@ class GeneratedMappedDataset(MappedDataset):
                     self._examples_cache[item] = ret
                 return ret
 
-    def map(self, f):
-        return GeneratedMappedDataset(self, f)
+    def filter(self, f):
+        # the generated base is filtered into a stored Dataset (see GeneratedDataset.filter())
+        newbase = self.baseds.filter(lambda ex: self._example_fits_filter(self.f(ex), f))
+        ret = newbase.map(self.f)
+        return ret
+
+
+class ShardedGeneratedDataset(Dataset):
+    """
+    Random-access Dataset of the examples of a GeneratedDataset, generated up front by forked worker processes.
+    The index range is split into shards and every worker encodes the trees of its shards into a flat int32 buffer
+    (label ids and numbers of children in preorder, -1 for string leaves) in a memory-mapped file.
+    Examples are decoded from the buffers on access and are identical to the ones of the GeneratedDataset
+    for the same seed (examples must be Trees or strings).
+    advance_seed() advances the seed of the GeneratedDataset and generates all examples again.
+    """
+    def __init__(self, baseds:GeneratedDataset, workers=None, shardsize=None, path=None, **kw):
+        """
+        :param workers:     number of worker processes (default: number of CPUs, 0: generate in this process)
+        :param shardsize:   number of examples per shard (default: a multiple of baseds.blocksize, if any,
+                            giving about four shards per worker)
+        :param path:        directory to keep the buffers in (default: a temporary directory, removed afterwards)
+        """
+        super(ShardedGeneratedDataset, self).__init__(**kw)
+        self.baseds = baseds
+        self.workers = os.cpu_count() if workers is None else workers
+        self.shardsize = shardsize
+        self._owndir = path is None
+        self.path = tempfile.mkdtemp(prefix="parseq_shards_") if path is None else path
+        os.makedirs(self.path, exist_ok=True)
+        if self._owndir:
+            weakref.finalize(self, _remove_dir, self.path, os.getpid())
+        self._generation = 0
+        self.generate()
+
+    def generate(self):
+        N = len(self.baseds)
+        shardsize = self.shardsize
+        if shardsize is None:
+            shardsize = max(1, int(np.ceil(N / (max(self.workers, 1) * 4))))
+            blocksize = getattr(self.baseds, "blocksize", None)
+            if blocksize is not None:       # shards don't split blocks of a PCFGDataset
+                shardsize = int(np.ceil(shardsize / blocksize)) * blocksize
+        shards = [(k, i, min(i + shardsize, N), os.path.join(self.path, f"shard-{self._generation}-{k}.bin"))
+                  for k, i in enumerate(range(0, N, shardsize))]
+        global _SHARD_DS
+        _SHARD_DS = self.baseds
+        try:
+            if self.workers <= 0 or len(shards) < 2:
+                ret = [_generate_shard(shard) for shard in shards]
+            else:
+                with multiprocessing.get_context("fork").Pool(self.workers) as pool:
+                    ret = pool.map(_generate_shard, shards, chunksize=1)
+        finally:
+            _SHARD_DS = None
+        # merge the label lists of the shards, in order
+        D = {}
+        self._shards = []
+        for (k, start, end, filepath), (labels, offsets) in zip(shards, ret):
+            remap = np.asarray([D.setdefault(label, len(D)) for label in labels], dtype="int64")
+            self._shards.append((start, filepath, offsets, remap))
+        self.labels = list(D.keys())
+        self._starts = [start for start, _, _, _ in self._shards]
+        self._generation += 1
+        self._pid, self._maps = None, {}
+
+    def advance_seed(self):
+        self.baseds.advance_seed()
+        for _, filepath, _, _ in self._shards:
+            _remove_file(filepath)
+        self.generate()
+
+    def _map(self, filepath, n):
+        if self._pid != os.getpid():
+            self._pid, self._maps = os.getpid(), {}
+        if filepath not in self._maps:
+            if n > 0:
+                with open(filepath, "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[filepath] = np.frombuffer(mm, dtype="int32").reshape(2, n)
+            else:
+                self._maps[filepath] = np.zeros((2, 0), dtype="int32")
+        return self._maps[filepath]
+
+    def __len__(self):
+        return len(self.baseds)
+
+    def __getitem__(self, item):
+        if isinstance(item, (Callable, tuple, dict)):
+            return self.filter(item)
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        item = item + len(self) if item < 0 else item
+        if not 0 <= item < len(self):
+            raise IndexError(f"index {item} out of range")
+        start, filepath, offsets, remap = self._shards[bisect.bisect_right(self._starts, item) - 1]
+        buf = self._map(filepath, int(offsets[-1]))
+        a, b = int(offsets[item - start]), int(offsets[item - start + 1])
+        labels = self.labels
+        return _decode_tree([labels[i] for i in remap[buf[0, a:b]].tolist()], buf[1, a:b].tolist())
+
+    def __getstate__(self):     # e.g. for spawned DataLoader workers: maps are reopened, buffers stay with the creator
+        state = copy(self.__dict__)
+        state["_pid"], state["_maps"], state["_owndir"] = None, {}, False
+        return state
+
+
+_SHARD_DS = None        # generated dataset being sharded, inherited by forked workers
+
+
+def _generate_shard(x):
+    """ Generates the examples start..end-1 of _SHARD_DS into a buffer file. Returns the labels and item offsets. """
+    k, start, end, filepath = x
+    D, tokens, numchildren, offsets = {}, [], [], [0]
+    for i in range(start, end):
+        _encode_tree(_SHARD_DS[i], D, tokens, numchildren)
+        offsets.append(len(tokens))
+    np.asarray([tokens, numchildren], dtype="int32").reshape(2, -1).tofile(filepath)
+    return list(D.keys()), np.asarray(offsets, dtype="int64")
+
+
+def _encode_tree(x, D, tokens, numchildren):
+    # preorder label ids (from D) and numbers of children (-1 for string leaves)
+    stack = [x]
+    while len(stack) > 0:
+        node = stack.pop()
+        if isinstance(node, Tree):
+            tokens.append(D.setdefault(node._label, len(D)))
+            numchildren.append(len(node))
+            stack.extend(reversed(node))
+        else:
+            assert(isinstance(node, str))
+            tokens.append(D.setdefault(node, len(D)))
+            numchildren.append(-1)
+
+
+def _decode_tree(labels, numchildren):
+    # backwards over the preorder: the children of a node are the last completed subtrees
+    stack = []
+    for label, n in zip(reversed(labels), reversed(numchildren)):
+        if n < 0:
+            stack.append(label)
+        elif n == 0:
+            stack.append(Tree(label, []))
+        else:
+            children = stack[:-n - 1:-1]
+            del stack[-n:]
+            stack.append(Tree(label, children))
+    return stack[0]
 
 
 class Pipeline(object):
@@ -273,13 +820,282 @@ class BatchDataset(Dataset):
         super(BatchDataset, self).__init__(examples, **kw)
 
 
+class SequenceDataset(Dataset):
+    """ Dataset over a sequence of examples that is not copied into a list (e.g. BinaryExamples, decoded on access). """
+    def __init__(self, examples, **kw):
+        super(SequenceDataset, self).__init__(**kw)
+        self._examples = examples
+
+
+def _align8(n):
+    return (n + 7) // 8 * 8
+
+
+class BinaryExamples(object):
+    """
+    Read-only sequence of tuple examples stored in a compact binary file, memory-mapped and decoded on first access.
+    Every field of the examples is either a Tree or a string and is stored as int32 ids into one shared label list:
+        - strings are stored pre-tokenized (split on spaces),
+        - Trees as preorder label ids and numbers of children (-1 for string leaves).
+    File layout: magic, length of a json header (label list, field kinds, array positions), the header and the arrays.
+    """
+    MAGIC = b"PQEX"
+    VERSION = 1
+
+    def __init__(self, path, **kw):
+        super(BinaryExamples, self).__init__(**kw)
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(4) != self.MAGIC:
+                raise ValueError(f"not a binary examples file: {path}")
+            headerlen = int(np.frombuffer(f.read(8), dtype="int64")[0])
+            header = ujson.loads(f.read(headerlen).decode("utf-8"))
+            start = 12 + headerlen
+            if header["version"] != self.VERSION:
+                raise ValueError(f"unsupported version {header['version']}")
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.labels = header["labels"]
+        self.kinds = header["kinds"]
+        self._arrays = {name: np.frombuffer(self._mm, dtype=dtype, count=count, offset=start + offset)
+                        for name, (dtype, offset, count) in header["arrays"].items()}
+        self._decoded = [None] * header["n"]
+
+    @classmethod
+    def write(cls, path, examples):
+        """ Writes examples (a sequence of tuples of strings and Trees) to path (atomically). """
+        D, kinds = {}, None
+        fields = []
+        for example in examples:
+            if kinds is None:
+                kinds = ["tree" if isinstance(fe, Tree) else "str" for fe in example]
+                fields = [([0], [], []) for _ in kinds]     # offsets, ids, numbers of children
+            assert(len(example) == len(kinds))
+            for fe, kind, (offsets, ids, numchildren) in zip(example, kinds, fields):
+                if kind == "tree":
+                    _encode_tree(fe, D, ids, numchildren)
+                else:
+                    assert(isinstance(fe, str))
+                    ids.extend([D.setdefault(tok, len(D)) for tok in fe.split(" ")])
+                offsets.append(len(ids))
+        arrays = {}
+        for k, (offsets, ids, numchildren) in enumerate(fields):
+            arrays[f"{k}.offsets"] = np.asarray(offsets, dtype="int64")
+            arrays[f"{k}.ids"] = np.asarray(ids, dtype="int32")
+            if kinds[k] == "tree":
+                arrays[f"{k}.numchildren"] = np.asarray(numchildren, dtype="int32")
+        # arrays are 8-byte aligned, positioned relative to the (aligned) end of the header
+        positions, offset = {}, 0
+        for name, array in arrays.items():
+            positions[name] = (array.dtype.str, offset, len(array))
+            offset += _align8(array.nbytes)
+        header = {"version": cls.VERSION, "n": len(examples), "labels": list(D.keys()), "kinds": kinds or [],
+                  "arrays": positions}
+        headerbytes = ujson.dumps(header).encode("utf-8")
+        headerbytes += b" " * (_align8(12 + len(headerbytes)) - 12 - len(headerbytes))   # json ignores the padding
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmppath = f"{path}.{os.getpid()}.tmp"
+        with open(tmppath, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(np.asarray([len(headerbytes)], dtype="int64").tobytes())
+            f.write(headerbytes)
+            for name, array in arrays.items():
+                data = array.tobytes()
+                f.write(data + b"\0" * (_align8(len(data)) - len(data)))
+        os.replace(tmppath, path)
+
+    def __len__(self):
+        return len(self._decoded)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        ret = self._decoded[item]
+        if ret is None:
+            ret = self._decoded[item] = self._decode(item % len(self))
+        return ret
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _decode(self, i):
+        labels, arrays = self.labels, self._arrays
+        ret = []
+        for k, kind in enumerate(self.kinds):
+            offsets = arrays[f"{k}.offsets"]
+            a, b = int(offsets[i]), int(offsets[i + 1])
+            tokens = [labels[j] for j in arrays[f"{k}.ids"][a:b].tolist()]
+            if kind == "tree":
+                ret.append(_decode_tree(tokens, arrays[f"{k}.numchildren"][a:b].tolist()))
+            else:
+                ret.append(" ".join(tokens))
+        return tuple(ret)
+
+    def __getstate__(self):     # the map is reopened in the new process
+        return {"path": self.path, "_decoded": self._decoded}
+
+    def __setstate__(self, state):
+        decoded = state["_decoded"]
+        self.__init__(state["path"])
+        self._decoded = decoded
+
+
+def build_alias_table(probs):
+    """
+    Builds an alias table (Vose's method) to sample from the given discrete distribution in O(1).
+    :param probs:   probabilities (normalized here)
+    :return:        (prob, alias) lists: draw i uniformly, keep it with probability prob[i], otherwise take alias[i]
+    """
+    probs = np.asarray(probs, dtype="float64")
+    k = len(probs)
+    scaled = probs / probs.sum() * k
+    prob, alias = [1.] * k, list(range(k))
+    small = [i for i in range(k) if scaled[i] < 1.]
+    large = [i for i in range(k) if scaled[i] >= 1.]
+    while len(small) > 0 and len(large) > 0:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = float(scaled[s]), l
+        scaled[l] = (scaled[l] + scaled[s]) - 1.
+        if scaled[l] < 1.:
+            small.append(l)
+        else:
+            large.append(l)
+    return prob, alias
+
+
+def compile_pcfg(pcfg, temperature=1.):
+    """
+    Compiles the rules of an nltk PCFG (as built by PCFGBuilder) for sampling.
+    :return:    (nonterminal -> id dict,
+                 for every nonterminal id: list of rules as (head label or None, rhs with nonterminal ids or terminal strings,
+                                                             size the rule adds to tree_length(count_brackets=True)),
+                 for every nonterminal id: array of rule probabilities (with temperature applied))
+    """
+    nt_ids = {}
+    for prod in pcfg.productions():
+        nt_ids.setdefault(prod.lhs(), len(nt_ids))
+    allrules, allprobs = [None] * len(nt_ids), [None] * len(nt_ids)
+    for nt, i in nt_ids.items():
+        productions = pcfg.productions(nt)
+        probs = np.asarray([prod.prob() for prod in productions])
+        if temperature != 1.:
+            probs = softmax(np.log(probs) * temperature)
+        rules = []
+        for prod in productions:
+            rhs = [nt_ids[rhse] if isinstance(rhse, Nonterminal) else rhse for rhse in prod.rhs()]
+            if isinstance(rhs[0], str):     # (head child child ...): head node, its brackets and terminal children
+                size = 1 + (2 if len(rhs) > 1 else 0) + sum([1 for rhse in rhs[1:] if isinstance(rhse, str)])
+                rules.append((rhs[0], rhs[1:], size))
+            else:
+                assert(len(rhs) == 1)
+                rules.append((None, rhs, 0))
+        allrules[i], allprobs[i] = rules, probs
+    return nt_ids, allrules, allprobs
+
+
 class PCFGDataset(GeneratedDataset):
-    def __init__(self, pcfg, N=int(1e6), seed=12345678, temperature=1., **kw):
+    def __init__(self, pcfg, N=int(1e6), seed=12345678, temperature=1., blocksize=None,
+                 exact_length=False, lengths=None, **kw):
+        """
+        :param blocksize:       if given, examples are generated in blocks of this many with generate_many()
+                                (much faster than one at a time) and kept until the seed is advanced
+        :param exact_length:    if True, trees are sampled from the PCFG conditioned on length < maxlen
+                                using length-indexed inside probabilities (see PCFGInsideTable): no rejection
+                                (the default sampler rejects and resamples every subtree that reaches maxlen)
+        :param lengths:         weights over tree lengths 0..maxlen-1 to sample the lengths of the trees from
+                                (implies exact_length)
+        """
         super(PCFGDataset, self).__init__(N=N, seed=seed, **kw)
         self._pcfg = pcfg
         self.temperature = temperature
+        self.blocksize = blocksize
+        self._blocks, self._blocks_seed = {}, None
+        self._compile()
+        self.lengths = lengths
+        self._inside = None
+        if exact_length or lengths is not None:
+            assert(self.maxlen < 1e6)
+            self._inside = PCFGBuilder.build_inside_table(pcfg, self.maxlen, temperature=temperature)
+
+    def _compile(self):
+        # alias tables per nonterminal
+        self._nt_ids, self._rules, probs = compile_pcfg(self._pcfg, temperature=self.temperature)
+        self._alias = [build_alias_table(probse) for probse in probs]
+
+    def advance_seed(self):
+        super(PCFGDataset, self).advance_seed()
+        self._blocks = {}
+
+    def __getitem__(self, item):
+        if self.blocksize is None or isinstance(item, (Callable, tuple, dict)):
+            return super(PCFGDataset, self).__getitem__(item)
+        if self._blocks_seed != self.seed:
+            self._blocks, self._blocks_seed = {}, self.seed
+        block = item // self.blocksize
+        if block not in self._blocks:
+            self._blocks[block] = self.generate_many(self.blocksize, seed=self.seed + block)
+        return self._blocks[block][item % self.blocksize]
 
     def generate(self, start=None, rng=None):
+        rng = np.random.RandomState(self.seed) if rng is None else rng
+        if self._inside is not None and start is None:
+            return self._inside.sample(rng, lengths=self.lengths)
+        return self._expand(start, _UniformStream(rng, 64))
+
+    def generate_many(self, n, seed=None, start=None):
+        """
+        Generates n examples from one random stream: deterministic given the seed, and much faster than
+        calling generate() n times. Samples come from the same distribution as generate().
+        """
+        rng = np.random.RandomState(self.seed if seed is None else seed)
+        stream = _UniformStream(rng, 4096)
+        if self._inside is not None and start is None:
+            return [self._inside.sample(stream, lengths=self.lengths) for _ in range(n)]
+        return [self._expand(start, stream) for _ in range(n)]
+
+    def _expand(self, start, stream):
+        """
+        Expands start iteratively, sampling rules from the alias tables.
+        As in generate_recursive(), an expansion of any nonterminal that reaches maxlen is sampled again.
+        Since sizes only grow, an expansion is restarted as soon as its completed part reaches maxlen.
+        """
+        start = self._pcfg.start() if start is None else start
+        rules, alias, maxlen = self._rules, self._alias, self.maxlen
+        next_uniform = stream.next
+
+        def sample(nt):
+            prob, al = alias[nt]
+            x = next_uniform() * len(prob)
+            i = int(x)
+            if x - i >= prob[i]:
+                i = al[i]
+            head, rhs, size = rules[nt][i]
+            return [nt, head, rhs, 0, [], size]      # frame: nt, head, rhs, position in rhs, children, size so far
+
+        stack = [sample(self._nt_ids[start])]
+        while True:
+            frame = stack[-1]
+            nt, head, rhs, pos, children, size = frame
+            if size >= maxlen:      # doomed: sample this expansion again
+                stack[-1] = sample(nt)
+            elif pos < len(rhs):
+                frame[3] = pos + 1
+                rhse = rhs[pos]
+                if isinstance(rhse, str):
+                    children.append(rhse)
+                else:
+                    stack.append(sample(rhse))
+            else:
+                ret = Tree(head, children) if head is not None else children[0]
+                stack.pop(-1)
+                if len(stack) == 0:
+                    return ret
+                parent = stack[-1]
+                parent[4].append(ret)
+                parent[5] += size
+
+    def generate_recursive(self, start=None, rng=None):
+        """ Reference implementation of generate(): samples rules one recursive call at a time. """
         rng = np.random.RandomState(self.seed) if rng is None else rng
         start = self._pcfg.start() if start is None else start
         productions = self._pcfg.productions(start)
@@ -290,7 +1106,7 @@ class PCFGDataset(GeneratedDataset):
         ret = []
         for rhse in chosen_prod.rhs():
             if isinstance(rhse, Nonterminal):
-                rete = self.generate(rhse, rng)
+                rete = self.generate_recursive(rhse, rng)
                 ret.append(rete)
             else:
                 ret.append(rhse)
@@ -308,7 +1124,22 @@ class PCFGDataset(GeneratedDataset):
         else:
             # generate another one
             rng = np.random.RandomState(rng.randint(10000000, 99999999))
-            return self.generate(start=start, rng=rng)
+            return self.generate_recursive(start=start, rng=rng)
+
+
+class _UniformStream(object):
+    """ Uniform random numbers drawn from rng in blocks (of growing size). """
+    def __init__(self, rng, blocksize=4096, **kw):
+        super(_UniformStream, self).__init__(**kw)
+        self.rng, self.blocksize = rng, blocksize
+        self._buf, self._i = [], 0
+
+    def next(self):
+        if self._i >= len(self._buf):
+            self._buf, self._i = self.rng.random_sample(self.blocksize).tolist(), 0
+            self.blocksize = min(self.blocksize * 2, 65536)
+        self._i += 1
+        return self._buf[self._i - 1]
 
 
 def tree_length(x:Union[Tree, str], count_brackets=False):
@@ -358,6 +1189,140 @@ class PCFGBuilder(object):
             t = x.label()
         return t
 
+    @staticmethod
+    def build_inside_table(pcfg, maxlen, temperature=1.):
+        """
+        Precomputes the length-indexed inside probabilities of pcfg for all lengths below maxlen,
+        which allows sampling trees of a given length without rejection (see PCFGInsideTable).
+        """
+        return PCFGInsideTable(pcfg, maxlen, temperature=temperature)
+
+
+class PCFGInsideTable(object):
+    """
+    Length-indexed inside probabilities of a PCFG:
+        inside[A, L] = probability that nonterminal A derives a tree with tree_length(count_brackets=True) == L.
+    For every rule with several nonterminal children, the convolutions of the inside probabilities of its
+    last children are kept as well, so that the lengths of the children can be split exactly top-down.
+    sample() then draws trees from the PCFG conditioned on their length (e.g. on length < maxlen) without rejection.
+    """
+    def __init__(self, pcfg, maxlen, temperature=1., **kw):
+        super(PCFGInsideTable, self).__init__(**kw)
+        self.maxlen = maxlen
+        self.nt_ids, self.rules, self.probs = compile_pcfg(pcfg, temperature=temperature)
+        self.start = self.nt_ids[pcfg.start()]
+        self._build()
+
+    def _build(self):
+        numnts, maxlen = len(self.rules), self.maxlen
+        # per rule: nonterminal children and, for children j < k-1, suffix convolutions (length of children j..k-1)
+        self._ntchildren = [[[rhse for rhse in rhs if not isinstance(rhse, str)] for head, rhs, size in rules]
+                            for rules in self.rules]
+        self._suffixes = [[[np.zeros(maxlen) for _ in range(len(ntchildren) - 1)] for ntchildren in ntchildrens]
+                          for ntchildrens in self._ntchildren]
+        inside = np.zeros((numnts, maxlen))
+        unary = np.zeros((numnts, numnts))      # rules A -> B: inside[A, L] depends on inside[B, L]
+        for a in range(numnts):
+            for (head, rhs, size), ntchildren, p in zip(self.rules[a], self._ntchildren[a], self.probs[a]):
+                if size == 0 and len(ntchildren) == 1:
+                    unary[a, ntchildren[0]] += p
+        solve = np.linalg.inv(np.eye(numnts) - unary)
+        for L in range(1, maxlen):
+            base = np.zeros(numnts)
+            for a in range(numnts):
+                for (head, rhs, size), ntchildren, suffixes, p \
+                        in zip(self.rules[a], self._ntchildren[a], self._suffixes[a], self.probs[a]):
+                    k = len(ntchildren)
+                    # update suffix convolutions at L (only needs values at lengths < L)
+                    for j in range(k - 2, -1, -1):
+                        nxt = suffixes[j + 1] if j + 1 < k - 1 else inside[ntchildren[k - 1]]
+                        suffixes[j][L] = np.dot(inside[ntchildren[j], 1:L], nxt[L - 1:0:-1])
+                    if k == 0:
+                        base[a] += p if L == size else 0.
+                    elif L - size >= 1 and not (size == 0 and k == 1):
+                        base[a] += p * (suffixes[0][L - size] if k > 1 else inside[ntchildren[0], L - size])
+            inside[:, L] = solve @ base
+        self.inside = inside
+        # rule weights per nonterminal and length, as cumulative sums for sampling
+        self._rulecum = []
+        for a in range(numnts):
+            w = np.zeros((maxlen, len(self.rules[a])))
+            for r, ((head, rhs, size), ntchildren, suffixes, p) \
+                    in enumerate(zip(self.rules[a], self._ntchildren[a], self._suffixes[a], self.probs[a])):
+                k = len(ntchildren)
+                if k == 0:
+                    if size < maxlen:
+                        w[size, r] = p
+                else:
+                    total = suffixes[0] if k > 1 else inside[ntchildren[0]]
+                    w[size:, r] = p * total[:maxlen - size]
+            self._rulecum.append(np.cumsum(w, 1))
+        self._cache = {}       # normalized cumulative weights as lists, filled while sampling
+
+    def length_probs(self, nt=None):
+        """ Probabilities of the lengths 0..maxlen-1 of trees derived from nt (default: start symbol). """
+        return self.inside[self.start if nt is None else self.nt_ids[nt]]
+
+    def sample(self, rng, lengths=None):
+        """
+        Samples a tree with length below maxlen, distributed as the PCFG's trees conditioned on that.
+        :param rng:         np.random.RandomState or _UniformStream
+        :param lengths:     optional weights over lengths 0..maxlen-1 to sample the length of the tree from instead
+                            (restricted to the lengths the grammar can produce)
+        """
+        next_uniform = rng.next if isinstance(rng, _UniformStream) else rng.random_sample
+        weights = self.inside[self.start] if lengths is None else np.asarray(lengths) * (self.inside[self.start] > 0)
+        cum = np.cumsum(weights)
+        assert(cum[-1] > 0)
+        L = int(np.searchsorted(cum, next_uniform() * cum[-1], side="right"))
+
+        inside, rules, cache = self.inside, self.rules, self._cache
+
+        def choose(cum):
+            return min(bisect.bisect_right(cum, next_uniform()), len(cum) - 1)
+
+        def frame(a, L):
+            key = (a, L)
+            if key not in cache:
+                cum = self._rulecum[a][L]
+                cache[key] = (cum / cum[-1]).tolist()
+            r = choose(cache[key])
+            head, rhs, size = rules[a][r]
+            ntchildren = self._ntchildren[a][r]
+            # split the remaining length over the nonterminal children
+            lens, m = [], L - size
+            for j in range(len(ntchildren) - 1):
+                key = (a, r, j, m)
+                if key not in cache:
+                    suffixes = self._suffixes[a][r]
+                    nxt = suffixes[j + 1] if j + 1 < len(ntchildren) - 1 else inside[ntchildren[-1]]
+                    w = np.cumsum(inside[ntchildren[j], 1:m] * nxt[m - 1:0:-1])
+                    cache[key] = (w / w[-1]).tolist()
+                l = 1 + choose(cache[key])
+                lens.append(l)
+                m -= l
+            lens.append(m)
+            return [head, rhs, 0, [], lens, 0]     # head, rhs, position in rhs, children, lengths of nt children, next nt
+
+        stack = [frame(self.start, L)]
+        while True:
+            fr = stack[-1]
+            head, rhs, pos, children, lens, k = fr
+            if pos < len(rhs):
+                fr[2] = pos + 1
+                rhse = rhs[pos]
+                if isinstance(rhse, str):
+                    children.append(rhse)
+                else:
+                    fr[5] = k + 1
+                    stack.append(frame(rhse, lens[k]))
+            else:
+                ret = Tree(head, children) if head is not None else children[0]
+                stack.pop(-1)
+                if len(stack) == 0:
+                    return ret
+                stack[-1][3].append(ret)
+
 
 def build_vocab_from_pcfg(pcfg, min_freq=0, top_k=np.infty)->Vocab:
     vocab = Vocab()
@@ -393,6 +1358,91 @@ def pad_and_default_collate(x, pad_value=0):
     return ret
 
 
+class BucketBatchSampler(object):
+    """
+    Batch sampler (use as DataLoader(ds, batch_sampler=..., collate_fn=autocollate)) that puts examples of similar
+    lengths together, to reduce padding and decoding steps.
+    Every epoch, the examples are shuffled and split into mega-batches of megabatch * batch_size examples.
+    Within a mega-batch, examples are sorted by their lengths (first field first) and cut into batches,
+    and the order of all batches is shuffled.
+    Randomness is drawn per epoch: from RandomState(seed + epoch) if a seed is given (reproducible),
+    otherwise from np.random.
+    """
+    def __init__(self, ds, batch_size, lengths=None, megabatch=50, shuffle=True, drop_last=False, seed=None,
+                 sortkey=None):
+        """
+        :param lengths:     lengths of the examples as a list of tuples (e.g. (input length, output length)) or a
+                            function computing them from an example.
+                            Default: the lengths of the 1-dim tensors of an example (the ones autocollate pads).
+        :param megabatch:   number of batches in a mega-batch (larger: less padding but less random batches)
+        :param sortkey:     function from the lengths of an example to the key to sort a mega-batch by
+                            (default: the lengths themselves, so first by the first length, ties by the next)
+        """
+        super(BucketBatchSampler, self).__init__()
+        self.batch_size = batch_size
+        self.megabatch = megabatch
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.sortkey = sortkey
+        self.epoch = 0
+        if lengths is None or isinstance(lengths, Callable):
+            f = example_lengths if lengths is None else lengths
+            lengths = [f(ds[i]) for i in range(len(ds))]
+        self.lengths = [tuple(l) if isinstance(l, (tuple, list)) else (l,) for l in lengths]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, epoch=None):
+        """ Batches (lists of indexes) of the given epoch (default: current epoch). """
+        epoch = self.epoch if epoch is None else epoch
+        rng = np.random.RandomState(self.seed + epoch if self.seed is not None else np.random.randint(0, 2**31-1))
+        indexes = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        size = self.batch_size * self.megabatch
+        keys = self.lengths if self.sortkey is None else [self.sortkey(l) for l in self.lengths]
+        batches = []
+        for i in range(0, len(indexes), size):
+            mega = sorted(indexes[i:i + size].tolist(), key=keys.__getitem__)      # stable
+            batches += [mega[j:j + self.batch_size] for j in range(0, len(mega), self.batch_size)]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def example_lengths(x):
+    """ Lengths of the 1-dim tensors in example x (the ones that are padded by autocollate). """
+    ret = tuple([len(xe) for xe in x if isinstance(xe, torch.Tensor) and xe.dim() == 1])
+    assert(len(ret) > 0)
+    return ret
+
+
+def padding_efficiency(batches, lengths):
+    """
+    Fraction of real (not padding) elements, per length field, when examples are padded to the longest in their batch.
+    :param batches:     lists of indexes
+    :param lengths:     tuples of lengths of the examples
+    """
+    real, padded = np.zeros(len(lengths[0])), np.zeros(len(lengths[0]))
+    for batch in batches:
+        batchlengths = np.asarray([lengths[i] for i in batch])
+        real += batchlengths.sum(0)
+        padded += batchlengths.max(0) * len(batch)
+    return tuple((real / padded).tolist())
+
+
 # region NOISE FUNCTIONS
 class TokenMasker(object):
     mask_symbol = "@MASK@"
@@ -457,6 +1507,29 @@ class SubtreeMasker(TokenMasker):
         else:
             return Tree(x.label(), [self(xe) for xe in x])
 
+
+class TreePermuter(object):
+    """
+    Augmentation that replaces a tree by a uniformly random permutation of it (children of orderless nodes shuffled).
+    Can be added to a Pipeline; accepts Trees or lisp strings (and then returns a lisp string).
+    """
+    def __init__(self, orderless={"and", "or"}, p=1., seed=None, **kw):
+        """
+        :param orderless:   set of labels whose children are unordered, or "__ALL__"
+        :param p:           probability of permuting a given example (otherwise it's returned as is)
+        """
+        super(TreePermuter, self).__init__(**kw)
+        self.orderless = orderless
+        self.p = p
+        self.rng = np.random.RandomState(seed)
+
+    def __call__(self, x:Union[Tree, str]):
+        if self.p < 1 and self.p <= self.rng.random_sample():
+            return x
+        if isinstance(x, str):
+            return tree_to_lisp(sample_tree_permutation(lisp_to_tree(x), orderless=self.orderless, rng=self.rng))
+        return sample_tree_permutation(x, orderless=self.orderless, rng=self.rng)
+
 # endregion
 
 
@@ -513,12 +1586,18 @@ class OvernightDatasetLoader(object):
         return self.simplify_mode == "full"
 
     def load(self, domain:str="restaurants", trainonvalid=False):
+        examples = None
+        if self._usecache:
+            examples = self._load_cached(domain)
 
-        examples, lexicon = self._initialize(self._p, self._mp, domain)
+        if examples is None:
+            examples, lexicon = self._initialize(self._p, self._mp, domain)
 
-        # _examples = examples
-        # examples = [example for example in _examples if example[2] != "train"]
-        examples += [(nl, lf, "lexicon") for nl, lf in lexicon]
+            # _examples = examples
+            # examples = [example for example in _examples if example[2] != "train"]
+            examples += [(nl, lf, "lexicon") for nl, lf in lexicon]
+            if self._usecache:
+                self._cache(domain, examples)
         '''
         examples is a list of tuples with each tuple being nl (utterance), lf (logical form) 
         and (text/train/valid/lexicon)
@@ -534,8 +1613,31 @@ class OvernightDatasetLoader(object):
                 elif example[2] == "test":
                     examples.append((example[0], example[1], "valid"))
                     examples.append(example)
+        if isinstance(examples, BinaryExamples):
+            return SequenceDataset(examples)
         return Dataset(examples)
 
+    def load_many(self, domains, workers=None, trainonvalid=False, f=None):
+        """
+        Loads several domains, in parallel (forked) worker processes.
+        :param domains:     domains to load
+        :param workers:     number of processes (default: one per domain, at most the number of CPUs; <= 1: no workers)
+        :param f:           optional function (domain, Dataset) -> result that is run in the worker on every loaded domain
+                            (e.g. to convert or tokenize the examples), its result is returned instead of the Dataset.
+                            Workers are forked, so f doesn't need to be picklable but its results do.
+        :return:            OrderedDict from domain to the Dataset returned by load() (or the result of f),
+                            in the order of domains, so that vocabularies built by going over them are deterministic
+        """
+        domains = list(domains)
+        workers = min(len(domains), os.cpu_count()) if workers is None else workers
+        if workers <= 1 or len(domains) < 2:
+            ret = [_load_domain(domain, self, trainonvalid, f) for domain in domains]
+        else:
+            with multiprocessing.get_context("fork").Pool(workers, initializer=_init_load_many,
+                                                          initargs=(self, trainonvalid, f)) as pool:
+                ret = pool.map(_load_domain, domains, chunksize=1)
+        return OrderedDict(zip(domains, ret))
+
     def _ztree_to_lf(self, ztree):
         afterstring = set()
         def simplify_tree(t:Tree):
@@ -785,64 +1887,60 @@ class OvernightDatasetLoader(object):
 
         return ret
 
+    def _source_paths(self, domain):
+        return [os.path.join(os.path.dirname(__file__), self._p, f"{domain}.paraphrases.train.examples"),
+                os.path.join(os.path.dirname(__file__), self._p, f"{domain}.paraphrases.test.examples"),
+                os.path.join(os.path.dirname(__file__), self._mp, f"{domain}.grammar")]
+
+    def _cache_path(self, domain):
+        """ Cache file for domain, named by a hash of the source files and of all options that change the examples. """
+        h = hashlib.sha1()
+        for path in self._source_paths(domain):
+            with open(path, "rb") as f:
+                h.update(f.read())
+        options = {"version": BinaryExamples.VERSION,
+                   "simplify_mode": self.simplify_mode, "simplify_blocks": self.simplify_blocks,
+                   "restore_reverse": self._restore_reverse, "simplify_filters": self._simplify_filters,
+                   "validfrac": self.validfrac}
+        h.update(ujson.dumps(options, sort_keys=True).encode("utf-8"))
+        return os.path.join(os.path.dirname(__file__), self._pcache, f"{domain}.{h.hexdigest()[:16]}.bin")
+
     def _load_cached(self, domain):
-        train_cached = ujson.load(open(os.path.join(os.path.dirname(__file__), self._pcache, f"{domain}.train.json"), "r"))
-        trainexamples = [(x, Tree.fromstring(y)) for x, y in train_cached]
-        test_cached = ujson.load(open(os.path.join(os.path.dirname(__file__), self._pcache, f"{domain}.test.json"), "r"))
-        testexamples = [(x, Tree.fromstring(y)) for x, y in test_cached]
+        path = self._cache_path(domain)
+        if not os.path.exists(path):
+            return None
+        try:
+            examples = BinaryExamples(path)
+        except (IOError, ValueError) as e:
+            print(f"could not load cache {path}: {e}")
+            return None
         print("loaded from cache")
-        return trainexamples, testexamples
+        return examples
 
-    def _cache(self, domain:str, trainexamples:List[Tuple[str, Tree]], testexamples:List[Tuple[str, Tree]]):
-        train_cached, test_cached = None, None
-        if os.path.exists(os.path.join(os.path.dirname(__file__), self._pcache, f"{domain}.train.json")):
-            try:
-                train_cached = ujson.load(open(os.path.join(os.path.dirname(__file__), self._pcache, f"{domain}.train.json"), "r"))
-                test_cached = ujson.load(open(os.path.join(os.path.dirname(__file__), self._pcache, f"{domain}.test.json"), "r"))
-            except (IOError, ValueError) as e:
-                pass
-        trainexamples = [(x, str(y)) for x, y in trainexamples]
-        testexamples = [(x, str(y)) for x, y in testexamples]
-
-        if train_cached != trainexamples:
-            with open(os.path.join(os.path.dirname(__file__), self._pcache, f"{domain}.train.json"), "w") as f:
-                ujson.dump(trainexamples, f, indent=4, sort_keys=True)
-        if test_cached != testexamples:
-            with open(os.path.join(os.path.dirname(__file__), self._pcache, f"{domain}.test.json"), "w") as f:
-                ujson.dump(testexamples, f, indent=4, sort_keys=True)
+    def _cache(self, domain:str, examples:List[Tuple[str, Tree, str]]):
+        BinaryExamples.write(self._cache_path(domain), examples)
         print("saved in cache")
 
     def _initialize(self, p, mp, domain):
         self.data = {}
 
-        trainexamples, testexamples = None, None
-        if self._usecache:
-            try:
-                trainexamples, testexamples = self._load_cached(domain)
-            except (IOError, ValueError) as e:
-                pass
-
-        if trainexamples is None:
-            '''
-                Train/Test/Grammar-lines: read the dataset and split it line by line.
-                lexicon: all the tokens (entities and relations) which are used for creating semantic parse.
-                Train/Test-examples: question and the corresponding target semantic parse (TargetFormula) represented as a nltk Tree.
-                (http://www.nltk.org/_modules/nltk/tree.html)
-            '''
-
-            trainlines = [x.strip() for x in
-                         open(os.path.join(os.path.dirname(__file__), p, f"{domain}.paraphrases.train.examples"), "r").readlines()]
-            testlines = [x.strip() for x in
-                        open(os.path.join(os.path.dirname(__file__), p, f"{domain}.paraphrases.test.examples"), "r").readlines()]
+        '''
+            Train/Test/Grammar-lines: read the dataset and split it line by line.
+            lexicon: all the tokens (entities and relations) which are used for creating semantic parse.
+            Train/Test-examples: question and the corresponding target semantic parse (TargetFormula) represented as a nltk Tree.
+            (http://www.nltk.org/_modules/nltk/tree.html)
+        '''
 
-            grammarlines = [x.strip() for x in open(os.path.join(os.path.dirname(__file__), mp, f"{domain}.grammar"), "r").readlines()]
+        trainlines = [x.strip() for x in
+                     open(os.path.join(os.path.dirname(__file__), p, f"{domain}.paraphrases.train.examples"), "r").readlines()]
+        testlines = [x.strip() for x in
+                    open(os.path.join(os.path.dirname(__file__), p, f"{domain}.paraphrases.test.examples"), "r").readlines()]
 
-            trainexamples = self.lines_to_examples(trainlines)
-            testexamples = self.lines_to_examples(testlines)
-            lexicon = self.grammarlines_to_lexicon(grammarlines)
+        grammarlines = [x.strip() for x in open(os.path.join(os.path.dirname(__file__), mp, f"{domain}.grammar"), "r").readlines()]
 
-            if self._usecache:
-                self._cache(domain, trainexamples, testexamples)
+        trainexamples = self.lines_to_examples(trainlines)
+        testexamples = self.lines_to_examples(testlines)
+        lexicon = self.grammarlines_to_lexicon(grammarlines)
 
         questions, queries = tuple(zip(*(trainexamples + testexamples)))
         trainlen = int(round((1-self.validfrac) * len(trainexamples)))
@@ -858,6 +1956,24 @@ class OvernightDatasetLoader(object):
         return examples, lexicon
 
 
+_LOAD_MANY = None       # (loader, trainonvalid, f) of OvernightDatasetLoader.load_many(), only set in its workers
+
+
+def _init_load_many(loader, trainonvalid, f):
+    """ Pool initializer of OvernightDatasetLoader.load_many() (forked, so the arguments are not pickled). """
+    global _LOAD_MANY
+    _LOAD_MANY = (loader, trainonvalid, f)
+
+
+def _load_domain(domain, loader=None, trainonvalid=False, f=None):
+    if loader is None:
+        loader, trainonvalid, f = _LOAD_MANY
+    ret = loader.load(domain=domain, trainonvalid=trainonvalid)
+    if f is not None:
+        ret = f(domain, ret)
+    return ret
+
+
 class TOPDatasetLoader(object):
     def __init__(self,
                  p="../datasets/top/",
@@ -1057,6 +2173,146 @@ def try_top_dataset():
     print(nl_tokenizer.get_vocab())
     print(gds._pcfg.productions)
 
+def try_overnight_cache(domains=("basketball", "blocks", "calendar", "housing",
+                                 "publications", "recipes", "restaurants", "socialnetwork")):
+    """ Load times of the overnight domains: parsing the sources vs a JSON cache (as before) vs the binary cache """
+    pcache = tempfile.mkdtemp(prefix="parseq_overnight_cache_")
+    try:
+        for domain in domains:
+            loader = OvernightDatasetLoader(simplify_mode="light", usecache=True, pcache=pcache)
+            t0 = time.time()
+            try:
+                ref = loader.load(domain)       # parses and writes the binary cache
+            except Exception as e:
+                print(f"{domain}: could not be loaded ({type(e).__name__}: {e})")
+                continue
+            parsetime = time.time() - t0
+            # previous cache: indented json of (question, lisp string) pairs, parsed with Tree.fromstring on load
+            jsonpath = os.path.join(pcache, f"{domain}.json")
+            with open(jsonpath, "w") as f:
+                ujson.dump([(x[0], str(x[1]), x[2]) for x in ref.examples], f, indent=4, sort_keys=True)
+            t0 = time.time()
+            jsonexamples = [(x, Tree.fromstring(y), z) for x, y, z in ujson.load(open(jsonpath, "r"))]
+            jsontime = time.time() - t0
+            t0 = time.time()
+            ds = loader.load(domain)
+            lazytime = time.time() - t0
+            examples = ds.examples
+            fulltime = time.time() - t0
+            assert(examples == ref.examples and len(jsonexamples) == len(examples))
+            binsize = os.path.getsize(loader._cache_path(domain))
+            print(f"{domain} ({len(examples)} examples): parse {parsetime:.3f}s, "
+                  f"json {jsontime:.3f}s ({os.path.getsize(jsonpath) // 1024}KB), "
+                  f"binary {lazytime:.4f}s lazy / {fulltime:.3f}s all decoded ({binsize // 1024}KB)")
+    finally:
+        shutil.rmtree(pcache, ignore_errors=True)
+
+
+def try_overnight_load_many(domains=("blocks", "calendar", "housing", "publications", "recipes", "restaurants"),
+                            workers=(2, 6)):
+    """ Startup time of loading all overnight domains and building a vocabulary: one by one vs load_many() """
+    def build_vocab(loaded):
+        seqenc = SequenceEncoder(tokenizer=tree_to_lisp_tokens)
+        for domain, ds in loaded.items():
+            for example in ds.examples:
+                seqenc.inc_build_vocab(example[1], seen=example[2] == "train")
+        seqenc.finalize_vocab()
+        return seqenc.vocab.D
+
+    loader = OvernightDatasetLoader(simplify_mode="light", simplify_blocks=True, validfrac=.10)
+    t0 = time.time()
+    ref = OrderedDict([(domain, loader.load(domain)) for domain in domains])
+    refvocab = build_vocab(ref)
+    print(f"one by one: {time.time() - t0:.2f}s")
+    for w in workers:
+        t0 = time.time()
+        loaded = loader.load_many(domains, workers=w)
+        vocab = build_vocab(loaded)
+        print(f"load_many({w} workers): {time.time() - t0:.2f}s, "
+              f"same examples: {all([loaded[d].examples == ref[d].examples for d in domains])}, "
+              f"same vocab: {list(vocab.items()) == list(refvocab.items())}")
+
+
+def try_bucket_batch_sampler(batch_sizes=(10, 50), megabatches=(10, 50)):
+    """ Padding efficiency (fraction of non-padding tokens in input and output) of shuffled vs bucketed batches """
+    geo = [line.strip().split("\t") for line in
+           open(os.path.join(os.path.dirname(__file__), "../datasets/geo880dong/train.txt"))]
+    geolengths = [(len(nl.split()), len(lf.split())) for nl, lf in geo]
+    overnight = OvernightDatasetLoader(simplify_mode="light").load_many(["restaurants", "blocks", "housing"])
+    overnightlengths = [(len(x[0].split()), len(tree_to_lisp_tokens(x[1])))
+                        for ds in overnight.values() for x in ds.examples if x[2] == "train"]
+    for name, lengths in [("geo880", geolengths), ("overnight", overnightlengths)]:
+        print(f"{name} ({len(lengths)} examples):")
+        for batch_size in batch_sizes:
+            rng = np.random.RandomState(1)
+            indexes = rng.permutation(len(lengths)).tolist()
+            shuffled = [indexes[i:i + batch_size] for i in range(0, len(indexes), batch_size)]
+            eff = padding_efficiency(shuffled, lengths)
+            print(f"  batch size {batch_size}, shuffled: input {eff[0]:.3f}, output {eff[1]:.3f}")
+            for megabatch in megabatches:
+                for keyname, sortkey in [("input, output", None), ("sum", sum)]:
+                    sampler = BucketBatchSampler(None, batch_size, lengths=lengths, megabatch=megabatch,
+                                                 seed=1, sortkey=sortkey)
+                    eff = padding_efficiency(sampler.batches(), lengths)
+                    print(f"  batch size {batch_size}, mega-batch {megabatch}, sorted by {keyname}: "
+                          f"input {eff[0]:.3f}, output {eff[1]:.3f}")
+
+
+def try_pcfg_length_sampling(n=2000, maxlens=(100, 50, 30, 20, 15), budget=20.):
+    """ Accepted samples per second when sampling trees below maxlen: by rejection vs from the inside table """
+    geotrees = [lisp_to_tree(line.split("\t")[1]) for line in
+                open(os.path.join(os.path.dirname(__file__), "../datasets/geo880dong/train.txt"))]
+    ovd = OvernightDatasetLoader(usecache=False, simplify_mode="none").load(domain="calendar")
+    grammars = [("geo880", PCFGBuilder(orderless={"and"}).build(geotrees)),
+                ("overnight-calendar", OvernightPCFGBuilder()
+                 .build(ovd[lambda x: x[2] == "train"].map(lambda x: x[1]).examples))]
+    for name, pcfg in grammars:
+        print(f"{name}: {len(pcfg.productions())} productions")
+        for maxlen in maxlens:
+            # before: sample whole derivations (practically unbounded) and keep those that fit, for at most budget seconds
+            unbounded = PCFGDataset(pcfg, seed=1, maxlen=1000)
+            accepted, draws, i = 0, 0, 0
+            t0 = time.time()
+            while accepted < n and time.time() - t0 < budget:
+                xs = unbounded.generate_many(100, seed=i)
+                accepted += sum([tree_length(x, count_brackets=True) < maxlen for x in xs])
+                draws, i = draws + len(xs), i + 1
+            rejectionspeed = accepted / (time.time() - t0)
+            # after: inside table, no rejection
+            t0 = time.time()
+            exact = PCFGDataset(pcfg, seed=1, maxlen=maxlen, exact_length=True)
+            buildtime = time.time() - t0
+            t0 = time.time()
+            xs = exact.generate_many(n)
+            exactspeed = n / (time.time() - t0)
+            assert(max([tree_length(x, count_brackets=True) for x in xs]) < maxlen)
+            print(f"  maxlen={maxlen}: acceptance {accepted / draws:.4f}, rejection {rejectionspeed:.0f}/s, "
+                  f"inside table {exactspeed:.0f}/s (built in {buildtime:.3f}s)")
+
+
+def try_sharded_generation(N=20000, workers=(0, 2, 4), blocksize=None):
+    """ Time to generate all examples of a PCFGDataset, in this process vs sharded over worker processes """
+    geotrees = [lisp_to_tree(line.split("\t")[1]) for line in
+                open(os.path.join(os.path.dirname(__file__), "../datasets/geo880dong/train.txt"))]
+    pcfg = PCFGBuilder(orderless={"and"}).build(geotrees)
+    ds = PCFGDataset(pcfg, N=N, seed=1, temperature=.33, maxlen=100, blocksize=blocksize)
+    t0 = time.time()
+    for x in ds.examples:
+        pass
+    print(f"single process: {time.time() - t0:.2f}s")
+    ref = [str(x) for x in PCFGDataset(pcfg, N=N, seed=1, temperature=.33, maxlen=100, blocksize=blocksize).examples]
+    for w in workers:
+        ds = PCFGDataset(pcfg, N=N, seed=1, temperature=.33, maxlen=100, blocksize=blocksize)
+        t0 = time.time()
+        sds = ds.shard(workers=w)
+        t1 = time.time()
+        for x in sds.examples:
+            pass
+        t2 = time.time()
+        print(f"{w} workers: generated in {t1 - t0:.2f}s, read in {t2 - t1:.2f}s, "
+              f"identical: {[str(x) for x in sds.examples] == ref}")
+
+
 if __name__ == '__main__':
     # import filelock
     # try_tokenizer_dataset()
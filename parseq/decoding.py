@@ -1,3 +1,4 @@
+from copy import copy, deepcopy
 from typing import Dict, List, Union, Tuple
 
 import torch
@@ -16,18 +17,30 @@ class StopDecoding(Exception):
 class SeqDecoder(torch.nn.Module):
     def __init__(self, model:TransitionModel,
                  eval:List[Union[Metric, Loss]]=tuple(),
-                 maxtime=100, tf_ratio=1.0, **kw):
+                 maxtime=100, tf_ratio=1.0, compact=False, **kw):
+        """
+        :param compact:     if True, in freerunning mode, terminated examples are removed from the state that is fed to the model
+                            and written back into the given state when they terminate.
+                            In freerunning mode (compact or not), outputs and predicted actions of terminated examples
+                            are zero from the step after their termination on (see pad_terminated()),
+                            so that compact and non-compact decoding give the same results.
+        """
         super(SeqDecoder, self).__init__(**kw)
         self.model = model
         self._metrics = eval
         self.maxtime = maxtime
         self.tf_ratio = tf_ratio        # 1 is for full TF, 0 for freerunning
+        self.compact = compact
         assert(self.tf_ratio == 1. or self.tf_ratio == 0)
 
     def forward(self, x:TrainableDecodableState, tf_ratio:float=None, return_all=False) -> Tuple[Dict, State]:
         tf_ratio = self.tf_ratio if tf_ratio is None else tf_ratio
+        if self.compact and tf_ratio == 0.:
+            return self.forward_compact(x, return_all=return_all)
         # sb = sb.make_copy()
         x.start_decoding()
+        if tf_ratio == 1. and self.model.supports_forward_sequence(x):
+            return self.forward_sequence(x, return_all=return_all)
 
         out = []
         predactions = []
@@ -37,8 +50,11 @@ class SeqDecoder(torch.nn.Module):
         all_terminated = x.all_terminated()
         while not all_terminated:
             try:
+                done = torch.tensor(np.asarray(x.is_terminated(), dtype=bool)) if tf_ratio == 0. else None
                 actionprobs, x = self.model(x)
                 _, _predactions = actionprobs.max(-1)
+                if done is not None and done.any():
+                    actionprobs, _predactions = pad_terminated(actionprobs, _predactions, done)
                 # feed next
                 if tf_ratio == 1.:
                     goldactions = x.get_gold(i)
@@ -65,6 +81,97 @@ class SeqDecoder(torch.nn.Module):
         else:
             return metrics, x
 
+    def forward_sequence(self, x:TrainableDecodableState, return_all=False) -> Tuple[Dict, State]:
+        """
+        Teacher forcing using .forward_sequence() of the model to compute the outputs of all steps at once.
+        Only valid if .supports_forward_sequence() of the model returns True for x.
+        """
+        prev_actions = []
+        i = 0
+        all_terminated = x.all_terminated()
+        while not all_terminated:
+            prev_actions.append(x.prev_actions)
+            x.step(x.get_gold(i))
+            all_terminated = x.all_terminated() or i >= self.maxtime - 1
+            i += 1
+
+        out, x = self.model.forward_sequence(x, torch.stack(prev_actions, 1))
+        _, predactions = out.max(-1)
+
+        golds = x.get_gold()
+
+        metrics = [metric(out, predactions, golds, x) for metric in self._metrics]
+        metrics = merge_metric_dicts(*metrics)
+
+        if return_all:
+            return metrics, x, out, predactions, golds
+        else:
+            return metrics, x
+
+    def forward_compact(self, x:TrainableDecodableState, return_all=False) -> Tuple[Dict, State]:
+        """
+        Freerunning decoding where only the examples that are not terminated yet are fed to the model.
+        Outputs, predicted actions and decoder state are the same as with .forward(tf_ratio=0),
+        except for the model's own substates of terminated examples, which are kept as they were at termination.
+        """
+        x.start_decoding()
+        batsize = len(x)
+
+        out = []
+        predactions = []
+
+        i = 0
+        active = torch.arange(batsize)      # ids in x of the examples in the working state
+        xa = x                              # working state
+
+        all_terminated = x.all_terminated()
+        while not all_terminated:
+            try:
+                actionprobs, xa = self.model(xa)
+                _, _predactions = actionprobs.max(-1)
+                xa.step(_predactions)
+                _active = active.to(actionprobs.device)
+                # terminated examples are padded as in pad_terminated()
+                out.append(actionprobs.new_zeros(batsize, *actionprobs.size()[1:]).index_copy(0, _active, actionprobs))
+                predactions.append(_predactions.new_zeros(batsize).index_copy(0, _active, _predactions))
+                if i == 0:
+                    x = xa          # model may return a different state object
+                is_term = torch.tensor(xa.is_terminated())
+                if is_term.any():
+                    if xa is not x:
+                        x[active[is_term]] = xa[is_term]        # write back terminated examples
+                    xa, active = xa[~is_term], active[~is_term]
+                all_terminated = len(active) == 0 or i >= self.maxtime - 1
+                i += 1
+            except StopDecoding as e:
+                all_terminated = True
+        if xa is not x and len(active) > 0:
+            x[active] = xa
+
+        out = torch.stack(out, 1)
+        predactions = torch.stack(predactions, 1)
+
+        golds = x.get_gold()
+
+        metrics = [metric(out, predactions, golds, x) for metric in self._metrics]
+        metrics = merge_metric_dicts(*metrics)
+
+        if return_all:
+            return metrics, x, out, predactions, golds
+        else:
+            return metrics, x
+
+
+def pad_terminated(actionprobs:torch.Tensor, predactions:torch.Tensor, terminated:torch.Tensor):
+    """
+    Zeroes the (batsize, V) outputs and (batsize,) predicted actions of examples that were terminated before this step.
+    Zero is the padding id that terminated examples get in their followed actions.
+    """
+    terminated = terminated.to(actionprobs.device)
+    actionprobs = actionprobs.masked_fill(terminated.view(-1, *([1] * (actionprobs.dim() - 1))), 0)
+    predactions = predactions.masked_fill(terminated, 0)
+    return actionprobs, predactions
+
 
 def merge_metric_dicts(*dicts, sum_loss=True, sum_penalties=True):
     ret = {}
@@ -97,13 +204,33 @@ class BeamDecoder(SeqDecoder):
     def __init__(self, model:TransitionModel,
                  eval:List[Union[Metric, Loss]]=tuple(),
                  eval_beam:List[Union[Metric, Loss]]=tuple(),
-                 beamsize=1, maxtime=100, copy_deep=False, **kw):
-        model = BeamTransition(model, beamsize=beamsize, maxtime=maxtime, copy_deep=copy_deep)
+                 beamsize=1, maxtime=100, copy_deep=False, keep_actionprobs=True, **kw):
+        """
+        :param keep_actionprobs:    if False, the beam only keeps the log-probabilities of the chosen actions and backpointers
+                                    instead of the full (batsize, beamsize, T, V) output distributions.
+                                    The distributions of the top hypothesis are then recomputed after decoding,
+                                    only if a Loss in eval needs them. Metrics in eval_beam get None as probs.
+        """
+        model = BeamTransition(model, beamsize=beamsize, maxtime=maxtime, copy_deep=copy_deep, keep_actionprobs=keep_actionprobs)
         super(BeamDecoder, self).__init__(model, eval, **kw)
         self._beam_metrics = eval_beam
+        self.keep_actionprobs = keep_actionprobs
+        assert(keep_actionprobs or not any([isinstance(metric, Loss) for metric in self._beam_metrics]))
+
+    def recompute_actionprobs(self, x:TrainableDecodableState, actions:torch.Tensor):
+        """ Runs the transition model over given (batsize, T) actions from given initial state and returns (batsize, T, V) outputs. """
+        x.start_decoding()
+        out = []
+        for i in range(actions.size(1)):
+            actionprobs, x = self.model.model(x)
+            out.append(actionprobs)
+            x.step(actions[:, i])
+        return torch.stack(out, 1)
 
     def forward(self, x:TrainableDecodableState) -> Dict:
         # sb = sb.make_copy()
+        recompute = not self.keep_actionprobs and any([isinstance(metric, Loss) for metric in self._metrics])
+        x0 = x.make_copy(detach=False, deep="cow") if recompute else None
         x.start_decoding()
 
         i = 0
@@ -115,12 +242,18 @@ class BeamDecoder(SeqDecoder):
             i += 1
 
         assert(isinstance(x, BeamState))
-        golds = x.bstates.get(0).get_gold()
+        golds = x.get_beam_element(0).get_gold()
+        if not self.keep_actionprobs:
+            predactions, _ = x.backtrack()
 
         beam_metrics = [metric(outprobs, predactions, golds, x) for metric in self._beam_metrics]
         beam_metrics = merge_metric_dicts(*beam_metrics)
         # get top of the beam and run eval on top of the beam
-        top_outprobs, top_predactions, top_x = outprobs[:, 0], predactions[:, 0], x.bstates.get(0)
+        top_predactions, top_x = predactions[:, 0], x.get_beam_element(0)
+        if self.keep_actionprobs:
+            top_outprobs = outprobs[:, 0]
+        else:
+            top_outprobs = self.recompute_actionprobs(x0, top_predactions) if recompute else None
         metrics = [metric(top_outprobs, top_predactions, golds, top_x) for metric in self._metrics]
         metrics = merge_metric_dicts(beam_metrics, *metrics)
         return metrics, x
@@ -130,51 +263,78 @@ class BeamTransition(SeqDecoderTransition):
     """
     Transition for beam search.
     """
-    def __init__(self, model:TransitionModel, beamsize=1, maxtime=100, copy_deep=False, **kw):
+    def __init__(self, model:TransitionModel, beamsize=1, maxtime=100, copy_deep=False, keep_actionprobs=True, **kw):
+        """
+        :param keep_actionprobs:    if False, creates compact beam states (see BeamState and BeamDecoder)
+        :param copy_deep:   if True, elements of numpy object arrays (token lists, trees, ...) are deep-copied
+                            when a beam element is continued more than once, otherwise they are copied shallowly.
+                            (Tensors are always copied by the index operation that reorders the folded beam.)
+        """
         super(BeamTransition, self).__init__(model, **kw)
         self.maxtime = maxtime
         self.beamsize = beamsize
         self.copy_deep = copy_deep
+        self.keep_actionprobs = keep_actionprobs
 
     def do_single_state_init(self, x):
         actionprobs, x = self.model(x)
         is_term = torch.tensor(x.is_terminated()).to(actionprobs.device)
-        logprobs, actionids = torch.sort(actionprobs, 1, descending=True)
-        beamstates = []
-        beamsize = min(self.beamsize, actionids.size(1))
-        for i in range(beamsize):
-            x_copy = x.make_copy(detach=False, deep=True)
-            x_copy.step(actionids[:, i])
-            beamstates.append(x_copy)
-        scores = logprobs[:, :beamsize]
-        # take into account terminated states
         if is_term.any().cpu().item():
-            scores[is_term, 0] = 0
-            scores[is_term, 1:] = -np.infty
             raise Exception("terminated after first timestep! wtf!")
+        beamsize = min(self.beamsize, actionprobs.size(1))
+        scores, actionids = torch.topk(actionprobs, beamsize, 1)
+        # fold the beam into the batch: every example is repeated beamsize times
+        fstate = x[torch.arange(len(x), device=actionprobs.device).repeat_interleave(beamsize)]
+        _copy_object_rows(fstate, np.arange(len(fstate)), deep=self.copy_deep is True)
+        fstate.step(actionids.reshape(-1))
         # create beam state
-        y = BeamState(beamstates,
-                      scores=scores,
-                      actionprobs=[actionprobs.clone()[:, None, :] for _ in range(beamsize)],
-                      predactions=actionids[:, :beamsize, None])
+        if self.keep_actionprobs:
+            y = BeamState(fstate,
+                          scores=scores,
+                          actionprobs=actionprobs[:, None, None, :].repeat(1, beamsize, 1, 1),
+                          predactions=actionids[:, :, None],
+                          beamsize=beamsize)
+        else:
+            y = BeamState(fstate, scores=scores, beamsize=beamsize,
+                          actions=actionids[:, :, None], actionlogprobs=scores[:, :, None],
+                          backpointers=torch.zeros_like(actionids[:, :, None]))
         return y
 
-    def gather_states(self, x:List[State], indexes:torch.Tensor)->List[State]:
-        ret = []
-        for i in range(indexes.size(1)): # for every element in new beam
-            uniq = indexes[:, i].unique()
-            if len(uniq) == 1:
-                x_id = uniq[0].cpu().item()
-                proto = x[x_id].make_copy(detach=False, deep=self.copy_deep)
-            else:
-                proto = x[0].make_copy(detach=True, deep=self.copy_deep)
-                for x_id in uniq:            # for every id pointing to a batch in current beam
-                    # x_x_id_copy = x[x_id].make_copy(detach=False, deep=True)
-                    x_id = x_id.cpu().item()
-                    idxs_where_x_id = torch.where(indexes[:, i] == x_id)[0]
-                    proto[idxs_where_x_id] = x[x_id][idxs_where_x_id].make_copy(detach=False, deep=self.copy_deep)
-                    # proto[idxs_where_x_id] = x_x_id_copy[idxs_where_x_id]
-            ret.append(proto)
+    def select(self, actionprobs:torch.Tensor, bscores:torch.Tensor, is_term:torch.Tensor):
+        """
+        Selects the best continuations over all beam elements and actions with a single topk.
+        :param actionprobs:     (batsize*beamsize, vocsize) log-probabilities of next actions for every beam element
+        :param bscores:         (batsize, beamsize) scores of the beam elements so far
+        :param is_term:         (batsize*beamsize,) bool whether beam element is terminated.
+                                Terminated elements are only continued with their highest-scoring action (as recorded in predactions),
+                                without changing their score. Their decoder states record padding regardless.
+        :return:    (batsize, newbeamsize) scores, ids of the beam elements that are continued and ids of the actions
+        """
+        batsize, beamsize = bscores.size()
+        vocsize = actionprobs.size(1)
+        if is_term.any().cpu().item():
+            termprobs = torch.full_like(actionprobs, -np.infty).scatter_(1, actionprobs.argmax(1, keepdim=True), 0)
+            actionprobs = torch.where(is_term[:, None], termprobs, actionprobs)
+        scores = (actionprobs.view(batsize, beamsize, vocsize) + bscores[:, :, None]).view(batsize, beamsize * vocsize)
+        scores, selection_ids = torch.topk(scores, min(self.beamsize, scores.size(1)), 1)
+        return scores, torch.div(selection_ids, vocsize, rounding_mode="floor"), selection_ids % vocsize
+
+    def gather_states(self, x:State, indexes:torch.Tensor, beamsize:int)->State:
+        """
+        Selects rows from folded state x with a single index operation.
+        :param x:           folded state with batsize*beamsize rows
+        :param indexes:     (batsize, newbeamsize) ids of the beam elements in x to take for every element of the new beam
+        :return:            folded state with batsize*newbeamsize rows
+        """
+        rows = (torch.arange(indexes.size(0), device=indexes.device)[:, None] * beamsize + indexes).view(-1)
+        ret = x[rows]
+        # rows that were selected more than once share the objects in numpy object arrays: copy them
+        rows = rows.cpu().numpy()
+        _, firsts = np.unique(rows, return_index=True)
+        duplicates = np.ones(len(rows), dtype=bool)
+        duplicates[firsts] = False
+        if duplicates.any():
+            _copy_object_rows(ret, np.where(duplicates)[0], deep=self.copy_deep is True)
         return ret
 
     def forward(self, x:Union[DecodableState, BeamState], timestep:int):
@@ -183,46 +343,47 @@ class BeamTransition(SeqDecoderTransition):
             y = self.do_single_state_init(x)
         else:
             assert(isinstance(x, BeamState))
+            batsize, modul = len(x), x.beamsize
 
-            # gather logprobs and actionids from individual beam elements in batches
-            scoreses, actionidses, actionprobses = [], [], []
-            modul = None
-            for i in range(len(x.bstates._list)):
-                actionprobs, xi = self.model(x.bstates.get(i))      # get i-th batched state in beam, run model over it
-                is_term = torch.tensor(xi.is_terminated()).to(actionprobs.device)
-                x.bstates.set(i, xi)
-                logprobs, actionids = torch.sort(actionprobs, 1, descending=True)   # sort output actions
-                beamsize = min(self.beamsize, actionids.size(1))
-                _actionprobs = torch.cat([x.actionprobs.get(i), actionprobs[:, None, :]], 1)
-                actionprobses.append(_actionprobs)
-                scores = logprobs[:, :beamsize]  # clip logprob to beamsize
-                if is_term.any().cpu().item():
-                    scores[is_term, 0] = 0
-                    scores[is_term, 1:] = -np.infty
-                scores = scores + x.bscores[:, i:i+1]                       # compute logprob of whole seq so far
-                actionids = actionids[:, :beamsize]# clip actionids to beamsize
-                scoreses.append(scores)         # save
-                actionidses.append(actionids)       # save
-                modul = beamsize if modul is None else modul   # make sure modul is correct and consistent (used later for state copying)
-                assert(modul == actionids.size(1))
-            scoreses, actionidses, actionprobses = torch.cat(scoreses, 1), torch.cat(actionidses, 1), torch.stack(actionprobses, 1)       # concatenate
-
-            # sort and select actionids for new beam, update logprobs etc
-            scores, selection_ids = torch.sort(scoreses, 1, descending=True)     # sort: selection_ids are the ids in logprobses
-            beamsize = min(self.beamsize, selection_ids.size(1))
-            scores = scores[:, :beamsize]       # clip to beamsize
-            selection_ids = selection_ids[:, :beamsize]       # clip to beamsize
-            actionids = actionidses.gather(1, selection_ids)         # select action ids using beam_ids
-            stateids = selection_ids // modul        # select state ids based on modul and selection_ids
-            actionprobs = actionprobses.gather(1, stateids[:, :, None, None].repeat(1, 1, actionprobses.size(2), actionprobses.size(3)))
-            predactions = x.predactions.gather(1, stateids[:, :, None].repeat(1, 1, x.predactions.size(2)))
-            predactions = torch.cat([predactions, actionids[:, :, None]], 2)
-            gatheredstates = self.gather_states(x.bstates._list, stateids)    # gatheredstates is a ListState
+            # run model once over all beam elements of all examples
+            actionprobs, fstate = self.model(x.fstate)
+            is_term = torch.tensor(fstate.is_terminated()).to(actionprobs.device)
+
+            # select actionids for new beam, update logprobs etc
+            scores, stateids, actionids = self.select(actionprobs, x.bscores, is_term)
+            beamsize = scores.size(1)
+            gatheredstates = self.gather_states(fstate, stateids, modul)
 
             # apply selected actions to selected states
-            for i in range(actionids.size(1)):
-                gatheredstates[i].step(actionids[:, i])         # if timestep != self.maxtime-1 else [self.endtoken]*len(gatheredstates[i]))
+            gatheredstates.step(actionids.reshape(-1))
 
             # create new beamstate from updated selected states
-            y = BeamState(gatheredstates, scores=scores, actionprobs=[e[:, 0] for e in actionprobs.split(1, 1)], predactions=predactions)
-        return torch.stack(y.actionprobs._list, 1), y.predactions, y, y.all_terminated() or timestep >= self.maxtime - 1
\ No newline at end of file
+            if self.keep_actionprobs:
+                actionprobses = torch.cat([x.actionprobs, actionprobs.view(batsize, modul, 1, -1)], 2)
+                actionprobs = actionprobses.gather(1, stateids[:, :, None, None].repeat(1, 1, actionprobses.size(2), actionprobses.size(3)))
+                predactions = x.predactions.gather(1, stateids[:, :, None].repeat(1, 1, x.predactions.size(2)))
+                predactions = torch.cat([predactions, actionids[:, :, None]], 2)
+                y = BeamState(gatheredstates, scores=scores, actionprobs=actionprobs, predactions=predactions, beamsize=beamsize)
+            else:
+                actionlogprobs = actionprobs.view(batsize, modul, -1)[torch.arange(batsize, device=stateids.device)[:, None], stateids, actionids]
+                actionlogprobs = actionlogprobs.masked_fill(is_term.view(batsize, modul).gather(1, stateids), 0)
+                y = BeamState(gatheredstates, scores=scores, beamsize=beamsize,
+                              actions=torch.cat([x.actions, actionids[:, :, None]], 2),
+                              actionlogprobs=torch.cat([x.actionlogprobs, actionlogprobs[:, :, None]], 2),
+                              backpointers=torch.cat([x.backpointers, stateids[:, :, None]], 2))
+        if self.keep_actionprobs:
+            return y.actionprobs, y.predactions, y, y.all_terminated() or timestep >= self.maxtime - 1
+        else:
+            return None, None, y, y.all_terminated() or timestep >= self.maxtime - 1
+
+
+def _copy_object_rows(x:State, rows:np.ndarray, deep=False):
+    """ Replaces the elements at given rows of all numpy object arrays in x (recursively) by copies. """
+    for k in x._schema_keys:
+        v = getattr(x, k)
+        if isinstance(v, State):
+            _copy_object_rows(v, rows, deep=deep)
+        elif isinstance(v, np.ndarray) and v.dtype == object:
+            v = x._own(k)
+            for row in rows:
+                v[row] = deepcopy(v[row]) if deep else copy(v[row])
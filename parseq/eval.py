@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from functools import partial
-from typing import Union, Dict, Callable
+from typing import Union, Dict, Callable, List, Iterable
 
 import nltk
 import qelos as q
@@ -8,7 +8,7 @@ import qelos as q
 import torch
 import numpy as np
 
-from parseq.grammar import are_equal_trees
+from parseq.grammar import canonicalize_tree
 from parseq.states import State, DecodableState, TrainableDecodableState, BeamState
 
 
@@ -290,26 +290,63 @@ class DerivedAccuracy(Metric):
 
 class TreeAccuracy(Metric):
     unktoken = "@UNK@"
-    def __init__(self, name:str="tree_acc", tensor2tree:Callable[[torch.Tensor], nltk.Tree]=None, orderless=set(), **kw):
+    def __init__(self, name:str="tree_acc", tensor2tree:Callable[[torch.Tensor], nltk.Tree]=None, orderless=set(),
+                 batch_tensor2tree:Callable[[torch.Tensor], List[nltk.Tree]]=None, **kw):
+        """
+        :param tensor2tree:         converts one 1D id sequence to a tree
+        :param batch_tensor2tree:   (optional) converts a 2D batch of id sequences to a list of trees at once
+                                    (e.g. partial(parseq.grammar.batch_tensor2tree, vocab=...)), used instead of tensor2tree
+        """
         super(TreeAccuracy, self).__init__(**kw)
         self.name = name
         self.tensor2tree = tensor2tree
+        self.batch_tensor2tree = batch_tensor2tree
         self.orderless = orderless
 
+    def canonicalize(self, x:Union[torch.Tensor, Iterable[torch.Tensor]], memo:Dict=None):
+        """
+        Canonical forms of the trees decoded from the rows of the 2D id tensor x
+        (or from the 1D id tensors in x, which can have different lengths), memoized on the id sequences.
+        Every distinct sequence is decoded once (in one call if batch_tensor2tree is given).
+        """
+        memo = {} if memo is None else memo
+        if isinstance(x, torch.Tensor):
+            keys = [tuple(xe) for xe in x.tolist()]
+        else:
+            x = list(x)
+            keys = [tuple(xe.tolist()) for xe in x]
+        todo = {}
+        for i, key in enumerate(keys):
+            if key not in memo and key not in todo:
+                todo[key] = i
+        if len(todo) > 0:
+            rows = list(todo.values())
+            if self.batch_tensor2tree is not None and isinstance(x, torch.Tensor):
+                trees = self.batch_tensor2tree(x[rows])
+            elif self.tensor2tree is not None:
+                trees = [self.tensor2tree(x[row]) for row in rows]
+            else:       # pad with id 0 (padding) to decode the sequences as one batch
+                trees = self.batch_tensor2tree(torch.nn.utils.rnn.pad_sequence([x[row] for row in rows], batch_first=True))
+            for key, tree in zip(todo.keys(), trees):
+                memo[key] = canonicalize_tree(tree, orderless=self.orderless, unktoken=self.unktoken)
+        return [memo[key] for key in keys]
+
     def forward(self, probs, predactions, golds, x:State=None):
+        memo = {}
         def compare(_gold_trees, _predactions):
-            pred_trees = [self.tensor2tree(predactionse) for predactionse in _predactions]
-            ret = [float(are_equal_trees(gold_tree, pred_tree, orderless=self.orderless, unktoken=self.unktoken))
+            pred_trees = self.canonicalize(_predactions, memo)
+            ret = [float(gold_tree == pred_tree)
                    for gold_tree, pred_tree in zip(_gold_trees, pred_trees)]
             return ret
         if predactions.dim() == 3:      # beam states
             # assert(isinstance(x, BeamState))
             # golds = x.bstates.get(0).get_gold()
-            gold_trees = [self.tensor2tree(goldse) for goldse in golds]
-            rets = []
-            for i in range(predactions.size(1)):
-                ret_i = compare(gold_trees, predactions[:, i])
-                rets.append(ret_i)
+            gold_trees = self.canonicalize(golds, memo)
+            # decode all beam elements in one go, rows ordered as (example, beam element)
+            beamsize = predactions.size(1)
+            pred_trees = self.canonicalize(predactions.reshape(-1, predactions.size(-1)), memo)
+            rets = [[float(gold_tree == pred_tree) for gold_tree, pred_tree in zip(gold_trees, pred_trees[i::beamsize])]
+                    for i in range(beamsize)]
             rets = np.asarray(rets).T
             acc_cum = np.cumsum(rets, 1)
             acc_cum = np.clip(acc_cum, 0, 1)
@@ -324,7 +361,7 @@ class TreeAccuracy(Metric):
             assert(predactions.dim() == 2)
             # golds = x.get_gold()
             # _gold_trees = x.gold_trees
-            gold_trees = [self.tensor2tree(goldse) for goldse in golds]
+            gold_trees = self.canonicalize(golds, memo)
             ret = compare(gold_trees, predactions)
             ret = {self.name: sum(ret) / len(ret)}
             return ret
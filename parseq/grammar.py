@@ -1,7 +1,12 @@
+import math
+import random
 import re
 from abc import ABC, abstractmethod
-from typing import List
+from functools import partial
+from itertools import permutations
+from typing import List, Union
 
+import numpy as np
 from nltk import Tree, ParentedTree
 
 
@@ -14,8 +19,11 @@ def pas_to_str(x):
         return x
 
 
+_TREESTR_DELIMS = re.compile(r"[()\s'\"]")
+
+
 class TreeStrParser(ABC):
-    def __init__(self, x:str=None, brackets="()"):
+    def __init__(self, x:str=None, brackets="()", tree_class=Tree):
         super(TreeStrParser, self).__init__()
         self.stack = [[]]
         self.curstring = None
@@ -24,6 +32,7 @@ class TreeStrParser(ABC):
         self.next_is_sibling = False
         self.nameless_func = "@NAMELESS@"
         self.brackets = brackets
+        self.tree_class = tree_class     # node class used by the *ToTree parsers (e.g. ActionTree)
 
         if x is not None:
             self.feed(x)
@@ -41,48 +50,99 @@ class TreeStrParser(ABC):
         pass
 
     def feed(self, x:str):
-        xsplits = re.split("([\(\)\s'\"])", x)
-        queue = list(xsplits)
-        while len(queue) > 0:
-            next_token = queue.pop(0)
+        """
+        Scans x once, left to right, and updates the parse stack.
+        Tokens are maximal runs of characters other than brackets, whitespace and quotes, and those characters themselves.
+        Can be called repeatedly: open levels and unfinished quoted strings carry over to the next call.
+        :return: the parsed structure if the stack holds exactly one complete element, None otherwise
+        """
+        search = _TREESTR_DELIMS.search
+        opener, closer = self.brackets[0], self.brackets[1]
+        i, n = 0, len(x)
+        while True:
+            m = search(x, i)
+            j = n if m is None else m.start()
             if self.curstring is not None:
-                if next_token == "\\":
-                    self.prevescape = 2
-                elif next_token == "":
-                    continue
-                self.curstring += next_token
-                if self.curstring[-1] == self.stringmode and self.prevescape == 0:  # closing string
-                    self.stack[-1].append(self.curstring)
-                    self.curstring = None
-                    self.stringmode = None
-                self.prevescape = max(self.prevescape - 1, 0)
+                if j > i:
+                    self._feed_string_token(x[i:j])
+                if m is not None:
+                    self._feed_string_token(x[j])
             else:
+                # common case outside of quoted strings handled inline
+                self.next_is_sibling = False
+                self.prevescape = False
+                if j > i:
+                    token = x[i:j]
+                    if token == opener:
+                        self.add_level()
+                    elif token == closer:
+                        self.close_level()
+                    elif token == ",":
+                        self.next_is_sibling = True
+                    else:
+                        self.add_sibling(token)
+                if m is not None:
+                    token = x[j]
+                    self.next_is_sibling = False
+                    if token == opener:
+                        self.add_level()
+                    elif token == closer:
+                        self.close_level()
+                    elif token == "'" or token == '"':
+                        self.curstring = token
+                        self.stringmode = token
+                    elif not token.isspace():
+                        self.add_sibling(token)
+            if m is None:
+                break
+            i = j + 1
+        if len(self.stack) != 1 or len(self.stack[-1]) != 1:
+            return None
+        else:
+            return self.stack[-1][-1]
+
+    def feed_tokens(self, tokens:List[str]):
+        """
+        Same as feed(" ".join(tokens)) but without joining and re-scanning plain tokens.
+        :return: the parsed structure if the stack holds exactly one complete element, None otherwise
+        """
+        search = _TREESTR_DELIMS.search
+        opener, closer = self.brackets[0], self.brackets[1]
+        for token in tokens:
+            if self.curstring is None and (token == "(" or token == ")" or search(token) is None):
                 self.next_is_sibling = False
-                next_token = next_token.strip()
                 self.prevescape = False
-                if next_token == self.brackets[0]:
-                    # add one level on stack
+                if token == opener:
                     self.add_level()
-                elif next_token == self.brackets[1]:
-                    # close last level on stack, merge into subtree
+                elif token == closer:
                     self.close_level()
-                elif next_token == "" or next_token == " ":
-                    pass  # do nothing
-                elif next_token == "'":
-                    self.curstring = next_token
-                    self.stringmode = "'"
-                elif next_token == '"':
-                    self.curstring = next_token
-                    self.stringmode = '"'
-                elif next_token == ",":
+                elif token == ",":
                     self.next_is_sibling = True
-                else:
-                    self.add_sibling(next_token)
+                elif token != "":
+                    self.add_sibling(token)
+            else:
+                self.feed(token)
+            # separator between tokens: only matters inside quoted strings
+            if self.curstring is not None:
+                self.feed(" ")
+            else:
+                self.next_is_sibling = False
+                self.prevescape = False
         if len(self.stack) != 1 or len(self.stack[-1]) != 1:
             return None
         else:
             return self.stack[-1][-1]
 
+    def _feed_string_token(self, next_token:str):
+        if next_token == "\\":
+            self.prevescape = 2
+        self.curstring += next_token
+        if self.curstring[-1] == self.stringmode and self.prevescape == 0:  # closing string
+            self.stack[-1].append(self.curstring)
+            self.curstring = None
+            self.stringmode = None
+        self.prevescape = max(self.prevescape - 1, 0)
+
 
 class PrologToPas(TreeStrParser):
 
@@ -109,7 +169,7 @@ class PrologToTree(TreeStrParser):
         self.stack[-1][-1].extend(siblings)
 
     def add_sibling(self, next_token):
-        self.stack[-1].append(Tree(next_token, []))
+        self.stack[-1].append(self.tree_class(next_token, []))
 
 
 class LispToPas(TreeStrParser):
@@ -136,10 +196,62 @@ class LispToTree(TreeStrParser):
             self.stack[-1].append(siblings[0])
 
     def add_sibling(self, next_token):
-        self.stack[-1].append(Tree(next_token, []))
+        self.stack[-1].append(self.tree_class(next_token, []))
 
 
-def _inc_convert_treestr(x, cls, self=-1, brackets="()"):
+def batch_tensor2tree(x, vocab, parser=None):
+    """
+    Converts a batch of predicted or gold token id sequences to trees.
+    Padding is dropped, sequences are cut off before the first end token and
+    missing or excess closing brackets are added or removed at the end (like the tensor2tree() in the scripts).
+    :param x:       (batsize, seqlen) int tensor or array of token ids
+    :param vocab:   Vocab mapping ids to the tokens of a bracketed tree string
+    :param parser:  TreeStrParser class or factory used to parse the tokens of one sequence (default: LispToTree)
+    :return:        list of trees (None where a sequence could not be parsed)
+    """
+    parser = LispToTree if parser is None else parser
+    if hasattr(x, "detach"):
+        x = x.detach().cpu().numpy()      # one transfer for the whole batch
+    x = np.asarray(x)
+    if x.ndim == 1:
+        x = x[None]
+    if x.shape[1] == 0:
+        return [None for _ in range(x.shape[0])]
+    # one id -> token mapping over the distinct ids in the batch
+    uniq, inverse = np.unique(x, return_inverse=True)
+    uniq_tokens = vocab.tokens(uniq)
+    tokens = uniq_tokens[inverse].reshape(x.shape)
+    # cut at first end token and drop padding
+    isend = x == vocab[vocab.endtoken]
+    ends = np.where(isend.any(1), isend.argmax(1), x.shape[1])
+    keep = (x != vocab[vocab.padtoken]) & (np.arange(x.shape[1])[None, :] < ends[:, None])
+    # bracket balance of every sequence
+    opens = np.asarray([isinstance(token, str) and (token == "(" or token[-1:] == "(") for token in uniq_tokens.tolist()], dtype=bool)
+    closes = np.asarray([token == ")" for token in uniq_tokens.tolist()], dtype=bool)
+    opens, closes = opens[inverse].reshape(x.shape), closes[inverse].reshape(x.shape)
+    balances = ((opens & keep).sum(1) - (closes & keep).sum(1)).tolist()
+
+    rets = []
+    for i in range(tokens.shape[0]):
+        tokens_i = tokens[i][keep[i]].tolist()
+        balance = balances[i]
+        if balance > 0:
+            tokens_i = tokens_i + [")"] * balance
+        j = len(tokens_i) - 1
+        while balance < 0 and j > 0:
+            if tokens_i[j] == ")":
+                tokens_i.pop(j)
+                balance += 1
+            j -= 1
+        try:
+            tree = parser().feed_tokens(tokens_i)
+        except Exception as e:
+            tree = None
+        rets.append(tree)
+    return rets
+
+
+def _inc_convert_treestr(x, cls, self=-1, brackets="()", **kw):
     """
     :param x: lisp-style string
     strings must be surrounded by single quotes (') and may not contain anything but single quotes
@@ -149,7 +261,7 @@ def _inc_convert_treestr(x, cls, self=-1, brackets="()"):
         ret = self.feed(x)
         return ret, self
     else:
-        _self = cls(x, brackets=brackets) if not isinstance(self, cls) else self
+        _self = cls(x, brackets=brackets, **kw) if not isinstance(self, cls) else self
         ret = _self.feed("")
         if ret is None:
             return None, _self
@@ -168,12 +280,12 @@ def prolog_to_pas(x:str, self:PrologToPas=-1, brackets="()"):
     return _inc_convert_treestr(x, PrologToPas, self=self, brackets=brackets)
 
 
-def lisp_to_tree(x:str, self:LispToTree=-1, brackets="()"):
-    return _inc_convert_treestr(x, LispToTree, self=self, brackets=brackets)
+def lisp_to_tree(x:str, self:LispToTree=-1, brackets="()", tree_class=Tree):
+    return _inc_convert_treestr(x, LispToTree, self=self, brackets=brackets, tree_class=tree_class)
 
 
-def prolog_to_tree(x: str, self:PrologToTree = -1, brackets="()"):
-    return _inc_convert_treestr(x, PrologToTree, self=self, brackets=brackets)
+def prolog_to_tree(x: str, self:PrologToTree = -1, brackets="()", tree_class=Tree):
+    return _inc_convert_treestr(x, PrologToTree, self=self, brackets=brackets, tree_class=tree_class)
 
 
 def pas_to_lisp(x, brackets="()"):
@@ -241,6 +353,73 @@ def try_lisp_to_tree():
     print(ct)
 
 
+def try_parse_speed(p="../datasets/overnightData/"):
+    """ Parse throughput over all overnight examples files (lines fed incrementally, as in OvernightDatasetLoader). """
+    import glob, os, time
+    lines = []
+    for fp in sorted(glob.glob(os.path.join(os.path.dirname(__file__), p, "*.examples"))):
+        with open(fp) as f:
+            lines += f.readlines()
+    numchars = sum([len(line) for line in lines])
+    t0 = time.time()
+    c, ltp = 0, None
+    for line in lines:
+        z, ltp = lisp_to_pas(line, ltp)
+        if z is not None:
+            c += 1
+            ltp = None
+    t = time.time() - t0
+    print(f"lisp_to_pas: {c} examples ({numchars} chars) in {t:.2f}s: {c/t:.0f} examples/s, {numchars/t/1e6:.2f}M chars/s")
+
+    for n in [1000, 10000, 100000]:
+        x = "(and " + " ".join(["(f x (g y))"] * n) + ")"
+        t0 = time.time()
+        lisp_to_tree(x)
+        print(f"{n} subtrees ({len(x)} chars): {time.time() - t0:.3f}s")
+
+
+def try_compact_tree(p="../datasets/overnightData/"):
+    """ Memory and speed of CompactTree vs nltk Tree on all overnight logical forms. """
+    import glob, os, time, tracemalloc
+    from parseq.vocab import Vocab
+    lines = []
+    for fp in sorted(glob.glob(os.path.join(os.path.dirname(__file__), p, "*.examples"))):
+        with open(fp) as f:
+            lines += f.readlines()
+    pases, ltp = [], None
+    for line in lines:
+        z, ltp = lisp_to_pas(line, ltp)
+        if z is not None:
+            pases.append(z[1][2][1][0])     # (example (utterance ..) (original ..) (targetFormula <lf>))
+            ltp = None
+    pases = [pas for pas in pases if "((" not in pas_to_lisp(pas)]       # no ((lambda ..) ..) heads
+    tracemalloc.start()
+    m0 = tracemalloc.get_traced_memory()[0]
+    trees = [pas_to_tree(pas) for pas in pases]
+    m1 = tracemalloc.get_traced_memory()[0]
+    vocab = Vocab()
+    for tree in trees:
+        for label in tree_to_lisp_tokens(tree):
+            vocab.add_token(label)
+    vocab.finalize()
+    m2 = tracemalloc.get_traced_memory()[0]
+    ctrees = [CompactTree.from_tree(tree, vocab=vocab) for tree in trees]
+    m3 = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{len(trees)} trees: nltk {(m1 - m0) / 1e6:.1f}MB, compact {(m3 - m2) / 1e6:.1f}MB")
+
+    for name, f, cf in [("size", tree_size, CompactTree.size),
+                        ("depth", lambda x: x.height(), CompactTree.depth),
+                        ("lisp", tree_to_lisp, CompactTree.to_lisp),
+                        ("canonical", canonicalize_tree, canonicalize_tree)]:
+        t0 = time.time()
+        a = [f(tree) for tree in trees]
+        t1 = time.time()
+        b = [cf(ctree) for ctree in ctrees]
+        t2 = time.time()
+        assert(a == b)
+        print(f"{name}: nltk {(t1 - t0) * 1e3:.0f}ms, compact {(t2 - t1) * 1e3:.0f}ms")
+
 
 def pas_to_tree(x):
     if isinstance(x, tuple):    # has children
@@ -254,6 +433,8 @@ def pas_to_tree(x):
 
 
 def tree_to_lisp(x:Tree, brackets="()"):
+    if isinstance(x, CompactTree):
+        return x.to_lisp(brackets=brackets)
     if len(x) > 0:
         children = [tree_to_lisp(xe, brackets=brackets) for xe in x]
         return f"{brackets[0]}{x.label()} {' '.join(children)}{brackets[1]}"
@@ -262,6 +443,8 @@ def tree_to_lisp(x:Tree, brackets="()"):
 
 
 def tree_to_lisp_tokens(x:Tree, brackets="()"):
+    if isinstance(x, CompactTree):
+        return x.to_lisp_tokens(brackets=brackets)
     if len(x) > 0:
         children = [tree_to_lisp_tokens(xe, brackets=brackets) for xe in x]
         return [brackets[0], x.label()] + [childe for child in children for childe in child] + [brackets[1]]
@@ -278,6 +461,8 @@ def tree_to_prolog(x:Tree, brackets="()"):
 
 
 def tree_size(x:Tree):
+    if isinstance(x, CompactTree):
+        return x.size()
     ret = sum([tree_size(xe) for xe in x])
     ret += 1
     return ret
@@ -325,43 +510,9 @@ class ActionTree(ParentedTree):
 
     def eq(self, other):
         assert(isinstance(other, ActionTree))
-        if self._label != other._label:
-            return False
-        if self._label in self.orderless:
-            # check if every child is in other and other contains no more
-            if len(self) != len(other):
-                return False
-            selfchildren = [selfchild for selfchild in self]
-            otherchildren = [otherchild for otherchild in other]
-            if not selfchildren[-1].eq(otherchildren[-1]):
-                return False    # terminator must be same and in the end
-            else:
-                selfchildren = selfchildren[:-1]
-                otherchildren = otherchildren[:-1]
-            i = 0
-            while i < len(selfchildren):
-                selfchild = selfchildren[i]
-                j = 0
-                unbroken = True
-                while j < len(otherchildren):
-                    otherchild = otherchildren[j]
-                    if selfchild.eq(otherchild):
-                        selfchildren.pop(i)
-                        otherchildren.pop(j)
-                        i -= 1
-                        j -= 1
-                        unbroken = False
-                        break
-                    j += 1
-                if unbroken:
-                    return False
-                i += 1
-            if len(selfchildren) == 0 and len(otherchildren) == 0:
-                return True
-            else:
-                return False
-        else:
-            return all([selfchild.eq(otherchild) for selfchild, otherchild in zip(self, other)])
+        # children of orderless nodes may be permuted, except for the last one (terminator)
+        return canonicalize_tree(self, orderless=self.orderless, unktoken=None, use_terminator=True) \
+               == canonicalize_tree(other, orderless=self.orderless, unktoken=None, use_terminator=True)
 
     @classmethod
     def convert(cls, tree):
@@ -383,51 +534,353 @@ class ActionTree(ParentedTree):
             return tree
 
 
+class CanonicalTree(object):
+    """
+    Canonical form of a tree, as returned by canonicalize_tree().
+    Hashes in O(1) (hash is computed bottom-up once) so it can be used as dict key to memoize per-tree results.
+    == compares the hashes and verifies a hash match by comparing the canonical forms.
+    Canonical forms of trees containing the unk token compare unequal to everything, including themselves.
+    """
+    __slots__ = ("form", "hash")
+
+    def __init__(self, form, hash:int):
+        self.form = form
+        self.hash = hash
+
+    def __eq__(self, other):
+        if not isinstance(other, CanonicalTree) or self.form is None or other.form is None:
+            return False
+        return self.hash == other.hash and self.form == other.form
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return self.hash
+
+    def __repr__(self):
+        return f"CanonicalTree({self.form})"
+
+
+def _canonicalize_tree_rec(x, orderless, unktoken, use_terminator):
+    if not isinstance(x, Tree):     # string leaf
+        form = (x,)
+        return hash(form), form
+    if x._label == unktoken:
+        return None
+    children = []
+    for xe in x:
+        child = _canonicalize_tree_rec(xe, orderless, unktoken, use_terminator)
+        if child is None:
+            return None
+        children.append(child)
+    return _canonical_node(x._label, children, orderless == "__ALL__" or x._label in orderless, use_terminator)
+
+
+def _canonical_node(label, children, isorderless, use_terminator):
+    # combines the (hash, form) pairs of the children into the (hash, form) pair of the node
+    if isorderless:
+        # (hash, form) pairs: sorted by hash, forms only compared on hash ties
+        if use_terminator and len(children) > 0:
+            children = sorted(children[:-1]) + children[-1:]
+        else:
+            children = sorted(children)
+    return hash((label,) + tuple([child[0] for child in children])), \
+           (label, tuple([child[1] for child in children]))
+
+
+def canonicalize_tree(x:Tree, orderless={"and", "or"}, unktoken="@UNK@", use_terminator=False):
+    """
+    Computes a canonical form of the given tree in one bottom-up pass, sorting the children of orderless nodes.
+    Two trees are equal up to reordering of children under orderless nodes iff their canonical forms are equal.
+    :param orderless:       set of labels whose children are unordered, or "__ALL__"
+    :param unktoken:        trees containing a node with this label are not equal to any tree
+    :param use_terminator:  if True, the last child of an orderless node stays in place
+    :return:                CanonicalTree
+    """
+    if x is None:
+        return CanonicalTree(None, 0)
+    if isinstance(x, CompactTree):
+        return x.canonicalize(orderless=orderless, unktoken=unktoken, use_terminator=use_terminator)
+    ret = _canonicalize_tree_rec(x, orderless, unktoken, use_terminator)
+    if ret is None:
+        return CanonicalTree(None, 0)
+    return CanonicalTree(ret[1], ret[0])
+
+
 def are_equal_trees(self, other, orderless={"and", "or"}, unktoken="@UNK@", use_terminator=False):
     if self is None or other is None:
         return False
     assert(isinstance(other, Tree) and isinstance(self, Tree))
     if self._label != other._label or self._label == unktoken or other._label == unktoken:
         return False
-    if self._label in orderless or orderless == "__ALL__":
-        # check if every child is in other and other contains no more
-        if len(self) != len(other):
-            return False
-        selfchildren = [selfchild for selfchild in self]
-        otherchildren = [otherchild for otherchild in other]
-        if use_terminator:
-            if not are_equal_trees(selfchildren[-1], otherchildren[-1], orderless=orderless, use_terminator=use_terminator):
-                return False    # terminator must be same and in the end
-            else:
-                selfchildren = selfchildren[:-1]
-                otherchildren = otherchildren[:-1]
-        i = 0
-        while i < len(selfchildren):
-            selfchild = selfchildren[i]
-            j = 0
-            unbroken = True
-            while j < len(otherchildren):
-                otherchild = otherchildren[j]
-                if are_equal_trees(selfchild, otherchild, orderless=orderless, use_terminator=use_terminator):
-                    selfchildren.pop(i)
-                    otherchildren.pop(j)
-                    i -= 1
-                    j -= 1
-                    unbroken = False
-                    break
-                j += 1
-            if unbroken:
-                return False
-            i += 1
-        if len(selfchildren) == 0 and len(otherchildren) == 0:
-            return True
+    return canonicalize_tree(self, orderless=orderless, unktoken=unktoken, use_terminator=use_terminator) \
+           == canonicalize_tree(other, orderless=orderless, unktoken=unktoken, use_terminator=use_terminator)
+
+
+def _is_orderless(x, orderless):
+    return isinstance(x, Tree) and (orderless == "__ALL__" or x._label in orderless)
+
+
+def sample_tree_permutation(x:Tree, orderless={"and", "or"}, rng=None):
+    """
+    Samples a uniformly random permutation of the given tree in time linear in the tree size,
+    by shuffling the children of every orderless node independently.
+    Equivalent to random.choice(list(iter_tree_permutations(x, orderless))) without enumerating anything.
+    :param orderless:   set of labels whose children are unordered, or "__ALL__"
+    :param rng:         random.Random or np.random.RandomState to use (default: module-level random)
+    :return:            a new Tree (leaves are shared with the input)
+    """
+    if not isinstance(x, Tree):
+        return x
+    children = [sample_tree_permutation(xe, orderless=orderless, rng=rng) for xe in x]
+    if _is_orderless(x, orderless) and len(children) > 1:
+        if rng is None:
+            random.shuffle(children)
+        elif isinstance(rng, np.random.RandomState):
+            children = [children[i] for i in rng.permutation(len(children))]
         else:
-            return False
+            rng.shuffle(children)
+    return Tree(x._label, children)
+
+
+def _lazy_product(factories, i=0, prefix=()):
+    # like itertools.product but over re-creatable iterators and without materializing them
+    if i == len(factories):
+        yield prefix
+        return
+    for e in factories[i]():
+        yield from _lazy_product(factories, i + 1, prefix + (e,))
+
+
+def iter_tree_permutations(x:Tree, orderless={"and", "or"}):
+    """
+    Lazily enumerates all permutations of the given tree, in the same order as the exhaustive enumeration
+    (permutations of children of orderless nodes, times the product of the permutations of every child).
+    Only the permutations that are consumed are built, so taking the first few is cheap even for huge trees.
+    """
+    if not isinstance(x, Tree):
+        yield x
+        return
+    if _is_orderless(x, orderless):
+        orders = permutations(list(x))
     else:
-        if len(self) != len(other):
-            return False
-        return all([are_equal_trees(selfchild, otherchild, orderless=orderless, use_terminator=use_terminator)
-                    for selfchild, otherchild in zip(self, other)])
+        orders = [list(x)]
+    for order in orders:
+        factories = [partial(iter_tree_permutations, xe, orderless) for xe in order]
+        for children in _lazy_product(factories):
+            yield Tree(x._label, list(children))
+
+
+def _count_tree_permutations_rec(x, orderless, distinct):
+    # returns (number of permutations, canonical (hash, form) of x or None if not distinct)
+    if not isinstance(x, Tree):
+        return 1, ((hash((x,)), (x,)) if distinct else None)
+    counts, forms = [], []
+    for xe in x:
+        count, form = _count_tree_permutations_rec(xe, orderless, distinct)
+        counts.append(count)
+        forms.append(form)
+    isorderless = _is_orderless(x, orderless)
+    ret = 1
+    if not distinct:
+        for count in counts:
+            ret *= count
+        if isorderless:
+            ret *= math.factorial(len(counts))
+        return ret, None
+    if isorderless:
+        # children that are equal up to reordering are interchangeable:
+        # n! / prod(m_g!) ways to place the groups, times d_g^m_g choices of variants within each group
+        ret = math.factorial(len(counts))
+        groups = {}
+        for count, form in zip(counts, forms):
+            groups.setdefault(form, []).append(count)
+        for form, groupcounts in groups.items():
+            ret //= math.factorial(len(groupcounts))
+            ret *= groupcounts[0] ** len(groupcounts)
+        forms = sorted(forms)
+    else:
+        for count in counts:
+            ret *= count
+    return ret, (hash((x._label,) + tuple([form[0] for form in forms])),
+                 (x._label, tuple([form[1] for form in forms])))
+
+
+def count_tree_permutations(x:Tree, orderless={"and", "or"}, distinct=False):
+    """
+    Counts the permutations of the given tree without enumerating them.
+    :param distinct:    if False, counts what iter_tree_permutations() yields (n! per orderless node with n children,
+                        multiplied over nodes); if True, counts only distinct trees (identical siblings are not
+                        told apart).
+    :return:            (python) int
+    """
+    return _count_tree_permutations_rec(x, orderless, distinct)[0]
+
+
+class CompactTree(object):
+    """
+    Array-backed tree: the nodes are stored in preorder, as
+        - ids:          label ids (int64)
+        - parents:      position of the parent of every node (int32, -1 for the root)
+        - numchildren:  number of children of every node (int32)
+    Uses a fraction of the memory of an nltk Tree and supports size, depth, lisp serialization and canonical hashing
+    without recursion.
+    Labels are mapped to ids by the given vocab (a parseq Vocab, shared between trees)
+    or, if no vocab is given, by a label list local to the tree.
+    String leaves (e.g. quoted strings in a Tree parsed by lisp_to_tree) are kept apart from childless Tree nodes.
+    """
+    __slots__ = ("ids", "parents", "numchildren", "vocab", "strleaves")
+
+    def __init__(self, ids, parents, numchildren, vocab, strleaves=None):
+        self.ids = ids
+        self.parents = parents
+        self.numchildren = numchildren
+        self.vocab = vocab
+        self.strleaves = strleaves      # positions of string leaves (None if there are none)
+
+    @classmethod
+    def from_tree(cls, x:Tree, vocab=None):
+        """
+        :param x:       nltk Tree (or subclass)
+        :param vocab:   parseq Vocab to map labels to ids (labels not in the vocab map to its unk id)
+        """
+        labels, parents, numchildren, strleaves = [], [], [], []
+        stack = [(x, -1)]
+        while len(stack) > 0:
+            node, parent = stack.pop()
+            parents.append(parent)
+            if isinstance(node, Tree):
+                i = len(labels)
+                labels.append(node._label)
+                numchildren.append(len(node))
+                stack.extend([(child, i) for child in reversed(node)])
+            else:
+                strleaves.append(len(labels))
+                labels.append(node)
+                numchildren.append(0)
+        if vocab is None:
+            D = {}
+            ids = np.fromiter((D.setdefault(label, len(D)) for label in labels), dtype="int64", count=len(labels))
+            vocab = list(D.keys())
+        else:
+            ids = vocab.ids(labels)
+        return cls(ids, np.asarray(parents, dtype="int32"), np.asarray(numchildren, dtype="int32"), vocab,
+                   np.asarray(strleaves, dtype="int32") if len(strleaves) > 0 else None)
+
+    @classmethod
+    def from_lisp(cls, x:str, vocab=None, brackets="()"):
+        return cls.from_tree(lisp_to_tree(x, brackets=brackets), vocab=vocab)
+
+    def labels(self) -> List[str]:
+        """ Labels of all nodes, in preorder. """
+        if isinstance(self.vocab, list):
+            vocab = self.vocab
+            return [vocab[i] for i in self.ids.tolist()]
+        else:
+            return self.vocab.tokens(self.ids).tolist()
+
+    def label(self):
+        """ Label of the root. """
+        return self.vocab[int(self.ids[0])] if isinstance(self.vocab, list) else self.vocab(int(self.ids[0]))
+
+    def size(self):
+        return len(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def depth(self):
+        """ Number of nodes on the longest path from the root to a leaf (same as Tree.height()). """
+        parents = self.parents.tolist()
+        depths = [1] * len(parents)
+        for i in range(1, len(parents)):        # parents come before their children
+            depths[i] = depths[parents[i]] + 1
+        return max(depths)
+
+    def children(self, i:int=0) -> List[int]:
+        """ Positions of the children of node i. """
+        return np.nonzero(self.parents == i)[0].tolist()
+
+    def nbytes(self):
+        return self.ids.nbytes + self.parents.nbytes + self.numchildren.nbytes \
+               + (self.strleaves.nbytes if self.strleaves is not None else 0)
+
+    def to_tree(self, tree_class=Tree):
+        labels, isstr = self.labels(), self._isstr()
+        nodes = [label if s else tree_class(label, []) for label, s in zip(labels, isstr)]
+        for node, parent in zip(nodes[1:], self.parents.tolist()[1:]):     # preorder: children are appended in order
+            nodes[parent].append(node)
+        return nodes[0]
+
+    def _isstr(self):
+        ret = [False] * len(self.ids)
+        if self.strleaves is not None:
+            for i in self.strleaves.tolist():
+                ret[i] = True
+        return ret
+
+    def _walk(self, onopen, onleaf, onclose):
+        # calls onopen/onleaf for every node in preorder and onclose when all children of a node have been visited
+        remaining = []
+        for label, n in zip(self.labels(), self.numchildren.tolist()):
+            if n > 0:
+                onopen(label)
+                remaining.append(n)
+                continue
+            onleaf(label)
+            while len(remaining) > 0:
+                remaining[-1] -= 1
+                if remaining[-1] > 0:
+                    break
+                remaining.pop(-1)
+                onclose()
+
+    def to_lisp_tokens(self, brackets="()"):
+        """ Same as tree_to_lisp_tokens() on the corresponding Tree. """
+        ret = []
+        self._walk(lambda label: ret.extend((brackets[0], label)), ret.append, lambda: ret.append(brackets[1]))
+        return ret
+
+    def to_lisp(self, brackets="()"):
+        """ Same as tree_to_lisp() on the corresponding Tree. """
+        pieces = []
+        def close():
+            pieces[-1] += brackets[1]
+        self._walk(lambda label: pieces.append(brackets[0] + label), pieces.append, close)
+        return " ".join(pieces)
+
+    def canonicalize(self, orderless={"and", "or"}, unktoken="@UNK@", use_terminator=False):
+        """ Same as canonicalize_tree() on the corresponding Tree, computed in one backward pass over the arrays. """
+        labels, isstr, parents = self.labels(), self._isstr(), self.parents.tolist()
+        allorderless = orderless == "__ALL__"
+        kids = [None] * len(labels)     # (hash, form) pairs of the children, in reverse order
+        ret = None
+        for i in range(len(labels) - 1, -1, -1):     # children come after their parents
+            label = labels[i]
+            if isstr[i]:
+                form = (label,)
+                ret = (hash(form), form)
+            elif label == unktoken:
+                return CanonicalTree(None, 0)
+            elif kids[i] is None:
+                form = (label, ())
+                ret = (hash((label,)), form)
+            else:
+                ret = _canonical_node(label, kids[i][::-1], allorderless or label in orderless, use_terminator)
+            parent = parents[i]
+            if parent >= 0:
+                if kids[parent] is None:
+                    kids[parent] = [ret]
+                else:
+                    kids[parent].append(ret)
+        return CanonicalTree(ret[1], ret[0])
+
+    def __str__(self):
+        return self.to_lisp()
+
+    def __repr__(self):
+        return f"CompactTree({self.to_lisp()})"
 
 
 def action_seq_from_tree():
@@ -437,6 +890,7 @@ def action_seq_from_tree():
 
 class FuncGrammar(object):
     typere = re.compile("<([^>]+)>([\*\+]?)")
+    TERMINAL, FUNC, SIBL = 0, 1, 2      # rule kinds
     def __init__(self, start_type:str, **kw):
         super(FuncGrammar, self).__init__(**kw)
         self.rules_by_type = {}
@@ -447,6 +901,29 @@ class FuncGrammar(object):
         self.start_type = start_type
         self.start_types = set([start_type])
 
+        # rules compiled at add_rule() into integer-indexed tables
+        self.rules = []                 # rule id -> rule string
+        self.rule_ids = {}              # rule string -> rule id
+        self.symbol_ids = {}            # type or arg symbol -> symbol id
+        self.symbol_names = []          # symbol id -> type or arg symbol
+        self.rule_type = []             # rule id -> symbol id of output type
+        self.rule_head = []             # rule id -> symbol id of arg (head symbol)
+        self.rule_argtypes = []         # rule id -> tuple of symbol ids of argument types (() if not a function)
+        self.rule_kind = []             # rule id -> TERMINAL, FUNC or SIBL
+        self._rules_by_head = {}        # head symbol id -> list of rule ids
+        self._terminal_rules_by_head = {}   # head symbol id -> list of terminal rule ids
+        self._func_rules_by_sig = {}    # (head symbol id, argument type ids) -> list of function rule ids
+        self._sibl_heads = set()        # head symbol ids that have sibling rules
+        self._star_base = {}            # symbol id of "<T>*" or "<T>+" -> symbol id of "<T>"
+
+    def symbol_id(self, symbol:str):
+        if symbol not in self.symbol_ids:
+            self.symbol_ids[symbol] = len(self.symbol_names)
+            self.symbol_names.append(symbol)
+            if symbol[-1] in "*+":
+                self._star_base[self.symbol_ids[symbol]] = self.symbol_id(symbol[:-1])
+        return self.symbol_ids[symbol]
+
     def add_rule(self, rule:str):
         if rule in self.all_rules:
             return
@@ -460,15 +937,18 @@ class FuncGrammar(object):
             # function rule --> add children
             arg_name = func_splits[0]
             argchildren = func_splits[1].split(" ")
+            kind = self.FUNC
         elif len(sibl_splits) > 1:
             # sibling rule --> add siblings
             arg_name = sibl_splits[0]
             argchildren = sibl_splits[1].split(" ")
             assert(len(argchildren) == 1)
+            kind = self.SIBL
         else:
             assert(len(body.split(" ")) == 1)
             arg_name = body
             argchildren = []
+            kind = self.TERMINAL
 
         if t not in self.rules_by_type:
             self.rules_by_type[t] = set()
@@ -484,7 +964,35 @@ class FuncGrammar(object):
             if not self.typere.match(argchild):
                 self.symbols.add(argchild)
 
-    def actions_for(self, x:str, format="lisp"):
+        # compile
+        rule_id = len(self.rules)
+        head = self.symbol_id(arg_name)
+        argtypes = tuple([self.symbol_id(argchild) for argchild in argchildren]) if kind == self.FUNC else tuple()
+        self.rules.append(rule)
+        self.rule_ids[rule] = rule_id
+        self.rule_type.append(self.symbol_id(t))
+        self.rule_head.append(head)
+        self.rule_argtypes.append(argtypes)
+        self.rule_kind.append(kind)
+        self._rules_by_head.setdefault(head, []).append(rule_id)
+        if kind == self.TERMINAL:
+            self._terminal_rules_by_head.setdefault(head, []).append(rule_id)
+        elif kind == self.FUNC:
+            self._func_rules_by_sig.setdefault((head, argtypes), []).append(rule_id)
+        else:
+            self._sibl_heads.add(head)
+
+    def actions_for(self, x:Union[str, List[str]], format="lisp"):
+        """
+        :param x:   logical form string or list of them
+        :return:    list of rule strings (actions) deriving x, or list of such lists if x is a list
+        """
+        if isinstance(x, (list, tuple)):
+            memo = {}
+            for xe in x:
+                if xe not in memo:
+                    memo[xe] = self.actions_for(xe, format=format)
+            return [list(memo[xe]) for xe in x]
         if format == "lisp":
             pas = lisp_to_pas(x)
         elif format == "pred" or format == "prolog":
@@ -492,24 +1000,22 @@ class FuncGrammar(object):
         else:
             raise Exception(f"unknown format {format}")
         ret = self._actions_for_rec_bottom_up(pas)
-        return ret
+        return [self.rules[rule_id] for rule_id in ret]
 
     def _actions_for_rec_bottom_up(self, pas):
+        """ Returns rule ids. """
         if isinstance(pas, tuple):      # has children
             arg_name, children = pas
             children_rules, children_types = [], []
-            children_ruleses = [self._actions_for_rec_bottom_up(child) for child in children]
-            # get child types
-            for _child_rules in children_ruleses:
-                _child_rule = _child_rules[0]
-                child_type, child_body = _child_rule.split(" -> ")
-                children_types.append(child_type)
+            for child in children:
+                _child_rules = self._actions_for_rec_bottom_up(child)
+                children_types.append(self.rule_type[_child_rules[0]])
                 children_rules += _child_rules
 
             # merge siblings into single child type
-            if len(children_types) > 0 and children_types[-1][-1] in "*+":
+            if len(children_types) > 0 and children_types[-1] in self._star_base:
                 # variable number of children rules
-                exp_child_type = children_types[-1][:-1]
+                exp_child_type = self._star_base[children_types[-1]]
                 for child_type in children_types[:-1]:
                     assert(child_type == exp_child_type)
                 children_types = [children_types[-1]]
@@ -519,44 +1025,20 @@ class FuncGrammar(object):
             children_rules = []
 
         # find applicable rules
-        rules = self.rules_by_arg[arg_name]
-        valid_rules = set()
-        # has_sibl_rules = False
-        # has_func_rules = False
-        for rule in rules:
-            rule_type, rule_body = rule.split(" -> ")
-            func_splits = rule_body.split(" :: ")
-            sibl_splits = rule_body.split(" -- ")
-            is_func_rule = len(func_splits) > 1
-            is_sibl_rule = len(sibl_splits) > 1
-            if not is_sibl_rule and not is_func_rule:   # terminal
-                valid_rules.add(rule)
-            elif not is_sibl_rule:  # func nonterminal
-                rule_arg, rule_inptypes = func_splits[0], func_splits[1].split(" ")
-                addit = True
-                if len(children_types) != len(rule_inptypes):   # must have same number of children
-                    addit = False
-                    continue
-                # children must match types
-                for rule_inptype, child_type in zip(rule_inptypes, children_types):
-                    if rule_inptype != child_type:
-                        addit = False
-                        break
-                if not addit:
-                    continue
-                if addit:
-                    valid_rules.add(rule)
-            else:
-                raise Exception("sibling rule syntax no longer supported")
-                valid_rules.add(rule)
+        head = self.symbol_ids.get(arg_name, None)
+        if head not in self._rules_by_head:
+            raise KeyError(arg_name)
+        if head in self._sibl_heads:
+            raise Exception("sibling rule syntax no longer supported")
+        valid_rules = self._terminal_rules_by_head.get(head, []) \
+                      + self._func_rules_by_sig.get((head, tuple(children_types)), [])
 
         if len(valid_rules) == 0:
             raise Exception(f"can not parse, valid rules for arg '{arg_name}' not found")
         elif len(valid_rules) > 1:
             raise Exception(f"can not parse, multiple valid rules for arg '{arg_name}' found")
         else:
-            rule = list(valid_rules)[0]
-            return [rule] + children_rules
+            return [valid_rules[0]] + children_rules
 
     def _actions_for_rec_top_down(self, pas, out_type:str=None):
         out_types = self.start_types if out_type is None else set([out_type])
@@ -584,12 +1066,12 @@ class FuncGrammar(object):
                 new_children_types.append(child_arg_name)
                 new_children_rules.append(None)
                 continue
-            possible_child_rules = self.rules_by_arg[child_arg_name]
+            possible_child_rules = self._rules_by_head[self.symbol_ids[child_arg_name]]
             is_sibl = False
             child_type = None
             for pcr in possible_child_rules:
-                rule_type, body = pcr.split(" -> ")
-                if rule_type[-1] in "*+":
+                rule_type = self.symbol_names[self.rule_type[pcr]]
+                if self.rule_type[pcr] in self._star_base:
                     is_sibl = True
                     assert(len(possible_child_rules) == 1)  # can't have more than one rule if has sibl rule
                     # do sibl rule stuff
@@ -597,13 +1079,12 @@ class FuncGrammar(object):
                         prev_sibl_type = rule_type
                         new_children_rules.append([])
                     assert(rule_type == prev_sibl_type)
-                    new_children_rules[-1].append(pcr)
-                    if " -- " not in body:  # seq terminator
+                    new_children_rules[-1].append(self.rules[pcr])
+                    if self.rule_kind[pcr] != self.SIBL:  # seq terminator
                         prev_sibl_type = None   # done doing siblings
                         new_children.append(None)
                         new_children_types.append(rule_type)
                 else:
-                    rule_type, body = pcr.split(" -> ")
                     assert(child_type is None or child_type == rule_type)   # arg can have only one return type
                     child_type = rule_type
 
@@ -613,30 +1094,18 @@ class FuncGrammar(object):
                 new_children_types.append(child_type)
                 new_children_rules.append(None)
 
-
-        rules = self.rules_by_arg[arg_name]
-        valid_rules = set()
-
-        for rule in rules:
-            rule_type, rule_body = rule.split(" -> ")
-            assert(rule_type[-1] not in "+*")   # no sibling rules here
-            func_splits = rule_body.split(" :: ")
-            is_func_rule = len(func_splits) > 1
-            addit = True
-            if is_func_rule:
-                func_arg, func_inptypes = func_splits
-                func_inptypes = func_inptypes.split(" ")
-            else:
-                func_arg, func_inptypes = rule_body, []
+        valid_rules = []
+        for rule_id in self._rules_by_head[self.symbol_ids[arg_name]]:
+            assert(self.rule_type[rule_id] not in self._star_base)   # no sibling rules here
             # filter by output type
-            if rule_type not in out_types:
-                addit = False
+            if self.symbol_names[self.rule_type[rule_id]] not in out_types:
                 continue
+            func_inptypes = [self.symbol_names[argtype] for argtype in self.rule_argtypes[rule_id]]
             # filter by number of children
             if len(func_inptypes) != len(new_children_types):
-                addit = False
                 continue
             # filter by children signature
+            addit = True
             for new_child_type, func_inptype in zip(new_children_types, func_inptypes):
                 if new_child_type is None:
                     if func_inptype[-1] in "*+":
@@ -646,28 +1115,17 @@ class FuncGrammar(object):
                     if new_child_type != func_inptype:
                         addit = False
                         break
-            if not addit:
-                continue
             if addit:
-                valid_rules.add(rule)
+                valid_rules.append(rule_id)
 
         if len(valid_rules) == 0:
             raise Exception(f"can not parse, valid rules for arg '{arg_name}' not found")
         elif len(valid_rules) > 1:
             raise Exception(f"can not parse, multiple valid rules for arg '{arg_name}' found")
         else:
-            rule = list(valid_rules)[0]
-            ret.append(rule)
-            rule_type, rule_body = rule.split(" -> ")
-            assert(rule_type[-1] not in "+*")
-            func_splits = rule_body.split(" :: ")
-            is_func_rule = len(func_splits) > 1
-            addit = True
-            if is_func_rule:
-                func_arg, func_inptypes = func_splits
-                func_inptypes = func_inptypes.split(" ")
-            else:
-                func_inptypes = []
+            rule_id = valid_rules[0]
+            ret.append(self.rules[rule_id])
+            func_inptypes = [self.symbol_names[argtype] for argtype in self.rule_argtypes[rule_id]]
 
             assert (len(func_inptypes) == len(new_children_types))
             child_rules = []
@@ -677,8 +1135,7 @@ class FuncGrammar(object):
                     child_rules += r
                 else:
                     child_rules += new_child_rules
-            # child_rules = [x for x in child_rules if x is not None]
-            ret = ret + child_rules  #[rule for child_rule in child_rules for rule in child_rule]
+            ret = ret + child_rules
             return ret
 
 
@@ -795,64 +1252,75 @@ class FuncGrammar(object):
                 return ret, body
 
     def actions_to_tree(self, remaining_actions:List[str]):
-        tree, remaining_actions = self._actions_to_tree_rec(remaining_actions)
-        assert(len(remaining_actions) == 0)
+        tree, i = self._actions_to_tree_rec(remaining_actions, 0)
+        assert(i == len(remaining_actions))
         return tree
 
-    def _actions_to_tree_rec(self, actions:List[str], out_type:str=None):
+    def _actions_to_tree_rec(self, actions:List[str], i:int, out_type:str=None):
+        """ Builds the subtree of type out_type from actions[i:], returns the subtree and the position of the next action. """
         out_type = self.start_type if out_type is None else out_type
         ret = ActionTree(out_type, [])
-        remaining_actions = actions
         if out_type not in self.rules_by_type:
             assert(out_type in self.symbols)
-            return ret, remaining_actions
-        while len(remaining_actions) > 0:
-            action = remaining_actions[0]
+            return ret, i
+        if i < len(actions):
+            action = actions[i]
+            rule_id = self.rule_ids[action]
             ret.set_action(action)
-            rule_type, rule_body = action.split(" -> ")
-
-            rule_func_splits = rule_body.split(" :: ")
-            rule_sibl_splits = rule_body.split(" -- ")
-            assert (int(len(rule_func_splits) > 1) + int(len(rule_sibl_splits) > 1) <= 1)
-
-            if len(rule_func_splits) > 1:
-                rule_arg, rule_inptypes = rule_func_splits
-                rule_inptypes = rule_inptypes.split(" ")
-                ret.set_label(rule_arg)
-                remaining_actions = remaining_actions[1:]
+            ret.set_label(self.symbol_names[self.rule_head[rule_id]])
+            i += 1
+            kind = self.rule_kind[rule_id]
+            if kind == self.FUNC:
+                rule_inptypes = [self.symbol_names[argtype] for argtype in self.rule_argtypes[rule_id]]
                 if len(rule_inptypes) == 1 and rule_inptypes[-1][-1] in "*+":
                     rule_inptype = rule_inptypes[-1][:-1]
                     terminated = False
                     while not terminated:
-                        subtree, remaining_actions = self._actions_to_tree_rec(remaining_actions, out_type=rule_inptype)
+                        subtree, i = self._actions_to_tree_rec(actions, i, out_type=rule_inptype)
                         ret.append(subtree)
                         if subtree.label() == f"{rule_inptypes[-1]}:END@":
                             terminated = True
                 else:
                     for rule_inptype in rule_inptypes:
-                        subtree, remaining_actions = self._actions_to_tree_rec(remaining_actions, out_type=rule_inptype)
-                        if isinstance(subtree, Tree):
-                            subtree = [subtree]
-                        for subtree_e in subtree:
-                            ret.append(subtree_e)
-                return ret, remaining_actions
-            elif len(rule_sibl_splits) > 1:
+                        subtree, i = self._actions_to_tree_rec(actions, i, out_type=rule_inptype)
+                        ret.append(subtree)
+            elif kind == self.SIBL:
                 raise Exception("sibling rules no longer supported")
-                rule_arg, rule_sibl_types = rule_sibl_splits
-                rule_sibl_types = rule_sibl_types.split(" ")
-                assert(len(rule_sibl_types) == 1)
-                ret.set_label(rule_arg)
-                remaining_actions = remaining_actions[1:]
-                siblings, remaining_actions = self._actions_to_tree_rec(remaining_actions, out_type=rule_sibl_types[-1])
-                if isinstance(siblings, Tree):
-                    siblings = [siblings]
-                ret = [ret] + siblings
-                return ret, remaining_actions
-            else:
-                assert(len(rule_body.split(" ")) == 1)
-                ret.set_label(rule_body)
-                remaining_actions = remaining_actions[1:]
-                return ret, remaining_actions
+        return ret, i
+
+
+def try_func_grammar_speed(p="../datasets/geoquery/queries.funql", reps=20):
+    """ Derivation timings on Geo880 FunQL with a grammar induced from the queries (one type per node, rules by arity). """
+    import os, time
+    with open(os.path.join(os.path.dirname(__file__), p)) as f:
+        # multi-word constants are single symbols in the grammar
+        queries = [re.sub("'[^']*'", lambda m: m.group(0).replace(" ", "_"), line.strip()) for line in f]
+    g = FuncGrammar("<R>")
+    def induce_rec(pas):
+        if isinstance(pas, tuple):
+            g.add_rule(f"<R> -> {pas[0]} :: " + " ".join(["<R>"] * len(pas[1])))
+            for child in pas[1]:
+                induce_rec(child)
+        else:
+            g.add_rule(f"<R> -> {pas}")
+    t0 = time.time()
+    for query in queries:
+        induce_rec(prolog_to_pas(query))
+    print(f"{len(g.rules)} rules from {len(queries)} queries in {time.time() - t0:.3f}s")
+
+    t0 = time.time()
+    for _ in range(reps):
+        actionses = g.actions_for(queries, format="prolog")
+    print(f"actions_for (batched, incl. parsing): {(time.time() - t0) / reps * 1e3:.2f}ms")
+    pases = [prolog_to_pas(query) for query in queries]
+    t0 = time.time()
+    for _ in range(reps):
+        [g._actions_for_rec_bottom_up(pas) for pas in pases]
+    print(f"bottom-up derivation only: {(time.time() - t0) / reps * 1e3:.2f}ms")
+    t0 = time.time()
+    for _ in range(reps):
+        [g.actions_to_tree(actions) for actions in actionses]
+    print(f"actions_to_tree: {(time.time() - t0) / reps * 1e3:.2f}ms")
 
 
 if __name__ == '__main__':
@@ -268,31 +268,31 @@ def load_ds(traindomains=("restaurants",),
         "agg:arg:sum", "agg:arg:avg"}
         # "-1", "0", "1", "2", "3", "5", "10", "15", "30", "40", "300", "2000", "1000", "1500", "800", "2015", "2004"}
 
-    domains = {}
-    for domain in list(traindomains) + [testdomain]:
-        ds = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True,
-                                    restore_reverse=DATA_RESTORE_REVERSE, validfrac=.10)\
-            .load(domain=domain)
+    # nl_split = lambda x: x.split()      # TODO replace this with spacy tokenizer
+
+    def nl_split(x: str) -> List[str]:
+        doc = nlp(x)
+        # posseq = [tok.tag_ for tok in doc]
+        return [tok.text.lower() for tok in doc]
+
+    def prepare_domain(domain, ds):
         domainexamples = [(a, b, c) for a, b, c in ds.examples]
         if supportsetting == "lex":
             domainexamples = [(a, b, "support" if c == "lexicon" else c)
                               for a, b, c in domainexamples]
         else:
             domainexamples = [(a, b, c) for a, b, c in domainexamples if c != "lexicon"]
-        domains[domain] = domainexamples
+        return [(nl_split(a), tokenize_and_add_start(b, domain, general_tokens=general_tokens), c, a)
+                for a, b, c in domainexamples]
 
+    domains = {}
+    loaded = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True,
+                                    restore_reverse=DATA_RESTORE_REVERSE, validfrac=.10)\
+        .load_many(list(traindomains) + [testdomain], f=prepare_domain)
     alltrainex = []
-    # nl_split = lambda x: x.split()      # TODO replace this with spacy tokenizer
-
-    def nl_split(x: str) -> List[str]:
-        doc = nlp(x)
-        # posseq = [tok.tag_ for tok in doc]
-        return [tok.text.lower() for tok in doc]
-
-    for domain in domains:
-        domains[domain] = [(nl_split(a), tokenize_and_add_start(b, domain, general_tokens=general_tokens), c, a)
-                           for a, b, c in domains[domain]]
-        alltrainex += [(a, b, c, domain, d) for a, b, c, d in domains[domain]] # d is the actual text without tokenization
+    for domain, domainexamples in loaded.items():
+        domains[domain] = domainexamples
+        alltrainex += [(a, b, c, domain, d) for a, b, c, d in domainexamples] # d is the actual text without tokenization
 
     if True or supportsetting == "min" or supportsetting == "train":
         for domain, domainexamples in domains.items():
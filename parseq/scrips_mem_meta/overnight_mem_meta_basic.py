@@ -227,24 +227,24 @@ def load_ds(traindomains=("restaurants",),
         "agg:arg:sum", "agg:arg:avg"}
         # "-1", "0", "1", "2", "3", "5", "10", "15", "30", "40", "300", "2000", "1000", "1500", "800", "2015", "2004"}
 
-    domains = {}
-    for domain in list(traindomains) + [testdomain]:
-        ds = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True,
-                                    restore_reverse=DATA_RESTORE_REVERSE, validfrac=.10)\
-            .load(domain=domain)
+    def prepare_domain(domain, ds):
         domainexamples = [(a, b, c) for a, b, c in ds.examples]
         if supportsetting == "lex":
             domainexamples = [(a, b, "support" if c == "lexicon" else c)
                               for a, b, c in domainexamples]
         else:
             domainexamples = [(a, b, c) for a, b, c in domainexamples if c != "lexicon"]
-        domains[domain] = domainexamples
+        return [(a, tokenize_and_add_start(b, domain, general_tokens=general_tokens), c)
+                for a, b, c in domainexamples]
 
+    domains = {}
+    loaded = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True,
+                                    restore_reverse=DATA_RESTORE_REVERSE, validfrac=.10)\
+        .load_many(list(traindomains) + [testdomain], f=prepare_domain)
     alltrainex = []
-    for domain in domains:
-        domains[domain] = [(a, tokenize_and_add_start(b, domain, general_tokens=general_tokens), c)
-                           for a, b, c in domains[domain]]
-        alltrainex += [(a, b, c, domain) for a, b, c in domains[domain]]
+    for domain, domainexamples in loaded.items():
+        domains[domain] = domainexamples
+        alltrainex += [(a, b, c, domain) for a, b, c in domainexamples]
 
     if True or supportsetting == "min" or supportsetting == "train":
         for domain, domainexamples in domains.items():
@@ -262,7 +262,7 @@ def load_ds(traindomains=("restaurants",),
     ds = Dataset(allex)
 
     et = get_lf_abstract_transform(ds[lambda x: x[3] != testdomain].examples, general_tokens=general_tokens)
-    ds = ds.map(lambda x: (x[0], x[1], et(x[1]), x[2], x[3]))
+    ds = ds.map(lambda x: (x[0], x[1], et(x[1]), x[2], x[3]), passthrough={0: 0, 1: 1, 3: 2, 4: 3})
 
     seqenc_vocab = Vocab(padid=0, unkid=1, startid=2, endid=3)
     seqenc_vocab.add_token("@ABS@", seen=np.infty)
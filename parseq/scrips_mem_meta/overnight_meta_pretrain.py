@@ -196,18 +196,21 @@ def load_ds(traindomains=("restaurants",),
             tokens = [starttok] + tokens
         return tokens
 
-    domains = {}
-    alltrainex = []
-    for domain in list(traindomains) + [testdomain]:
-        ds = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True,
-                                    restore_reverse=DATA_RESTORE_REVERSE, validfrac=.10)\
-            .load(domain=domain)
+    def prepare_domain(domain, ds):
         domainexamples = [(a, b, c) for a, b, c in ds.examples]
         if supportsetting == "lex":
             domainexamples = [(a, b, "finetune" if c == "lexicon" else c)
                               for a, b, c in domainexamples]
         else:
             domainexamples = [(a, b, c) for a, b, c in domainexamples if c != "lexicon"]
+        return domainexamples
+
+    domains = {}
+    alltrainex = []
+    loaded = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True,
+                                    restore_reverse=DATA_RESTORE_REVERSE, validfrac=.10)\
+        .load_many(list(traindomains) + [testdomain], f=prepare_domain)
+    for domain, domainexamples in loaded.items():
         if domain != testdomain:
             alltrainex += [(a, b, c, domain) for a, b, c in domainexamples if c == "train"]
         domains[domain] = domainexamples
@@ -230,7 +233,7 @@ def load_ds(traindomains=("restaurants",),
     ds = Dataset(allex)
 
     et = get_lf_abstract_transform(ds[lambda x: x[3] != testdomain].examples)
-    ds = ds.map(lambda x: (x[0], x[1], et(x[1]), x[2], x[3]))
+    ds = ds.map(lambda x: (x[0], x[1], et(x[1]), x[2], x[3]), passthrough={0: 0, 1: 1, 3: 2, 4: 3})
 
     abstracttokens = set()
     # abstracttokens.add("@META@")
@@ -267,10 +270,10 @@ def load_ds(traindomains=("restaurants",),
     sourceret = {}
     targetret = {}
     for domain in domains:
-        finetuneds = ds[lambda x: x[3] == "finetune" and x[4] == domain].map(tokenize)
-        trainds = ds[lambda x: x[3] == "train" and x[4] == domain].map(tokenize)
-        validds = ds[lambda x: x[3] == "valid" and x[4] == domain].map(tokenize)
-        testds = ds[lambda x: x[3] == "test" and x[4] == domain].map(tokenize)
+        finetuneds = ds[lambda x, domain=domain: x[3] == "finetune" and x[4] == domain].map(tokenize)
+        trainds = ds[lambda x, domain=domain: x[3] == "train" and x[4] == domain].map(tokenize)
+        validds = ds[lambda x, domain=domain: x[3] == "valid" and x[4] == domain].map(tokenize)
+        testds = ds[lambda x, domain=domain: x[3] == "test" and x[4] == domain].map(tokenize)
         if domain == testdomain:
             ret = targetret
         else:
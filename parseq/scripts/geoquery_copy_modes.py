@@ -0,0 +1,142 @@
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+import qelos as q
+
+from parseq.grammar import lisp_to_tree
+from parseq.states import State, TreeDecoderState
+from parseq.transitions import TransitionModel, LSTMTransition
+from parseq.vocab import SequenceEncoder
+
+
+def load_geo_states(p="../../datasets/geo880dong/", split="test"):
+    """ Builds a list of single-example TreeDecoderStates from geo880dong. """
+    lines = [x.strip().split("\t") for x in
+             open(os.path.join(os.path.dirname(__file__), p, f"{split}.txt"), "r").readlines()]
+    inpenc = SequenceEncoder(tokenizer=lambda x: x.split())
+    outenc = SequenceEncoder(tokenizer=lambda x: x.split(), add_end_token=True)
+    for inp, out in lines:
+        inpenc.inc_build_vocab(inp)
+        outenc.inc_build_vocab(out)
+    inpenc.finalize_vocab()
+    outenc.finalize_vocab()
+
+    token_specs = {}
+    def walk_the_tree(t):
+        minc, maxc = token_specs.get(t.label(), (np.infty, -np.infty))
+        token_specs[t.label()] = (min(minc, len(t)), max(maxc, len(t)))
+        for c in t:
+            walk_the_tree(c)
+
+    trees = [lisp_to_tree(out) for inp, out in lines]
+    for tree in trees:
+        walk_the_tree(tree)
+    token_specs["and"] = (token_specs["and"][0], np.infty)
+
+    states = []
+    for (inp, out), tree in zip(lines, trees):
+        inp_tensor, inp_tokens = inpenc.convert(inp, return_what="tensor,tokens")
+        out_tensor, out_tokens = outenc.convert(out, return_what="tensor,tokens")
+        states.append(TreeDecoderState([inp], [tree], inp_tensor[None], out_tensor[None], [inp_tokens], [out_tokens],
+                                       inpenc.vocab, outenc.vocab, token_specs=token_specs))
+    return states
+
+
+class AttentionLSTMModel(TransitionModel):
+    """ Small attention-based LSTM decoder. """
+    def __init__(self, inpvocsize, outvocsize, dim=64, **kw):
+        super(AttentionLSTMModel, self).__init__(**kw)
+        self.inp_emb = torch.nn.Embedding(inpvocsize, dim, padding_idx=0)
+        self.out_emb = torch.nn.Embedding(outvocsize, dim, padding_idx=0)
+        self.out_rnn = LSTMTransition(dim, dim)
+        self.out_lin = torch.nn.Linear(dim * 2, outvocsize)
+
+    def forward(self, x:State):
+        if not "mstate" in x:
+            x.mstate = State()
+        mstate = x.mstate
+        if not "ctx" in mstate:
+            mstate.ctx = self.inp_emb(x.inp_tensor)
+            mstate.ctx_mask = x.inp_tensor != 0
+            mstate.rnnstate = self.out_rnn.get_init_state(len(x), x.inp_tensor.device)
+        enc, mstate.rnnstate = self.out_rnn(self.out_emb(x.prev_actions), mstate.rnnstate)
+        scores = torch.einsum("bd,bsd->bs", enc, mstate.ctx)
+        alphas = torch.softmax(scores.masked_fill(~mstate.ctx_mask, -np.infty), -1)
+        summ = torch.einsum("bs,bsd->bd", alphas, mstate.ctx)
+        x.store_attention(alphas.detach())
+        outs = self.out_lin(torch.cat([enc, summ], -1))
+        return torch.log_softmax(outs, -1), x
+
+    def supports_forward_sequence(self, x:State) -> bool:
+        return self.out_rnn.supports_forward_sequence()
+
+    def forward_sequence(self, x:State, prev_actions:torch.Tensor):
+        x.mstate = State()
+        mstate = x.mstate
+        mstate.ctx = self.inp_emb(x.inp_tensor)
+        mstate.ctx_mask = x.inp_tensor != 0
+        mstate.rnnstate = self.out_rnn.get_init_state(len(x), x.inp_tensor.device)
+        enc, mstate.rnnstate = self.out_rnn.forward_sequence(self.out_emb(prev_actions), mstate.rnnstate)
+        scores = torch.einsum("btd,bsd->bts", enc, mstate.ctx)
+        alphas = torch.softmax(scores.masked_fill(~mstate.ctx_mask[:, None, :], -np.infty), -1)
+        summ = torch.einsum("bts,bsd->btd", alphas, mstate.ctx)
+        for t in range(alphas.size(1)):
+            x.store_attention(alphas[:, t].detach())
+        outs = self.out_lin(torch.cat([enc, summ], -1))
+        return torch.log_softmax(outs, -1), x
+
+
+def try_copy_modes(batsize=20, numbats=5, reps=3, seed=123456):
+    """
+    Reports time and peak memory of copying geoquery decoder states (deep vs. copy-on-write)
+    and decoding the copies step by step along the golds, as done when a decoder keeps its input state around.
+    """
+    states = load_geo_states()
+    vocab = states[0].query_vocab
+    torch.manual_seed(seed)
+    model = AttentionLSTMModel(states[0].sentence_vocab.number_of_ids(), vocab.number_of_ids())
+    model.eval()
+
+    def make_batch(i):
+        batch = [state.make_copy() for state in states[i * batsize: (i+1) * batsize]]
+        gl = max([state.gold_tensor.size(1) for state in batch])
+        il = max([state.inp_tensor.size(1) for state in batch])
+        for state in batch:
+            state.gold_tensor = torch.cat([state.gold_tensor, state.gold_tensor.new_zeros(1, gl - state.gold_tensor.size(1))], 1)
+            state.inp_tensor = torch.cat([state.inp_tensor, state.inp_tensor.new_zeros(1, il - state.inp_tensor.size(1))], 1)
+        return batch[0].merge(batch)
+
+    batches = [make_batch(i) for i in range(numbats)]
+    for batch in batches:
+        batch.start_decoding()
+    results = {}
+    for deep in (True, "cow"):
+        tracemalloc.start()
+        start = time.time()
+        preds = []
+        with torch.no_grad():
+            for _ in range(reps):
+                for batch in batches:
+                    x = batch.make_copy(deep=deep)
+                    i = 0
+                    while not x.all_terminated():
+                        _, x = model(x)
+                        x.step(x.get_gold(i))
+                        i += 1
+                    preds.append(x.followed_actions)
+        duration = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[deep] = preds
+        print(f"deep={deep}: {duration:.2f}s for {reps}x{numbats} batches of {batsize}, "
+              f"peak traced memory: {peak / 2**20:.1f} MiB")
+    assert(all([torch.equal(a, b) for a, b in zip(results[True], results["cow"])]))
+    assert(all([len(batch.followed_actions[0]) == 0 for batch in batches]))
+    print("same decoded sequences, original states untouched")
+
+
+if __name__ == '__main__':
+    q.argprun(try_copy_modes)
@@ -451,9 +451,7 @@ class BasicGenModelNOBERT(TransitionModel):
         # _, preds = outs.max(-1)
 
         if self.store_attn:
-            if "stored_attentions" not in x:
-                x.stored_attentions = torch.zeros(alphas.size(0), 0, alphas.size(1), device=alphas.device)
-            x.stored_attentions = torch.cat([x.stored_attentions, alphas.detach()[:, None, :]], 1)
+            x.store_attention(alphas.detach())
 
         return outs[0], x
 
@@ -562,9 +560,7 @@ class BasicGenModel(TransitionModel):
         # _, preds = outs.max(-1)
 
         if self.store_attn:
-            if "stored_attentions" not in x:
-                x.stored_attentions = torch.zeros(alphas.size(0), 0, alphas.size(1), device=alphas.device)
-            x.stored_attentions = torch.cat([x.stored_attentions, alphas.detach()[:, None, :]], 1)
+            x.store_attention(alphas.detach())
 
         return outs[0], x
 
@@ -28,7 +28,7 @@ from torch.utils.data import DataLoader
 from parseq.decoding import SeqDecoder, BeamDecoder, BeamTransition
 from parseq.eval import CELoss, SeqAccuracies, make_array_of_metrics, DerivedAccuracy, TreeAccuracy
 from parseq.grammar import prolog_to_pas, lisp_to_pas, pas_to_prolog, pas_to_tree, tree_size, tree_to_prolog, \
-    tree_to_lisp, lisp_to_tree
+    tree_to_lisp, lisp_to_tree, batch_tensor2tree, sample_tree_permutation
 from parseq.nn import TokenEmb, BasicGenOutput, PtrGenOutput, PtrGenOutput2, load_pretrained_embeddings, GRUEncoder, \
     LSTMEncoder
 from parseq.scripts.geoquery_gen_orderiml import get_tree_permutations
@@ -228,7 +228,7 @@ class GeoDataset(object):
                                      token_specs=self.token_specs)
             if split == "train" and self.reorder_random is True:
                 gold_tree_ = tensor2tree(out_tensor, self.query_encoder.vocab)
-                random_gold_tree = random.choice(get_tree_permutations(gold_tree_, orderless={"and"}))
+                random_gold_tree = sample_tree_permutation(gold_tree_, orderless={"and"})
                 out_ = tree_to_lisp(random_gold_tree)
                 out_tensor_, out_tokens_ = self.query_encoder.convert(out_, return_what="tensor,tokens")
                 if gold_map is not None:
@@ -431,12 +431,56 @@ class BasicGenModel(TransitionModel):
         # _, preds = outs.max(-1)
 
         if self.store_attn:
-            if "stored_attentions" not in x:
-                x.stored_attentions = torch.zeros(alphas.size(0), 0, alphas.size(1), device=alphas.device)
-            x.stored_attentions = torch.cat([x.stored_attentions, alphas.detach()[:, None, :]], 1)
+            x.store_attention(alphas.detach())
 
         return outs[0], x
 
+    def supports_forward_sequence(self, x:State) -> bool:
+        return not self.feedatt and self.nocopy and self.training \
+               and self.out_rnn.supports_forward_sequence()
+
+    def forward_sequence(self, x:State, prev_actions:torch.Tensor):
+        """ Teacher-forced outputs for all timesteps at once (feeding attention, copying and output masks need step-by-step decoding). """
+        x.mstate = State()
+        mstate = x.mstate
+        # encode input
+        inptensor = x.inp_tensor
+        mask = inptensor != 0
+        inpembs = self.inp_emb(inptensor)
+        inpenc, final_encs = self.inp_enc(inpembs, mask)
+        init_states = []
+        for i, final_enc in enumerate(final_encs):    # iter over layers
+            _fenc = self.enc_to_dec[i](final_enc[0])
+            init_states.append(_fenc)
+        mstate.ctx = ctx = inpenc
+        mstate.ctx_mask = ctx_mask = mask
+
+        init_rnn_state = self.out_rnn.get_init_state(len(x), x.inp_tensor.device)
+        if len(init_states) == init_rnn_state.h.size(1):
+            init_rnn_state.h = torch.stack(init_states, 1).contiguous()
+        mstate.rnnstate = init_rnn_state
+
+        batsize, seqlen = prev_actions.size()
+        emb = self.out_emb(prev_actions)
+        enc, mstate.rnnstate = self.out_rnn.forward_sequence(emb, mstate.rnnstate)
+
+        # attention for all timesteps at once: fold time into batch
+        ctx_ = ctx[:, None].expand(-1, seqlen, -1, -1).reshape(batsize * seqlen, ctx.size(1), ctx.size(2))
+        ctx_mask_ = ctx_mask[:, None].expand(-1, seqlen, -1).reshape(batsize * seqlen, ctx_mask.size(1))
+        alphas, summ, scores = self.att(enc.reshape(batsize * seqlen, -1), ctx_, ctx_mask_)
+        alphas, summ = alphas.view(batsize, seqlen, -1), summ.view(batsize, seqlen, -1)
+        mstate.prev_summ = summ[:, -1]
+        enc = torch.cat([enc, summ], -1)
+
+        outs = self.out_lin(enc.view(batsize * seqlen, -1))
+        outs = (outs,) if not q.issequence(outs) else outs
+
+        if self.store_attn:
+            for i in range(seqlen):
+                x.store_attention(alphas[:, i].detach())
+
+        return outs[0].view(batsize, seqlen, -1), x
+
 
 def do_rare_stats(ds, sentence_rare_tokens=None, query_rare_tokens=None):
     # how many examples contain rare words, in input and output, in both train and test
@@ -576,18 +620,21 @@ def run(lr=0.001,
     tfdecoder = SeqDecoder(model, tf_ratio=1.,
                            eval=[CELoss(ignore_index=0, mode="logprobs", smoothing=smoothing),
                             SeqAccuracies(), TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                          batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                           orderless={"and"})])
     losses = make_array_of_metrics("loss", "elem_acc", "seq_acc", "tree_acc")
 
     freedecoder = SeqDecoder(model, maxtime=100, tf_ratio=0.,
                              eval=[SeqAccuracies(),
                                    TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                 orderless={"and"})])
     vlosses = make_array_of_metrics("seq_acc", "tree_acc")
 
     beamdecoder = BeamDecoder(model, maxtime=100, beamsize=beamsize, copy_deep=True,
                               eval=[SeqAccuracies()],
                               eval_beam=[TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                      batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                 orderless={"and"})])
     beamlosses = make_array_of_metrics("seq_acc", "tree_acc", "tree_acc_at_last")
 
@@ -657,6 +704,7 @@ def run(lr=0.001,
         _freedecoder = BeamDecoder(_model, maxtime=100, beamsize=beamsize, copy_deep=True,
                                   eval=[SeqAccuracies()],
                                   eval_beam=[TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                          batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                           orderless={"and"})])
 
         # testing
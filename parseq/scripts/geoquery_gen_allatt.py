@@ -28,7 +28,7 @@ from torch.utils.data import DataLoader
 from parseq.decoding import SeqDecoder, BeamDecoder, BeamTransition
 from parseq.eval import CELoss, SeqAccuracies, make_array_of_metrics, DerivedAccuracy, TreeAccuracy
 from parseq.grammar import prolog_to_pas, lisp_to_pas, pas_to_prolog, pas_to_tree, tree_size, tree_to_prolog, \
-    tree_to_lisp, lisp_to_tree
+    tree_to_lisp, lisp_to_tree, sample_tree_permutation
 from parseq.nn import TokenEmb, BasicGenOutput, PtrGenOutput, PtrGenOutput2, load_pretrained_embeddings, GRUEncoder, \
     LSTMEncoder
 from parseq.scripts.geoquery_gen_orderiml import get_tree_permutations
@@ -228,7 +228,7 @@ class GeoDataset(object):
                                      token_specs=self.token_specs)
             if split == "train" and self.reorder_random is True:
                 gold_tree_ = tensor2tree(out_tensor, self.query_encoder.vocab)
-                random_gold_tree = random.choice(get_tree_permutations(gold_tree_, orderless={"and"}))
+                random_gold_tree = sample_tree_permutation(gold_tree_, orderless={"and"})
                 out_ = tree_to_lisp(random_gold_tree)
                 out_tensor_, out_tokens_ = self.query_encoder.convert(out_, return_what="tensor,tokens")
                 if gold_map is not None:
@@ -440,10 +440,7 @@ class BasicGenModel(TransitionModel):
         # _, preds = outs.max(-1)
 
         if self.store_attn:
-            if "stored_attentions" not in x:
-                x.stored_attentions = torch.zeros(alphas.size(0), 0, alphas.size(1), device=alphas.device)
-            atts = q.pad_tensors([x.stored_attentions, alphas.detach()[:, None, :]], 2, 0)
-            x.stored_attentions = torch.cat(atts, 1)
+            x.store_attention(alphas.detach())
 
         return outs[0], x
 
@@ -28,7 +28,7 @@ from torch.utils.data import DataLoader
 from parseq.decoding import SeqDecoder, BeamDecoder, BeamTransition
 from parseq.eval import CELoss, SeqAccuracies, make_array_of_metrics, DerivedAccuracy, TreeAccuracy, StatePenalty
 from parseq.grammar import prolog_to_pas, lisp_to_pas, pas_to_prolog, pas_to_tree, tree_size, tree_to_prolog, \
-    tree_to_lisp, lisp_to_tree, are_equal_trees
+    tree_to_lisp, lisp_to_tree, are_equal_trees, iter_tree_permutations, count_tree_permutations
 from parseq.nn import TokenEmb, BasicGenOutput, PtrGenOutput, PtrGenOutput2, load_pretrained_embeddings, GRUEncoder, \
     LSTMEncoder
 from parseq.states import DecodableState, BasicDecoderState, State, TreeDecoderState, ListState
@@ -133,22 +133,8 @@ def try_basic_query_tokenizer():
 
 
 def get_tree_permutations(tree, orderless={"and", "or"}):
-    rets = []
-    if len(tree) == 0:
-        return [Tree(tree.label(), [])]
-    elif tree.label() in orderless:
-        for permutation in permutations(tree):
-            child_perms = [get_tree_permutations(child, orderless=orderless) for child in permutation]
-            for children in product(*child_perms):
-                ret = Tree(tree.label(), children)
-                rets.append(ret)
-        return rets
-    else:
-        child_perms = [get_tree_permutations(child, orderless=orderless) for child in tree]
-        for children in product(*child_perms):
-            ret = Tree(tree.label(), children)
-            rets.append(ret)
-        return rets
+    # lazy: only the permutations that are consumed are built
+    return iter_tree_permutations(tree, orderless=orderless)
 
 
 def try_tree_permutations():
@@ -164,6 +150,8 @@ def try_tree_permutations():
         perms.append(str(tree_perm))
 
     print(len(unique_perms), len(perms))
+    assert(len(perms) == count_tree_permutations(tree, orderless={"a", "x"}))
+    assert(len(unique_perms) == count_tree_permutations(tree, orderless={"a", "x"}, distinct=True))
 
 
 class GeoDataset(object):
@@ -506,9 +494,7 @@ class BasicGenModel(TransitionModel):
         # _, preds = outs.max(-1)
 
         if self.store_attn:
-            if "stored_attentions" not in x:
-                x.stored_attentions = torch.zeros(alphas.size(0), 0, alphas.size(1), device=alphas.device)
-            x.stored_attentions = torch.cat([x.stored_attentions, alphas.detach()[:, None, :]], 1)
+            x.store_attention(alphas.detach())
 
         mstate.decoding_step = mstate.decoding_step + 1
 
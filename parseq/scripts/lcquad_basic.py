@@ -27,7 +27,7 @@ from torch.utils.data import DataLoader
 from parseq.decoding import SeqDecoder, BeamDecoder, BeamTransition
 from parseq.eval import CELoss, SeqAccuracies, make_array_of_metrics, DerivedAccuracy, TreeAccuracy
 from parseq.grammar import prolog_to_pas, lisp_to_pas, pas_to_prolog, pas_to_tree, tree_size, tree_to_prolog, \
-    tree_to_lisp, lisp_to_tree
+    tree_to_lisp, lisp_to_tree, batch_tensor2tree
 from parseq.nn import TokenEmb, BasicGenOutput, PtrGenOutput, PtrGenOutput2, load_pretrained_embeddings, GRUEncoder, \
     LSTMEncoder
 from parseq.states import DecodableState, BasicDecoderState, State, TreeDecoderState, ListState
@@ -441,9 +441,7 @@ class BasicGenModel(TransitionModel):
         # _, preds = outs.max(-1)
 
         if self.store_attn:
-            if "stored_attentions" not in x:
-                x.stored_attentions = torch.zeros(alphas.size(0), 0, alphas.size(1), device=alphas.device)
-            x.stored_attentions = torch.cat([x.stored_attentions, alphas.detach()[:, None, :]], 1)
+            x.store_attention(alphas.detach())
 
         return outs[0], x
 
@@ -578,6 +576,7 @@ def run(lr=0.001,
     tfdecoder = SeqDecoder(model, tf_ratio=1.,
                            eval=[CELoss(ignore_index=0, mode="logprobs"),
                             SeqAccuracies(), TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                          batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                           orderless={"select", "count", "ask"})])
     losses = make_array_of_metrics("loss", "elem_acc", "seq_acc", "tree_acc")
     # beamdecoder = BeamActionSeqDecoder(tfdecoder.model, beamsize=beamsize, maxsteps=50)
@@ -585,6 +584,7 @@ def run(lr=0.001,
         freedecoder = SeqDecoder(model, maxtime=40, tf_ratio=0.,
                                  eval=[SeqAccuracies(),
                                        TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                    batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                     orderless={"select", "count", "ask"})])
         vlosses = make_array_of_metrics("seq_acc", "tree_acc")
     else:
@@ -592,6 +592,7 @@ def run(lr=0.001,
         freedecoder = BeamDecoder(model, maxtime=30, beamsize=beamsize,
                                   eval=[SeqAccuracies()],
                                   eval_beam=[TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                          batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                     orderless={"select", "count", "ask"})])
         vlosses = make_array_of_metrics("seq_acc", "tree_acc", "tree_acc_at_last")
 
@@ -927,10 +928,12 @@ def run_rerank(lr=0.001,
     tfdecoder = SeqDecoder(TFTransition(model),
                            [CELoss(ignore_index=0, mode="logprobs"),
                             SeqAccuracies(), TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                          batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                           orderless={"op:and", "SW:concat"})])
     # beamdecoder = BeamActionSeqDecoder(tfdecoder.model, beamsize=beamsize, maxsteps=50)
     freedecoder = BeamDecoder(model, maxtime=50, beamsize=beamsize,
                               eval_beam=[TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                      batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                  orderless={"op:and", "SW:concat"})])
 
     # # test
@@ -1008,6 +1011,7 @@ def run_rerank(lr=0.001,
 
         _freedecoder = BeamDecoder(_model, maxtime=50, beamsize=beamsize,
                                   eval_beam=[TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                          batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                           orderless={"op:and", "SW:concat"})])
 
         # testing
@@ -27,7 +27,7 @@ from torch.utils.data import DataLoader
 from parseq.decoding import SeqDecoder, BeamDecoder, BeamTransition
 from parseq.eval import CELoss, SeqAccuracies, make_array_of_metrics, DerivedAccuracy, TreeAccuracy
 from parseq.grammar import prolog_to_pas, lisp_to_pas, pas_to_prolog, pas_to_tree, tree_size, tree_to_prolog, \
-    tree_to_lisp, lisp_to_tree
+    tree_to_lisp, lisp_to_tree, batch_tensor2tree
 from parseq.nn import TokenEmb, BasicGenOutput, PtrGenOutput, PtrGenOutput2, load_pretrained_embeddings
 from parseq.states import DecodableState, BasicDecoderState, State, TreeDecoderState, ListState
 from parseq.transitions import TransitionModel, LSTMCellTransition
@@ -572,12 +572,49 @@ class BasicGenModel(TransitionModel):
         # _, preds = outs.max(-1)
 
         if self.store_attn:
-            if "stored_attentions" not in x:
-                x.stored_attentions = torch.zeros(alphas.size(0), 0, alphas.size(1), device=alphas.device)
-            x.stored_attentions = torch.cat([x.stored_attentions, alphas.detach()[:, None, :]], 1)
+            x.store_attention(alphas.detach())
 
         return outs[0], x
 
+    def supports_forward_sequence(self, x:State) -> bool:
+        return not self.feedatt and self.nocopy \
+               and self.out_rnn.supports_forward_sequence()
+
+    def forward_sequence(self, x:State, prev_actions:torch.Tensor):
+        """ Teacher-forced outputs for all timesteps at once (feeding attention and copying need step-by-step decoding). """
+        x.mstate = State()
+        mstate = x.mstate
+        # encode input
+        inptensor = x.inp_tensor
+        mask = inptensor != 0
+        inpembs = self.inp_emb(inptensor)
+        inpenc, final_enc = self.inp_enc(inpembs, mask)
+        mstate.ctx = ctx = inpenc
+        mstate.ctx_mask = ctx_mask = mask
+
+        mstate.rnnstate = self.out_rnn.get_init_state(len(x), x.inp_tensor.device)
+
+        batsize, seqlen = prev_actions.size()
+        emb = self.out_emb(prev_actions)
+        enc, mstate.rnnstate = self.out_rnn.forward_sequence(emb, mstate.rnnstate)
+
+        # attention for all timesteps at once: fold time into batch
+        ctx_ = ctx[:, None].expand(-1, seqlen, -1, -1).reshape(batsize * seqlen, ctx.size(1), ctx.size(2))
+        ctx_mask_ = ctx_mask[:, None].expand(-1, seqlen, -1).reshape(batsize * seqlen, ctx_mask.size(1))
+        alphas, summ, scores = self.att(enc.reshape(batsize * seqlen, -1), ctx_, ctx_mask_)
+        alphas, summ = alphas.view(batsize, seqlen, -1), summ.view(batsize, seqlen, -1)
+        mstate.prev_summ = summ[:, -1]
+        enc = torch.cat([enc, summ], -1)
+
+        outs = self.out_lin(enc.view(batsize * seqlen, -1))
+        outs = (outs,) if not q.issequence(outs) else outs
+
+        if self.store_attn:
+            for i in range(seqlen):
+                x.store_attention(alphas[:, i].detach())
+
+        return outs[0].view(batsize, seqlen, -1), x
+
 
 def do_rare_stats(ds, sentence_rare_tokens=None, query_rare_tokens=None):
     # how many examples contain rare words, in input and output, in both train and test
@@ -702,10 +739,12 @@ def run(lr=0.001,
     tfdecoder = SeqDecoder(model, tf_ratio=1.,
                            eval=[CELoss(ignore_index=0, mode="logprobs"),
                             SeqAccuracies(), TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                          batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                           orderless={"op:and", "SW:concat"})])
     # beamdecoder = BeamActionSeqDecoder(tfdecoder.model, beamsize=beamsize, maxsteps=50)
     freedecoder = BeamDecoder(model, maxtime=50, beamsize=beamsize, tf_ratio=0.,
                               eval_beam=[TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                      batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                  orderless={"op:and", "SW:concat"})])
 
     # # test
@@ -784,6 +823,7 @@ def run(lr=0.001,
 
         _freedecoder = BeamDecoder(_model, maxtime=50, beamsize=beamsize,
                                   eval_beam=[TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                          batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                           orderless={"op:and", "SW:concat"})])
 
         # testing
@@ -972,10 +1012,12 @@ def run_rerank(lr=0.001,
     tfdecoder = SeqDecoder(TFTransition(model),
                            [CELoss(ignore_index=0, mode="logprobs"),
                             SeqAccuracies(), TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                          batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                           orderless={"op:and", "SW:concat"})])
     # beamdecoder = BeamActionSeqDecoder(tfdecoder.model, beamsize=beamsize, maxsteps=50)
     freedecoder = BeamDecoder(model, maxtime=50, beamsize=beamsize,
                               eval_beam=[TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                      batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                  orderless={"op:and", "SW:concat"})])
 
     # # test
@@ -1053,6 +1095,7 @@ def run_rerank(lr=0.001,
 
         _freedecoder = BeamDecoder(_model, maxtime=50, beamsize=beamsize,
                                   eval_beam=[TreeAccuracy(tensor2tree=partial(tensor2tree, D=ds.query_encoder.vocab),
+                                                          batch_tensor2tree=partial(batch_tensor2tree, vocab=ds.query_encoder.vocab),
                                                           orderless={"op:and", "SW:concat"})])
 
         # testing
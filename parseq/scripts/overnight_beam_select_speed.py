@@ -0,0 +1,59 @@
+import time
+
+import numpy as np
+import torch
+import qelos as q
+
+from parseq.datasets import OvernightDatasetLoader
+from parseq.decoding import BeamTransition
+
+
+def try_beam_select_speed(domains=("restaurants", "housing", "blocks", "publications", "recipes", "calendar"),
+                          batsize=50, beamsize=5, reps=50):
+    """ Reports per-step latency of beam candidate selection vs. vocabulary size, for sizes of overnight vocabularies. """
+    def select_by_sort(actionprobs, bscores, is_term):        # selection as it was done before, with full sorts
+        batsize, modul = bscores.size()
+        logprobs, actionids = torch.sort(actionprobs, 1, descending=True)
+        scores = logprobs[:, :beamsize].clone()
+        scores[is_term, 0] = 0
+        scores[is_term, 1:] = -np.infty
+        scoreses = scores.reshape(batsize, modul * beamsize) + bscores.repeat_interleave(beamsize, 1)
+        actionidses = actionids[:, :beamsize].reshape(batsize, modul * beamsize)
+        scores, selection_ids = torch.sort(scoreses, 1, descending=True)
+        scores, selection_ids = scores[:, :beamsize], selection_ids[:, :beamsize]
+        return scores, torch.div(selection_ids, beamsize, rounding_mode="floor"), actionidses.gather(1, selection_ids)
+
+    loader = OvernightDatasetLoader()
+    vocsizes = {}
+    alltokens = set()
+    for domain in domains:
+        tokens = {"@PAD@", "@UNK@", "@START@", "@END@", "(", ")"}
+        for nl, lf, split in loader.load(domain).examples:
+            tokens |= set(lf.leaves()) | set([st.label() for st in lf.subtrees()])
+            tokens |= set(nl.split())       # output vocabularies of copying models include input words
+        vocsizes[domain] = len(tokens)
+        alltokens |= tokens
+    vocsizes["all"] = len(alltokens)
+
+    bt = BeamTransition(None, beamsize=beamsize)
+    print(f"batsize {batsize}, beamsize {beamsize}")
+    print(f"{'domain':>15}{'vocsize':>10}{'sort (ms)':>12}{'topk (ms)':>12}")
+    for domain, vocsize in sorted(vocsizes.items(), key=lambda x: x[1]):
+        actionprobs = torch.log_softmax(torch.randn(batsize * beamsize, vocsize), -1)
+        bscores = torch.randn(batsize, beamsize)
+        is_term = torch.rand(batsize * beamsize) < 0.1
+        durations = []
+        for f in [select_by_sort, bt.select]:
+            f(actionprobs, bscores, is_term)
+            start = time.time()
+            for _ in range(reps):
+                ret = f(actionprobs, bscores, is_term)
+            durations.append((time.time() - start) / reps * 1000)
+            if f is select_by_sort:
+                ref = ret
+        assert(torch.allclose(ret[0], ref[0]))
+        print(f"{domain:>15}{vocsize:>10}{durations[0]:>12.3f}{durations[1]:>12.3f}")
+
+
+if __name__ == '__main__':
+    q.argprun(try_beam_select_speed)
@@ -155,10 +155,11 @@ def load_ds(traindomains=("restaurants",),
         return tokens
 
     allex = []
-    for traindomain in traindomains:
-        ds = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True, restore_reverse=DATA_RESTORE_REVERSE, validfrac=.10)\
-            .load(domain=traindomain)
-        allex += ds[(None, None, lambda x: x in ("train", "valid"))].map(lambda x: (x[0], x[1], x[2], traindomain)).examples       # don't use test examples
+    loaded = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True, restore_reverse=DATA_RESTORE_REVERSE, validfrac=.10)\
+        .load_many(traindomains, f=lambda traindomain, ds: ds[(None, None, lambda x: x in ("train", "valid"))]       # don't use test examples
+                   .map(lambda x: (x[0], x[1], x[2], traindomain)).examples)
+    for traindomain, domainexamples in loaded.items():
+        allex += domainexamples
 
     testds = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True, restore_reverse=DATA_RESTORE_REVERSE)\
         .load(domain=testdomain)
@@ -177,7 +178,7 @@ def load_ds(traindomains=("restaurants",),
     ds = _ds.map(lambda x: (x[0], tokenize_and_add_start(x[1], x[3]), x[2], x[3]))
 
     et = get_lf_abstract_transform(ds[lambda x: x[3] != testdomain].examples)
-    ds = ds.map(lambda x: (x[0], x[1], et(x[1]), x[2], x[3]))
+    ds = ds.map(lambda x: (x[0], x[1], et(x[1]), x[2], x[3]), passthrough={0: 0, 1: 1, 3: 2, 4: 3})
 
     seqenc_vocab = Vocab(padid=0, startid=1, endid=2, unkid=UNKID)
     absseqenc_vocab = Vocab(padid=0, startid=1, endid=2, unkid=UNKID)
@@ -434,7 +435,7 @@ def run(traindomains="ALL",
     print(json.dumps(settings, indent=4))
     if traindomains == "ALL":
         alldomains = {"recipes", "restaurants", "blocks", "calendar", "housing", "publications"}
-        traindomains = alldomains - {domain, }
+        traindomains = sorted(alldomains - {domain, })
     random.seed(seed)
     torch.manual_seed(seed)
     np.random.seed(seed)
@@ -598,8 +599,8 @@ def run(traindomains="ALL",
             ret = predm.generate(input_ids, attention_mask=input_ids != predm.config.pad_token_id,
                                       max_length=maxlen)
             inp_strs = [nltok.decode(input_idse, skip_special_tokens=True, clean_up_tokenization_spaces=False) for input_idse in input_ids]
-            out_strs = [flenc.vocab.tostr(rete.to(torch.device("cpu"))) for rete in ret]
-            gold_strs = [flenc.vocab.tostr(output_idse.to(torch.device("cpu"))) for output_idse in output_ids]
+            out_strs = flenc.vocab.tostr(ret.to(torch.device("cpu")))
+            gold_strs = flenc.vocab.tostr(output_ids.to(torch.device("cpu")))
 
             for x, y, g in zip(inp_strs, out_strs, gold_strs):
                 print(" ")
@@ -788,8 +788,8 @@ def run(traindomains="ALL",
             ret = predm.generate(input_ids, attention_mask=input_ids != predm.config.pad_token_id,
                                       max_length=maxlen)
             inp_strs = [nltok.decode(input_idse, skip_special_tokens=True, clean_up_tokenization_spaces=False) for input_idse in input_ids]
-            out_strs = [flenc.vocab.tostr(rete.to(torch.device("cpu"))) for rete in ret]
-            gold_strs = [flenc.vocab.tostr(output_idse.to(torch.device("cpu"))) for output_idse in output_ids]
+            out_strs = flenc.vocab.tostr(ret.to(torch.device("cpu")))
+            gold_strs = flenc.vocab.tostr(output_ids.to(torch.device("cpu")))
 
             for x, y, g in zip(inp_strs, out_strs, gold_strs):
                 print(" ")
@@ -179,7 +179,7 @@ def load_ds(traindomains=("restaurants",),
 
     if onlyabstract:
         et = get_lf_abstract_transform(ds[lambda x: x[3] != testdomain].examples)
-        ds = ds.map(lambda x: (x[0], et(x[1]), x[2], x[3]))
+        ds = ds.map(lambda x: (x[0], et(x[1]), x[2], x[3]), passthrough={0: 0, 2: 2, 3: 3})
 
     seqenc_vocab = Vocab(padid=0, startid=1, endid=2, unkid=UNKID)
     seqenc = SequenceEncoder(vocab=seqenc_vocab, tokenizer=lambda x: x,
@@ -571,8 +571,8 @@ def run(traindomains="ALL",
             ret = predm.generate(input_ids, attention_mask=input_ids != predm.config.pad_token_id,
                                       max_length=maxlen)
             inp_strs = [nltok.decode(input_idse, skip_special_tokens=True, clean_up_tokenization_spaces=False) for input_idse in input_ids]
-            out_strs = [flenc.vocab.tostr(rete.to(torch.device("cpu"))) for rete in ret]
-            gold_strs = [flenc.vocab.tostr(output_idse.to(torch.device("cpu"))) for output_idse in output_ids]
+            out_strs = flenc.vocab.tostr(ret.to(torch.device("cpu")))
+            gold_strs = flenc.vocab.tostr(output_ids.to(torch.device("cpu")))
 
             for x, y, g in zip(inp_strs, out_strs, gold_strs):
                 print(" ")
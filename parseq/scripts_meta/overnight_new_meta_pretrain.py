@@ -224,27 +224,29 @@ def load_ds(traindomains=("restaurants",),
         "SW:CNT-arg:max", "SW:CNT-arg:=", "arg:max",
     }
 
-    domains = {}
-    alltrainex = []
-    for domain in list(traindomains) + [testdomain]:
-        ds = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True,
-                                    restore_reverse=DATA_RESTORE_REVERSE, validfrac=.10)\
-            .load(domain=domain)
+    def prepare_domain(domain, ds):
         domainexamples = [(a, b, c) for a, b, c in ds.examples]
         if supportsetting == "lex":
             domainexamples = [(a, b, "finetune" if c == "lexicon" else c)
                               for a, b, c in domainexamples]
         else:
             domainexamples = [(a, b, c) for a, b, c in domainexamples if c != "lexicon"]
+        trainexamples = [(a, b, c) for a, b, c in domainexamples if c == "train"]
+        domainexamples = [(a, tokenize_and_add_start(b, domain, meta=c=="finetune", add_domain_start=add_domain_start,
+                                                     general_tokens=general_tokens), c)
+                          for a, b, c in domainexamples]
+        return trainexamples, domainexamples
+
+    domains = {}
+    alltrainex = []
+    loaded = OvernightDatasetLoader(simplify_mode="light" if not fullsimplify else "full", simplify_blocks=True,
+                                    restore_reverse=DATA_RESTORE_REVERSE, validfrac=.10)\
+        .load_many(list(traindomains) + [testdomain], f=prepare_domain)
+    for domain, (trainexamples, domainexamples) in loaded.items():
         if domain != testdomain:
-            alltrainex += [(a, b, c, domain) for a, b, c in domainexamples if c == "train"]
+            alltrainex += [(a, b, c, domain) for a, b, c in trainexamples]
         domains[domain] = domainexamples
 
-    for domain in domains:
-        domains[domain] = [(a, tokenize_and_add_start(b, domain, meta=c=="finetune", add_domain_start=add_domain_start,
-                                                      general_tokens=general_tokens), c)
-                           for a, b, c in domains[domain]]
-
     if supportsetting == "min" or supportsetting == "train":
         for domain, domainexamples in domains.items():
             print(domain)
@@ -259,7 +261,7 @@ def load_ds(traindomains=("restaurants",),
     ds = Dataset(allex)
 
     et = get_lf_abstract_transform(ds[lambda x: x[3] != testdomain].examples, general_tokens=general_tokens)
-    ds = ds.map(lambda x: (x[0], x[1], et(x[1]), x[2], x[3]))
+    ds = ds.map(lambda x: (x[0], x[1], et(x[1]), x[2], x[3]), passthrough={0: 0, 1: 1, 3: 2, 4: 3})
 
     seqenc_vocab = Vocab(padid=0, startid=1, endid=2, unkid=UNKID)
     seqenc_vocab.add_token("@ABS@", seen=np.infty)
@@ -316,10 +318,10 @@ def load_ds(traindomains=("restaurants",),
         finetunekey = "finetune"
         if supportsetting == "train" and domain != testdomain:
             finetunekey = "train"
-        finetuneds = ds[lambda x: x[3] == finetunekey and x[4] == domain].map(tokenize)
-        trainds = ds[lambda x: x[3] == "train" and x[4] == domain].map(tokenize)
-        validds = ds[lambda x: x[3] == "valid" and x[4] == domain].map(tokenize)
-        testds = ds[lambda x: x[3] == "test" and x[4] == domain].map(tokenize)
+        finetuneds = ds[lambda x, finetunekey=finetunekey, domain=domain: x[3] == finetunekey and x[4] == domain].map(tokenize)
+        trainds = ds[lambda x, domain=domain: x[3] == "train" and x[4] == domain].map(tokenize)
+        validds = ds[lambda x, domain=domain: x[3] == "valid" and x[4] == domain].map(tokenize)
+        testds = ds[lambda x, domain=domain: x[3] == "test" and x[4] == domain].map(tokenize)
         if domain == testdomain:
             ret = targetret
         else:
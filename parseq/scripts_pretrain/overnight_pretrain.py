@@ -252,6 +252,7 @@ def run(domain="restaurants",
         dataseed=12345678,
         datatemp=0.33,
         ptN=3000,
+        ptworkers=0,
         tokenmaskp=0.,
         spanmaskp=0.,
         spanmasklamda=2.2,
@@ -281,7 +282,9 @@ def run(domain="restaurants",
 
     tt.tick("creating grammar dataset generator")
     pcfg = build_grammar(tds, vds)
-    ptds = PCFGDataset(pcfg, N=ptN, seed=seed, temperature=datatemp, maxlen=100)
+    ptds = PCFGDataset(pcfg, N=ptN, seed=seed, temperature=datatemp, maxlen=100, blocksize=1000)
+    if ptworkers > 0:   # generate every epoch's examples up front in worker processes
+        ptds = ptds.shard(workers=ptworkers)
     tt.tock("created dataset generator")
 
     tt.tick("creating model")
@@ -441,8 +444,8 @@ def run(domain="restaurants",
             ret = predm.generate(input_ids, attention_mask=input_ids != predm.config.pad_token_id,
                                       max_length=maxlen)
             inp_strs = [nltok.decode(input_idse, skip_special_tokens=True, clean_up_tokenization_spaces=False) for input_idse in input_ids]
-            out_strs = [flenc.vocab.tostr(rete.to(torch.device("cpu"))) for rete in ret]
-            gold_strs = [flenc.vocab.tostr(output_idse.to(torch.device("cpu"))) for output_idse in output_ids]
+            out_strs = flenc.vocab.tostr(ret.to(torch.device("cpu")))
+            gold_strs = flenc.vocab.tostr(output_ids.to(torch.device("cpu")))
 
             for x, y, g in zip(inp_strs, out_strs, gold_strs):
                 print(" ")
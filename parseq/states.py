@@ -17,6 +17,8 @@ class State(object):
     """
     A State object represents the state of a batch of examples.
     """
+    _shared_keys = frozenset()      # keys whose values are shared with other copies (see make_copy(deep="cow"))
+
     def __init__(self, **kwdata):
         super(State, self).__init__()
         self._schema_keys = set()
@@ -47,6 +49,8 @@ class State(object):
             else:
                 self._length = len(v) if self._length is None and v is not None else self._length
                 assert(v is None or self._length == len(v))
+            if k in self._shared_keys and v is not self.__dict__.get(k):
+                self._shared_keys = self._shared_keys - {k}
             self.__dict__[k] = v
             self._schema_keys.add(k)
 
@@ -66,18 +70,43 @@ class State(object):
             return self._schema_keys
 
     def make_copy(self, ret=None, detach=None, deep=True):
+        """
+        :param deep:    True for deep copy, False for shallow copy,
+                        "cow" for copy-on-write: the values are shared by reference between this state and the copy
+                        and are only cloned by the first one that writes into them in-place (see ._own()).
+                        Values that are only read or reassigned during decoding (inputs, golds, ...) are thus never cloned.
+        """
         detach = deep if detach is None else detach
         ret = type(self)() if ret is None else ret
+        shared = set()
         for k in self._schema_keys:
             v = getattr(self, k)
-            if isinstance(v, torch.Tensor):
-                ret.set(**{k:v.clone().detach() if detach else v.clone()})
-            elif isinstance(v, State):
+            if isinstance(v, State):
                 ret.set(**{k: v.make_copy(detach=detach, deep=deep)})
+            elif deep == "cow":
+                ret.set(**{k: v.detach() if detach and isinstance(v, torch.Tensor) else v})
+                shared.add(k)
+            elif isinstance(v, torch.Tensor):
+                ret.set(**{k:v.clone().detach() if detach else v.clone()})
             else:
                 ret.set(**{k: deepcopy(v) if deep else copy(v)})
+        if len(shared) > 0:
+            self._shared_keys = self._shared_keys | shared
+            ret._shared_keys = ret._shared_keys | shared
         return ret
 
+    def _own(self, k):
+        """
+        Must be called before modifying the value under key k in-place.
+        If the value is shared with other copies (copy-on-write), it is cloned first.
+        Returns the value.
+        """
+        v = getattr(self, k)
+        if k in self._shared_keys:
+            v = v.clone() if isinstance(v, torch.Tensor) else deepcopy(v)
+            self.set(k, v)
+        return v
+
     def __len__(self):
         return self._length if self._length is not None else 0
 
@@ -147,7 +176,7 @@ class State(object):
             assert(len(ret) == len(value))
             item_cpu = item.detach().cpu().numpy() if isinstance(item, torch.Tensor) else item
             for k in self._schema_keys:
-                v = getattr(self, k)
+                v = self._own(k)
                 assert(True)        # TODO: assert type match
                 if isinstance(v, np.ndarray):
                     item = item_cpu
@@ -159,6 +188,7 @@ class State(object):
             v = getattr(self, k)
             if isinstance(v, np.ndarray):
                 if len(set([type(ve) for ve in v]) & {torch.Tensor, State}) > 0:
+                    v = self._own(k)
                     for i in range(len(v)):
                         v[i] = v[i].to(device)
             else:
@@ -194,6 +224,10 @@ class ListState(State):
                 self._list[ie] = xe
         else:
             self._list[i] = x
+        if len(self._shared_keys) > 0:
+            if isinstance(i, slice):
+                i = list(range(len(self._list))[i])
+            self._shared_keys = self._shared_keys - (set(i) if isinstance(i, list) else {i})
 
     def get(self, i:Union[int, slice, List[int]]):
         if isinstance(i, list):
@@ -207,17 +241,31 @@ class ListState(State):
     def make_copy(self, ret=None, detach=None, deep=True):
         detach = deep if detach is None else detach
         ret = type(self)() if ret is None else ret
+        shared = set()
         for i in range(len(self._list)):
             v = self._list[i]
-            if isinstance(v, torch.Tensor):
-                ret.append(v.clone.detach() if detach else v.clone())
-            elif isinstance(v, State):
+            if isinstance(v, State):
                 ret.append(v.make_copy(detach=detach, deep=deep))
+            elif deep == "cow":
+                ret.append(v.detach() if detach and isinstance(v, torch.Tensor) else v)
+                shared.add(i)
+            elif isinstance(v, torch.Tensor):
+                ret.append(v.clone().detach() if detach else v.clone())
             else:
                 ret.append(deepcopy(v) if deep else copy(v))
             assert(len(ret._list) == i + 1)
+        if len(shared) > 0:
+            self._shared_keys = self._shared_keys | shared
+            ret._shared_keys = ret._shared_keys | shared
         return ret
 
+    def _own(self, i:int):
+        v = self._list[i]
+        if i in self._shared_keys:
+            v = v.clone() if isinstance(v, torch.Tensor) else deepcopy(v)
+            self.set(i, v)
+        return v
+
     @classmethod
     def merge(cls, states:List['ListState'], ret=None):
         ret = cls() if ret is None else ret
@@ -270,7 +318,7 @@ class ListState(State):
         assert(len(ret) == len(value))
 
         for k in range(len(self._list)):
-            v = self.get(k)
+            v = self._own(k)
             assert(True)        # TODO: assert type match
             if not isinstance(item, slice) and isinstance(v, list):
                 if isinstance(item, torch.Tensor):
@@ -288,6 +336,7 @@ class ListState(State):
             v = self.get(k)
             if isinstance(v, list):
                 if len(set([type(ve) for ve in v]) & {torch.Tensor, State}) > 0:
+                    v = self._own(k)
                     for i in range(len(v)):
                         v[i] = v[i].to(device)
             else:
@@ -338,21 +387,181 @@ def batchstack(x:List[torch.Tensor]):
     return ret
 
 
+def _pad_to_size(x:torch.Tensor, size:typing.Sequence[int]):
+    """ Zero-pads all dimensions of x except the first one up to given size. """
+    if tuple(x.size()[1:]) == tuple(size):
+        return x
+    ret = x.new_zeros(x.size(0), *size)
+    ret[tuple([slice(None)] + [slice(0, s) for s in x.size()[1:]])] = x
+    return ret
+
+
+class HistoryState(State):
+    """
+    Fixed-capacity history buffer with a per-row length cursor (a long tensor on the device of the buffer).
+    Stores a (batsize, capacity, *elemsize) tensor that is allocated once and filled in place by .append(),
+    instead of growing a tensor with torch.cat on every decoding step.
+    The buffer grows (doubles) only if the capacity is exceeded.
+    Use .filled() to get a view over the filled prefix.
+    """
+    def __init__(self, batsize:int=None, capacity:int=100, *elemsize:int,
+                 dtype=torch.long, device=torch.device("cpu"), **kw):
+        if batsize is None:
+            super(HistoryState, self).__init__(**kw)
+        else:
+            super(HistoryState, self).__init__(
+                buffer=torch.zeros(batsize, capacity, *elemsize, dtype=dtype, device=device),
+                lens=torch.zeros(batsize, dtype=torch.long, device=device), **kw)
+
+    @property
+    def capacity(self):
+        return self.buffer.size(1)
+
+    def _grow(self, capacity:int=None, elemsize:typing.Sequence[int]=None):
+        capacity = max(self.capacity * 2, 1) if capacity is None else capacity
+        elemsize = tuple(self.buffer.size()[2:]) if elemsize is None else elemsize
+        self.buffer = _pad_to_size(self.buffer, (capacity,) + tuple(elemsize))
+
+    def append(self, x:torch.Tensor):
+        """
+        :param x:   (batsize, *elemsize) tensor to write at the current cursor of every row.
+                    If x is larger than the buffer in non-time dimensions, the buffer is padded, and vice versa.
+        """
+        assert(x.size(0) == len(self))
+        elemsize = tuple(self.buffer.size()[2:])
+        if len(x.size()[1:]) > 0 and any([xs > es for xs, es in zip(x.size()[1:], elemsize)]):
+            elemsize = tuple([max(xs, es) for xs, es in zip(x.size()[1:], elemsize)])
+            self._grow(capacity=self.capacity, elemsize=elemsize)
+        x = _pad_to_size(x, elemsize)
+        if len(self) > 0 and int(self.lens.max()) >= self.capacity:
+            self._grow()
+        buffer, lens = self._own("buffer"), self._own("lens")
+        buffer[torch.arange(len(self), device=buffer.device), lens] = x.to(buffer.dtype)
+        lens += 1
+
+    def filled(self):
+        """ Returns a view over the filled prefix of the buffer: (batsize, max(lens), *elemsize) """
+        maxlen = int(self.lens.max()) if len(self) > 0 else 0
+        return self.buffer[:, :maxlen]
+
+    @classmethod
+    def merge(cls, states:List['HistoryState'], ret=None):
+        ret = cls() if ret is None else ret
+        size = [max(sizes) for sizes in zip(*[state.buffer.size()[1:] for state in states])]
+        ret.set(buffer=torch.cat([_pad_to_size(state.buffer, size) for state in states], 0),
+                lens=torch.cat([state.lens for state in states], 0))
+        return ret
+
+    def __setitem__(self, item, value:'HistoryState'):
+        if isinstance(item, str):
+            return super(HistoryState, self).__setitem__(item, value)
+        size = [max(a, b) for a, b in zip(self.buffer.size()[1:], value.buffer.size()[1:])]
+        self.buffer = _pad_to_size(self.buffer, size)
+        value = type(value)(buffer=_pad_to_size(value.buffer, size), lens=value.lens)
+        return super(HistoryState, self).__setitem__(item, value)
+
+
 class BeamState(DecodableState):
-    def __init__(self, states:List[DecodableState]=None, scores:torch.Tensor=None,
-                 actionprobs:List[torch.Tensor]=None, predactions:torch.Tensor=None):
+    """
+    State of beam search where the beam is folded into the batch dimension:
+    .fstate is a single decoder state with batsize*beamsize rows, row b*beamsize+k holding the k-th beam element of example b.
+    The other keys are (batsize, beamsize, ...) tensors: "bscores", "actionprobs" (batsize, beamsize, T, V) and "predactions".
+    Compact beam states instead keep per step only the chosen actions, their log-probabilities and backpointers
+    (keys "actions", "actionlogprobs" and "backpointers", all (batsize, beamsize, T)), see .backtrack().
+    """
+    def __init__(self, states:Union[DecodableState, List[DecodableState]]=None, scores:torch.Tensor=None,
+                 actionprobs:Union[torch.Tensor, List[torch.Tensor]]=None, predactions:torch.Tensor=None, beamsize:int=None,
+                 **kw):
+        """
+        :param states:  either a folded state (then beamsize must be given) or a list of batched states, one per beam element
+        """
         if states is not None:
-            bstates = ListState(*states)
-            batsize, beamsize = len(bstates), len(states)
+            if isinstance(states, list):
+                beamsize, batsize = len(states), len(states[0])
+                fstate = type(states[0]).merge(states)      # beam-major --> make batch-major
+                fstate = fstate[torch.arange(batsize * beamsize).view(beamsize, batsize).t().reshape(-1)]
+            else:
+                fstate = states
+                batsize = len(fstate) // beamsize
             bscores = torch.zeros(batsize, beamsize) if scores is None else scores
-            kw = {"bstates": bstates, "bscores": bscores}
+            kw = kw.copy()
+            kw["bscores"] = bscores
             if actionprobs is not None:
-                actionprobs = ListState(*actionprobs)
-                kw["actionprobs"] = actionprobs
-            kw["predactions"] = predactions
+                kw["actionprobs"] = torch.stack(actionprobs, 1) if isinstance(actionprobs, list) else actionprobs
+            if predactions is not None:
+                kw["predactions"] = predactions
             super(BeamState, self).__init__(**kw)
+            self._set_fstate(fstate, beamsize)
         else:
             super(BeamState, self).__init__()
+            self._set_fstate(None, beamsize)
+
+    def _set_fstate(self, fstate:DecodableState, beamsize:int):
+        # the folded state is kept outside of the schema since its length is batsize*beamsize
+        self.__dict__["fstate"] = fstate
+        self.beamsize = beamsize
+
+    def fold_index(self, item=None)->torch.Tensor:
+        """ Returns the rows in .fstate that belong to the given batch indexes (all if None). """
+        batids = torch.arange(len(self))
+        batids = batids[item] if item is not None else batids
+        return (batids[:, None] * self.beamsize + torch.arange(self.beamsize)[None, :]).view(-1)
+
+    def get_beam_element(self, k:int)->DecodableState:
+        """ Returns the batched state of the k-th elements of the beam. """
+        return self.fstate[torch.arange(len(self)) * self.beamsize + k]
+
+    def backtrack(self)->typing.Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Follows the backpointers of a compact beam state.
+        :return:    (batsize, beamsize, T) actions of every beam element and their log-probabilities
+        """
+        ptr = torch.arange(self.beamsize, device=self.actions.device)[None, :].repeat(len(self), 1)
+        actions, logprobs = torch.zeros_like(self.actions), torch.zeros_like(self.actionlogprobs)
+        for t in range(self.actions.size(2) - 1, -1, -1):
+            actions[:, :, t] = self.actions[:, :, t].gather(1, ptr)
+            logprobs[:, :, t] = self.actionlogprobs[:, :, t].gather(1, ptr)
+            ptr = self.backpointers[:, :, t].gather(1, ptr)
+        return actions, logprobs
+
+    @property
+    def bstates(self)->ListState:
+        return ListState(*[self.get_beam_element(k) for k in range(self.beamsize)])
+
+    def make_copy(self, ret=None, detach=None, deep=True):
+        ret = super(BeamState, self).make_copy(ret=ret, detach=detach, deep=deep)
+        ret._set_fstate(self.fstate.make_copy(detach=detach, deep=deep), self.beamsize)
+        return ret
+
+    @classmethod
+    def merge(cls, states:List['BeamState'], ret=None):
+        assert(all([state.beamsize == states[0].beamsize for state in states]))
+        ret = super(BeamState, cls).merge(states, ret=ret)
+        ret._set_fstate(type(states[0].fstate).merge([state.fstate for state in states]), states[0].beamsize)
+        return ret
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return super(BeamState, self).__getitem__(item)
+        if isinstance(item, int):
+            item = slice(item, item+1)
+        ret = super(BeamState, self).__getitem__(item)
+        ret._set_fstate(self.fstate[self.fold_index(item)], self.beamsize)
+        return ret
+
+    def __setitem__(self, item, value:'BeamState'):
+        if isinstance(item, str):
+            return super(BeamState, self).__setitem__(item, value)
+        if isinstance(item, int):
+            item = slice(item, item+1)
+        ret = super(BeamState, self).__setitem__(item, value)
+        self.fstate[self.fold_index(item)] = value.fstate
+        return ret
+
+    def to(self, device):
+        super(BeamState, self).to(device)
+        self.fstate.to(device)
+        return self
 
     def start_decoding(self):
         raise Exception("states must have already been started decoding.")
@@ -361,10 +570,10 @@ class BeamState(DecodableState):
         """
         Returns a list (over beam elements) of lists (over batch size) of booleans whether each elem in this state is terminated.
         """
-        return [x.is_terminated() for x in self.bstates._list]
+        return list(np.asarray(self.fstate.is_terminated()).reshape(len(self), self.beamsize).T)
 
     def all_terminated(self):
-        return all([all(ist) for ist in self.is_terminated()])
+        return bool(np.all(self.fstate.is_terminated()))
 
     def step(self, action:Union[torch.Tensor, List[Union[str, torch.Tensor]]]=None):
         raise Exception("this should not be used")
@@ -375,6 +584,7 @@ class BasicDecoderState(TrainableDecodableState):
     Basic state object for seq2seq
     """
     endtoken = "@END@"
+    maxtime = 100       # initial capacity of history buffers
     def __init__(self,
                  inp_strings:List[str]=None,
                  gold_strings:List[str]=None,
@@ -398,27 +608,25 @@ class BasicDecoderState(TrainableDecodableState):
             # self.set(followed_actions_str = np.asarray([None for _ in self.inp_strings]))
             # for i in range(len(self.followed_actions_str)):
             #     self.followed_actions_str[i] = []
-            self.set(followed_actions = torch.zeros(len(inp_strings), 0, dtype=torch.long))
+            self.set(_followed_actions = HistoryState(len(inp_strings), 0, dtype=torch.long))
             self.set(_is_terminated = np.asarray([False for _ in self.inp_strings]))
             self.set(_timesteps = np.asarray([0 for _ in self.inp_strings]))
 
             if sentence_encoder is not None:
-                x = [sentence_encoder.convert(x, return_what="tensor,tokens") for x in self.inp_strings]
-                x = list(zip(*x))
-                inp_tokens = np.asarray([None for _ in range(len(x[1]))], dtype=np.object)
-                for i, inp_tokens_e in enumerate(x[1]):
+                inp_tensor, _, x = sentence_encoder.convert_batch(list(self.inp_strings))
+                inp_tokens = np.asarray([None for _ in range(len(x))], dtype=object)
+                for i, inp_tokens_e in enumerate(x):
                     inp_tokens[i] = tuple(inp_tokens_e)
-                x = {"inp_tensor": batchstack(x[0]),
+                x = {"inp_tensor": inp_tensor,
                      "inp_tokens": inp_tokens}
                 self.set(**x)
             if self.gold_strings is not None:
                 if query_encoder is not None:
-                    x = [query_encoder.convert(x, return_what="tensor,tokens") for x in self.gold_strings]
-                    x = list(zip(*x))
-                    gold_tokens = np.asarray([None for _ in range(len(x[1]))])
-                    for i, gold_tokens_e in enumerate(x[1]):
+                    gold_tensor, _, x = query_encoder.convert_batch(list(self.gold_strings))
+                    gold_tokens = np.asarray([None for _ in range(len(x))])
+                    for i, gold_tokens_e in enumerate(x):
                         gold_tokens[i] = tuple(gold_tokens_e)
-                    x = {"gold_tensor": batchstack(x[0]),
+                    x = {"gold_tensor": gold_tensor,
                          "gold_tokens": gold_tokens}
                     self.set(**x)
 
@@ -448,6 +656,21 @@ class BasicDecoderState(TrainableDecodableState):
         ret = super(BasicDecoderState, self).__setitem__(key, value)
         return ret
 
+    @property
+    def followed_actions(self):
+        return self._followed_actions.filled()
+
+    @property
+    def stored_attentions(self):
+        return self._stored_attentions.filled() if "_stored_attentions" in self else None
+
+    def store_attention(self, alphas:torch.Tensor):
+        """ Appends given (batsize, inplen) attention weights to the attention history of this state. """
+        if "_stored_attentions" not in self:
+            self.set(_stored_attentions=HistoryState(len(self), self.maxtime, alphas.size(1),
+                                                     dtype=alphas.dtype, device=alphas.device))
+        self._stored_attentions.append(alphas)
+
     # DecodableState API implementation
     def is_terminated(self):
         return self._is_terminated
@@ -457,6 +680,7 @@ class BasicDecoderState(TrainableDecodableState):
         qe = self.query_encoder
         self.set(prev_actions=torch.tensor([qe.vocab[qe.vocab.starttoken] for _ in self.inp_strings],
                                                    device=self.inp_tensor.device, dtype=torch.long))
+        self._followed_actions = HistoryState(len(self), self.maxtime, dtype=torch.long, device=self.inp_tensor.device)
 
     def step(self, tokens:Union[torch.Tensor, np.ndarray, List[Union[str, np.ndarray, torch.Tensor]]]):
         qe = self.query_encoder
@@ -487,13 +711,13 @@ class BasicDecoderState(TrainableDecodableState):
 
         mask = torch.tensor(self._is_terminated).to(self.prev_actions.device)
         self.prev_actions = self.prev_actions * (mask).long() + tokens_pt * (~mask).long()
-        self._timesteps[~self._is_terminated] = self._timesteps[~self._is_terminated] + 1
+        self._own("_timesteps")[~self._is_terminated] = self._timesteps[~self._is_terminated] + 1
 
         # for i, token in enumerate(tokens_str):
         #     if not self.is_terminated()[i]:
         #         self.followed_actions_str[i] = self.followed_actions_str[i] + [token]
 
-        self.followed_actions = torch.cat([self.followed_actions, tokens_pt[:, None]], 1)
+        self._followed_actions.append(tokens_pt)
 
         # self._is_terminated |= tokens_str == self.endtoken
         self._is_terminated = self._is_terminated | (tokens_np == self.query_encoder.vocab[self.endtoken])
@@ -505,8 +729,74 @@ class BasicDecoderState(TrainableDecodableState):
             return self.gold_tensor[:, i]
 
 
+class TreeGrammarTable(object):
+    """
+    Precomputed output masks for decoding bracketed trees (see TreeDecoderState).
+    Every token with a spec (min #children, max #children) in token_specs is mapped to a spec class
+    (class 0 is for unconstrained parents, i.e. parents that are not known yet or have no spec).
+    .masks contains one row for every (spec class, child count bucket) combination
+    where child counts are bucketed as -1, 0, 1, ..., K-1 and >= K (K is the largest finite max or min #children + 1),
+    preceded by three special rows (nothing decoded yet, decoding ended, complete tree at root).
+    """
+    START, ENDED, ROOT = 0, 1, 2
+    NUM_SPECIAL = 3
+
+    def __init__(self, token_specs:Dict[str, typing.Tuple[int, int]], vocab:Vocab,
+                 pushtoken="(", reducetoken=")", endtoken="@END@", padtoken="@PAD@", **kw):
+        super(TreeGrammarTable, self).__init__(**kw)
+        vocsize = vocab.number_of_ids()
+        leaf = {t for t, (min_c, max_c) in token_specs.items() if min_c == 0 and max_c == 0}
+        nonleaf = set(token_specs.keys()) - leaf
+        specs = sorted(set([tuple(spec) for spec in token_specs.values()]))
+        self.numbuckets = int(max([max_c for _, max_c in specs if max_c < np.infty] + [min_c for min_c, _ in specs] + [0])) + 3
+        self.push_id, self.reduce_id = vocab[pushtoken], vocab[reducetoken]
+        self.end_id, self.pad_id = vocab[endtoken], vocab[padtoken]
+
+        # spec class of every parent token id (shifted by one: index 0 is for parent -1, not known yet)
+        token_class = torch.zeros(vocsize + 1, dtype=torch.long)
+        for t, spec in token_specs.items():
+            if t in vocab.D:
+                token_class[vocab[t] + 1] = specs.index(tuple(spec)) + 1
+
+        def to_mask(tokens):
+            ret = torch.zeros(vocsize)
+            for token in tokens:
+                ret[vocab[token]] = 1
+            return ret
+
+        rows = [to_mask({pushtoken}), to_mask({padtoken}), to_mask({endtoken})]
+        for spec in [None] + specs:
+            for bucket in range(self.numbuckets):
+                child_count = bucket - 1
+                if child_count == -1:
+                    ret = ({reducetoken, pushtoken} | nonleaf) - {pushtoken}
+                else:
+                    ret = {reducetoken, pushtoken} | leaf
+                if spec is not None:
+                    if child_count == spec[1]:
+                        ret = {reducetoken}
+                    elif child_count < spec[0]:
+                        ret = ret - {reducetoken}
+                rows.append(to_mask(ret))
+        self.masks = torch.stack(rows, 0)
+        self.token_class = token_class
+
+    def to(self, device):
+        if self.masks.device != device:
+            self.masks = self.masks.to(device)
+            self.token_class = self.token_class.to(device)
+        return self
+
+    def get_rows(self, parents:torch.Tensor, child_counts:torch.Tensor):
+        """ Mask row ids for given (batsize,) parent token ids (-1 if not known yet) and child counts. """
+        classes = self.token_class[parents + 1]
+        buckets = (child_counts + 1).clamp(0, self.numbuckets - 1)
+        return self.NUM_SPECIAL + classes * self.numbuckets + buckets
+
+
 class TreeDecoderState(TrainableDecodableState):
     endtoken = "@END@"
+    maxtime = 100       # initial capacity of history buffers
     reducetoken = ")"
     pushtoken = "("
     def __init__(self,
@@ -561,8 +851,9 @@ class TreeDecoderState(TrainableDecodableState):
                         self.token_groups["leaf"].add(t)
                     else:
                         self.token_groups["nonleaf"].add(t)
+            self.grammar_table = None
 
-            self.set(followed_actions = torch.zeros(len(inp_strings), 0, dtype=torch.long))
+            self.set(_followed_actions = HistoryState(len(inp_strings), 0, dtype=torch.long))
             self.set(_is_terminated = np.asarray([False for _ in self.inp_strings]))
             self.set(_timesteps = np.asarray([0 for _ in self.inp_strings]))
 
@@ -574,16 +865,19 @@ class TreeDecoderState(TrainableDecodableState):
         ret.query_vocab = self.query_vocab
         ret.token_specs = self.token_specs
         ret.token_groups = self.token_groups
+        ret.grammar_table = self.grammar_table
         return ret
 
     @classmethod
     def merge(cls, states:List['TreeDecoderState'], ret=None):
         assert(all([state.sentence_vocab == states[0].sentence_vocab and state.query_vocab == states[0].query_vocab for state in states]))
+        cls._equalize_stacks(states)
         ret = super(TreeDecoderState, cls).merge(states, ret=ret)
         ret.sentence_vocab = states[0].sentence_vocab
         ret.query_vocab = states[0].query_vocab
         ret.token_specs = states[0].token_specs
         ret.token_groups = states[0].token_groups
+        ret.grammar_table = states[0].grammar_table
         return ret
 
     def __getitem__(self, item):
@@ -592,13 +886,41 @@ class TreeDecoderState(TrainableDecodableState):
         ret.query_vocab = self.query_vocab
         ret.token_specs = self.token_specs
         ret.token_groups = self.token_groups
+        ret.grammar_table = self.grammar_table
         return ret
 
     def __setitem__(self, key, value:'TreeDecoderState'):
         assert(value.sentence_vocab == self.sentence_vocab and value.query_vocab == self.query_vocab)
+        self._equalize_stacks([self, value])
         ret = super(TreeDecoderState, self).__setitem__(key, value)
         return ret
 
+    @staticmethod
+    def _equalize_stacks(states:List['TreeDecoderState']):
+        """ Pads the grammar automaton stacks of given states to the same depth capacity. """
+        if not all(["_parent_stack" in state for state in states]):
+            return
+        size = max([state._parent_stack.size(1) for state in states])
+        for state in states:
+            if state._parent_stack.size(1) < size:
+                state.set(_parent_stack=_pad_to_size(state._parent_stack, (size,)),
+                          _child_count_stack=_pad_to_size(state._child_count_stack, (size + 1,)))
+
+    @property
+    def followed_actions(self):
+        return self._followed_actions.filled()
+
+    @property
+    def stored_attentions(self):
+        return self._stored_attentions.filled() if "_stored_attentions" in self else None
+
+    def store_attention(self, alphas:torch.Tensor):
+        """ Appends given (batsize, inplen) attention weights to the attention history of this state. """
+        if "_stored_attentions" not in self:
+            self.set(_stored_attentions=HistoryState(len(self), self.maxtime, alphas.size(1),
+                                                     dtype=alphas.dtype, device=alphas.device))
+        self._stored_attentions.append(alphas)
+
     # DecodableState API implementation
     def is_terminated(self):
         return self._is_terminated
@@ -608,6 +930,40 @@ class TreeDecoderState(TrainableDecodableState):
         qe = self.query_vocab
         self.set(prev_actions=torch.tensor([qe[qe.starttoken] for _ in self.inp_strings],
                                                    device=self.inp_tensor.device, dtype=torch.long))
+        self._followed_actions = HistoryState(len(self), self.maxtime, dtype=torch.long, device=self.inp_tensor.device)
+        if self.token_specs is not None:
+            if self.grammar_table is None:
+                self.grammar_table = TreeGrammarTable(self.token_specs, qe, pushtoken=self.pushtoken,
+                                                      reducetoken=self.reducetoken, endtoken=self.endtoken)
+            # grammar automaton: stack of parent token ids (-1 if not decoded yet) and stack of child counts
+            device = self.inp_tensor.device
+            self.set(_depth=torch.zeros(len(self), dtype=torch.long, device=device),
+                     _parent_stack=torch.full((len(self), self.maxtime), -1, dtype=torch.long, device=device),
+                     _child_count_stack=torch.zeros(len(self), self.maxtime + 1, dtype=torch.long, device=device))
+
+    def _update_automaton(self, tokens:torch.Tensor, active:torch.Tensor):
+        """ Updates the grammar automaton stacks with the given (batsize,) tokens for the active rows. """
+        table = self.grammar_table
+        depth = self._own("_depth")
+        if int(depth.max()) + 1 >= self._parent_stack.size(1):     # grow stacks
+            size = self._parent_stack.size(1) * 2
+            self.set(_parent_stack=_pad_to_size(self._parent_stack, (size,)),
+                     _child_count_stack=_pad_to_size(self._child_count_stack, (size + 1,)))
+        parents, child_counts = self._own("_parent_stack"), self._own("_child_count_stack")
+        rows = torch.arange(len(self), device=depth.device)
+        push = active & (tokens == table.push_id)
+        reduce = active & (tokens == table.reduce_id) & (depth > 0)
+        other = active & (tokens != table.push_id) & (tokens != table.reduce_id)
+        # push: open a new level whose parent is not known yet
+        depth += push.long()
+        child_counts[rows[push], depth[push]] = -1
+        parents[rows[push], depth[push] - 1] = -1
+        # reduce: close current level and count it as a child of the level above
+        depth -= reduce.long()
+        # any other token is a child of the current level and the parent if it is the first token after a push
+        child_counts[rows, depth] += (reduce | other).long()
+        newparent = other & (depth > 0) & (parents[rows, (depth - 1).clamp_min(0)] == -1)
+        parents[rows[newparent], depth[newparent] - 1] = tokens[newparent]
 
     def step(self, tokens:Union[torch.Tensor, np.ndarray, List[Union[str, np.ndarray, torch.Tensor]]]):
         qe = self.query_vocab
@@ -623,7 +979,7 @@ class TreeDecoderState(TrainableDecodableState):
         if isinstance(tokens, list):
             for i, token in enumerate(tokens):
                 if isinstance(token, str):
-                    tokens_np[i] = qe.vocab[token]
+                    tokens_np[i] = qe[token]
                 elif isinstance(token, np.ndarray):
                     assert(token.shape == (1,))
                     tokens_np[i] = token[0]
@@ -638,15 +994,17 @@ class TreeDecoderState(TrainableDecodableState):
 
         mask = torch.tensor(self._is_terminated).to(self.prev_actions.device)
         self.prev_actions = self.prev_actions * (mask).long() + tokens_pt * (~mask).long()
-        self._timesteps[~self._is_terminated] = self._timesteps[~self._is_terminated] + 1
+        self._own("_timesteps")[~self._is_terminated] = self._timesteps[~self._is_terminated] + 1
 
         # for i, token in enumerate(tokens_str):
         #     if not self.is_terminated()[i]:
         #         self.followed_actions_str[i] = self.followed_actions_str[i] + [token]
 
-        self.followed_actions = torch.cat([self.followed_actions, tokens_pt[:, None]], 1)
-        token_strs = [self.query_vocab(tokenid) for tokenid in tokens_np]
-        for followed_tokens_i, token_str in zip(self.followed_tokens, token_strs):
+        self._followed_actions.append(tokens_pt)
+        if "_depth" in self:
+            self._update_automaton(tokens_pt.to(self._depth.device), ~mask.to(self._depth.device))
+        token_strs = self.query_vocab.tokens(tokens_np)
+        for followed_tokens_i, token_str in zip(self._own("followed_tokens"), token_strs):
             followed_tokens_i.append(token_str)
 
         # self._is_terminated |= tokens_str == self.endtoken
@@ -668,46 +1026,23 @@ class TreeDecoderState(TrainableDecodableState):
         #                 child_count[-1] = token_spec
 
     def get_out_mask(self, device=torch.device("cpu")):
-        rets = []
-        for history in self.followed_tokens:
-            if len(history) == 0:
-                ret = {"("}
-            elif history[-1] in ("@END@", "@PAD@"):
-                ret = {"@PAD@"}
-            else:
-                child_counts = [0]
-                ancestors = []
-                for t in history:
-                    if t == self.pushtoken:
-                        child_counts.append(-1)
-                        ancestors.append(None)
-                    elif t == self.reducetoken:
-                        child_counts.pop(-1)
-                        ancestors.pop(-1)
-                        child_counts[-1] += 1
-                    else:
-                        child_counts[-1] += 1
-                        if len(ancestors) > 0 and ancestors[-1] is None:
-                            ancestors[-1] = t
-                ret = {self.reducetoken, self.pushtoken}
-                if len(ancestors) == 0:
-                    ret = {"@END@"}
-                elif child_counts[-1] == -1:
-                    ret |= self.token_groups["nonleaf"]
-                    ret -= {self.pushtoken}
-                else:
-                    ret |= self.token_groups["leaf"]
-                if len(ancestors) > 0 and ancestors[-1] in self.token_specs:
-                    parent_min_children, parent_max_children = self.token_specs[ancestors[-1]]
-                    if child_counts[-1] == parent_max_children:
-                        ret = {self.reducetoken}
-                    elif child_counts[-1] < parent_min_children:
-                        ret -= {self.reducetoken}
-            ret_ = torch.zeros(self.query_vocab.number_of_ids(), device=device)
-            for ret_i in ret:
-                ret_[self.query_vocab[ret_i]] = 1
-            rets.append(ret_)
-        return torch.stack(rets, 0)
+        """
+        Returns a (batsize, vocsize) float mask of the tokens that are allowed next according to token_specs.
+        Looks up one precomputed row per example using the grammar automaton state maintained by .step().
+        """
+        table = self.grammar_table.to(self._depth.device)
+        depth = self._depth
+        rows = torch.arange(len(self), device=depth.device)
+        parents = self._parent_stack[rows, (depth - 1).clamp_min(0)]
+        child_counts = self._child_count_stack[rows, depth]
+        ids = table.get_rows(parents, child_counts)
+        ids = torch.where(depth == 0, torch.full_like(ids, table.ROOT), ids)
+        prev = self.prev_actions.to(depth.device)
+        ended = (prev == table.end_id) | (prev == table.pad_id)
+        ids = torch.where(ended, torch.full_like(ids, table.ENDED), ids)
+        started = (self._followed_actions.lens > 0).to(depth.device)
+        ids = torch.where(started, ids, torch.full_like(ids, table.START))
+        return table.masks[ids].to(device)
 
     def get_gold(self, i:int=None):
         if i is None:
@@ -5,7 +5,16 @@ import torch
 from parseq.states import State, ListState
 
 
-class TransitionModel(torch.nn.Module): pass
+class TransitionModel(torch.nn.Module):
+    def supports_forward_sequence(self, *args, **kw) -> bool:
+        """
+        Whether the model has a .forward_sequence() that can be used for the given arguments in the current mode.
+        Checked before any work is done for .forward_sequence(), which is only called when this returns True.
+        .forward_sequence() is a parallel version of .forward() over a whole sequence of known inputs (teacher forcing).
+        Decoder transition models take (x:State, prev_actions:(batsize, T) tensor) and return (batsize, T, V) outputs and x.
+        prev_actions[:, t] is what x.prev_actions was at step t and x has already been stepped through all T steps.
+        """
+        return False
 
 
 class LSTMState(State): pass
@@ -79,6 +88,25 @@ class LSTMTransition(TransitionModel):
         state.c = c_n.transpose(0, 1)
         return out, state
 
+    def supports_forward_sequence(self, *args, **kw) -> bool:
+        return not (self.dropout_rec.p > 0 and self.training)
+
+    def forward_sequence(self, inp:torch.Tensor, state:State):
+        """
+        Runs the LSTM over all timesteps at once.
+        :param inp:     (batsize, seqlen, indim)
+        :param state:   State with .h, .c of shape (numlayers, batsize, hdim)
+        :return:        (batsize, seqlen, hdim) outputs and updated state
+        """
+        assert(self.supports_forward_sequence())      # no recurrent dropout over sequences in training
+        _x = self.dropout(inp)
+        h_nm1 = ((state.h * state.h_dropout) if self.dropout_rec.p > 0 else state.h).transpose(0, 1)
+        c_nm1 = ((state.c * state.c_dropout) if self.dropout_rec.p > 0 else state.c).transpose(0, 1)
+        out, (h_n, c_n) = self.cell(_x, (h_nm1.contiguous(), c_nm1.contiguous()))
+        state.h = h_n.transpose(0, 1)
+        state.c = c_n.transpose(0, 1)
+        return out, state
+
 
 class LSTMCellTransition(TransitionModel):
     def __init__(self, *cells:torch.nn.LSTMCell, dropout:float=0., **kw):
@@ -108,3 +136,25 @@ class LSTMCellTransition(TransitionModel):
             state.h = x
             state.c = c
         return x, states
+
+    def supports_forward_sequence(self, *args, **kw) -> bool:
+        return not (self.dropout_rec.p > 0 and self.training)
+
+    def forward_sequence(self, inp:torch.Tensor, states:MultiLSTMState):
+        """
+        Runs every cell over all timesteps at once.
+        :param inp:     (batsize, seqlen, indim)
+        :return:        (batsize, seqlen, hdim) outputs of the last cell and updated states
+        """
+        assert(self.supports_forward_sequence())      # no recurrent dropout over sequences in training
+        x = inp
+        for i in range(len(self.cells)):
+            _x = self.dropout(x)
+            state, cell = states.get(i), self.cells[i]
+            h, c = state.h * state.h_dropout, state.c * state.c_dropout
+            params = [cell.weight_ih, cell.weight_hh] + ([cell.bias_ih, cell.bias_hh] if cell.bias else [])
+            x, h_n, c_n = torch.lstm(_x, (h[None].contiguous(), c[None].contiguous()), params,
+                                     cell.bias, 1, 0., self.training, False, True)
+            state.h = h_n[0]
+            state.c = c_n[0]
+        return x, states
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from typing import Union, Callable, List, Dict
 import numpy as np
 
@@ -30,10 +31,21 @@ class Vocab(_Vocab):
         self.rare_ids = set()
         self.RD = {v: k for k, v in self.D.items()}
         self.growing = True
+        self._size, self._id2token = None, None
 
     def set_dict(self, D):
         self.D = D
         self.RD = {v: k for k, v in self.D.items()}
+        self._size, self._id2token = None, None
+        if not self.growing:
+            self._freeze()
+
+    def _freeze(self):
+        """ Caches the number of ids and an id -> token object array (unused ids map to None). """
+        self._size = max(self.D.values()) + 1
+        self._id2token = np.full(self._size, None, dtype=object)
+        for k, v in self.D.items():
+            self._id2token[v] = k
 
     def nextid(self):
         return max(self.D.values()) + 1
@@ -85,6 +97,7 @@ class Vocab(_Vocab):
         self.RD = {v: k for k, v in self.D.items()}
         if keep_tokens is not None:
             self.rare_ids = set([self[rare_token] for rare_token in self.rare_tokens])
+        self._freeze()
 
     def add_token(self, token, seen: Union[int, bool] = True):
         assert (self.growing)
@@ -105,6 +118,8 @@ class Vocab(_Vocab):
 
     def number_of_ids(self, exclude_rare=False):
         if not exclude_rare:
+            if self._size is not None:
+                return self._size
             return max(self.D.values()) + 1
         else:
             return max(set(self.D.values()) - self.rare_ids) + 1
@@ -123,25 +138,51 @@ class Vocab(_Vocab):
         else:
             raise Exception("illegal argument")
 
-    def tostr(self, x: Union[np.ndarray, torch.Tensor], return_tokens=False):
+    def ids(self, x) -> np.ndarray:
         """
-        :param x:   2D LongTensor or array
-        :param return_tokens:
-        :return:
+        Maps tokens to ids in one pass (unknown tokens map to the unk id).
+        :param x:   list or array of tokens (can be nested, but not ragged)
+        :return:    int64 array of ids of the same shape as x
         """
+        x = np.asarray(x, dtype=object)
+        D, unkid = self.D, self[self.unktoken]
+        ret = np.fromiter((D.get(token, unkid) for token in x.ravel()), dtype="int64", count=x.size)
+        return ret.reshape(x.shape)
+
+    def tokens(self, x: Union[np.ndarray, torch.Tensor]) -> np.ndarray:
+        """ Maps an array of ids (any shape) to an object array of tokens of the same shape. """
         if isinstance(x, torch.Tensor):
             x = x.detach().cpu().numpy()
-        x = list(np.vectorize(lambda e: self(e))(x))
-        x = [e for e in x if e != self.padtoken]
-        ret = []
-        for xe in x:
-            if len(ret) > 0 and ret[-1] == self.endtoken:
-                break
-            ret.append(xe)
-        if return_tokens:
-            return ret
-        else:
-            return " ".join(ret)
+        x = np.asarray(x)
+        if self._id2token is not None:
+            return self._id2token[x]
+        ret = np.empty(x.shape, dtype=object)
+        ret.ravel()[:] = [self.RD[e] for e in x.ravel().tolist()]
+        return ret
+
+    def tostr(self, x: Union[np.ndarray, torch.Tensor], return_tokens=False):
+        """
+        :param x:   1D or 2D LongTensor or array
+        :param return_tokens:
+        :return:    string (or list of tokens) for 1D x, list of strings (or token lists) for 2D x.
+                    Padding is dropped and everything after the first end token is cut off.
+        """
+        x = self.tokens(x)
+        if x.ndim == 1:
+            return self._tostr(x[None], return_tokens=return_tokens)[0]
+        return self._tostr(x, return_tokens=return_tokens)
+
+    def _tostr(self, x: np.ndarray, return_tokens=False):
+        if x.shape[1] == 0:
+            return [[] if return_tokens else "" for _ in range(x.shape[0])]
+        isend = x == self.endtoken
+        ends = np.where(isend.any(1), isend.argmax(1) + 1, x.shape[1])
+        keep = x != self.padtoken
+        rets = []
+        for i in range(x.shape[0]):
+            ret = x[i, :ends[i]][keep[i, :ends[i]]].tolist()
+            rets.append(ret if return_tokens else " ".join(ret))
+        return rets
 
 
 class FixedVocab(Vocab):
@@ -185,17 +226,46 @@ class VocabBuilder(ABC):
 
 class SequenceEncoder(VocabBuilder):
     def __init__(self, tokenizer: Callable[[str], List[str]], vocab: Vocab = None,
-                 add_start_token=False, add_end_token=False, **kw):
+                 add_start_token=False, add_end_token=False, cache_size: int = 0, **kw):
+        """
+        :param cache_size:  if > 0, tokenizer outputs for up to this many input strings are memoized (least recently used are dropped)
+        """
         super(SequenceEncoder, self).__init__(**kw)
         self.tokenizer = tokenizer
         self.vocab = vocab if vocab is not None else Vocab()
         self.vocab_final = False
         self.add_start_token = add_start_token
         self.add_end_token = add_end_token
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.cache_hits, self.cache_misses = 0, 0
+
+    def tokenize(self, x: str) -> List[str]:
+        """ Returns a new list of tokens for x, using the tokenizer cache if enabled. """
+        if self.cache_size <= 0 or not isinstance(x, str):
+            return self.tokenizer(x)
+        if x in self._cache:
+            self.cache_hits += 1
+            self._cache.move_to_end(x)
+            return list(self._cache[x])
+        self.cache_misses += 1
+        tokens = self.tokenizer(x)
+        self._cache[x] = tuple(tokens)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return list(tokens)
+
+    def cache_info(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses,
+                "size": len(self._cache), "maxsize": self.cache_size}
+
+    def clear_cache(self):
+        self._cache = OrderedDict()
+        self.cache_hits, self.cache_misses = 0, 0
 
     def inc_build_vocab(self, x: str, seen: bool = True):
         if not self.vocab_final:
-            tokens = self.tokenizer(x) + []
+            tokens = self.tokenize(x) + []
             if self.add_end_token:
                 tokens.append(self.vocab.endtoken)
             for token in tokens:
@@ -228,7 +298,7 @@ class SequenceEncoder(VocabBuilder):
                 and (x == [] or isinstance(x[0], str)):
             tokens = x
         else:
-            tokens = self.tokenizer(x)
+            tokens = self.tokenize(x)
         if add_start_token and tokens[0] != self.vocab.starttoken:
             tokens.insert(0, self.vocab.starttoken)
         if add_end_token and tokens[-1] != self.vocab.endtoken:
@@ -250,6 +320,32 @@ class SequenceEncoder(VocabBuilder):
             ret = ret[0]
         return ret
 
+    def convert_batch(self, xs: List[Union[str, List[str]]], add_start_token: bool = None, add_end_token: bool = None):
+        """
+        Converts a batch of strings (or token lists) at once.
+        :return:    (batsize, maxlen) LongTensor of ids padded with the pad id, (batsize,) LongTensor of lengths and list of token lists
+        """
+        add_start_token = self.add_start_token if add_start_token is None else add_start_token
+        add_end_token = self.add_end_token if add_end_token is None else add_end_token
+        starttoken, endtoken = self.vocab.starttoken, self.vocab.endtoken
+        tokenses = []
+        for x in xs:
+            if isinstance(x, list) and not isinstance(x, Tree) and (x == [] or isinstance(x[0], str)):
+                tokens = x
+            else:
+                tokens = self.tokenize(x)
+            if add_start_token and tokens[0] != starttoken:
+                tokens.insert(0, starttoken)
+            if add_end_token and tokens[-1] != endtoken:
+                tokens.append(endtoken)
+            tokenses.append(tokens)
+
+        lens = np.asarray([len(tokens) for tokens in tokenses], dtype="int64")
+        ids = np.full((len(tokenses), lens.max(initial=0)), self.vocab[self.vocab.padtoken], dtype="int64")
+        ids[np.arange(ids.shape[1])[None, :] < lens[:, None]] = \
+            self.vocab.ids([token for tokens in tokenses for token in tokens])
+        return torch.tensor(ids), torch.tensor(lens), tokenses
+
 
 class FuncQueryEncoder(VocabBuilder):
     def __init__(self, grammar: FuncGrammar = None, vocab_tokens: Vocab = None,
@@ -270,28 +366,49 @@ class FuncQueryEncoder(VocabBuilder):
 
         self.format = format
 
-        # prebuild valid action masks
-        self._valid_action_mask_by_type = {}
+        # valid action masks, built in finalize_vocab(): one row of bits over the action vocab per grammar type
+        self.type_ids = {}      # grammar type -> row in valid action bitset (row 0: unknown type, only none action)
+        self._valid_action_bits = None      # (num_types, ceil(num_actions / 8)) uint8, little-endian bit order
+        self._valid_action_bits_on = {}     # device -> copy of bitset on that device
 
     def prebuild_valid_action_masks(self):
+        numactions = self.vocab_actions.number_of_ids()
+        self.type_ids = {}
+        masks = [np.zeros(numactions, dtype=bool)]
+        masks[0][self.vocab_actions[self.none_action]] = True
         for typestr, rules in self.grammar.rules_by_type.items():
-            action_mask = torch.zeros(self.vocab_actions.number_of_ids(), dtype=torch.uint8)
-            for rule in rules:
-                action_mask[self.vocab_actions[rule]] = 1
+            action_mask = np.zeros(numactions, dtype=bool)
             if typestr[-1] in "*+":
-                rules = self.grammar.rules_by_type[typestr[:-1]]
-                for rule in rules:
-                    action_mask[self.vocab_actions[rule]] = 1
-            self._valid_action_mask_by_type[typestr] = action_mask
-        # self._valid_action_mask_by_type["_@unk@_"] = torch.tensor(self.vocab_actions.number_of_ids(), dtype=torch.uint8)
+                rules = rules | self.grammar.rules_by_type.get(typestr[:-1], set())
+            action_mask[[self.vocab_actions[rule] for rule in rules]] = True
+            self.type_ids[typestr] = len(masks)
+            masks.append(action_mask)
+        self._valid_action_bits = torch.tensor(np.packbits(np.stack(masks, 0), axis=1, bitorder="little"))
+        self._valid_action_bits_on = {}
+
+    def get_type_ids(self, types: List[str]) -> torch.Tensor:
+        """ Rows in the valid action table for the given grammar types (unknown types map to row 0). """
+        return torch.tensor([self.type_ids.get(typ, 0) for typ in types], dtype=torch.long)
+
+    def get_valid_actions(self, type_ids: torch.Tensor, device=None) -> torch.Tensor:
+        """
+        :param type_ids:    LongTensor (any shape) of rows in the valid action table (see get_type_ids())
+        :param device:      device to build the mask on, default: device of type_ids
+        :return:            BoolTensor of shape type_ids.shape + (number of actions,)
+        """
+        device = type_ids.device if device is None else torch.device(device)
+        if device not in self._valid_action_bits_on:
+            self._valid_action_bits_on[device] = self._valid_action_bits.to(device)
+        # unpack only the distinct rows, then expand
+        uniq_ids, inverse = torch.unique(type_ids.to(device), return_inverse=True)
+        bits = self._valid_action_bits_on[device][uniq_ids]
+        shifts = torch.arange(8, dtype=torch.uint8, device=device)
+        ret = ((bits.unsqueeze(-1) >> shifts) & 1).view(len(uniq_ids), -1)
+        ret = ret[:, :self.vocab_actions.number_of_ids()].bool()
+        return ret[inverse]
 
     def get_action_mask_for(self, typ: str):
-        if typ in self._valid_action_mask_by_type:
-            return self._valid_action_mask_by_type[typ]
-        else:
-            ret = torch.zeros(self.vocab_actions.number_of_ids(), dtype=torch.uint8)
-            ret[self.vocab_actions[self.none_action]] = 1
-            return ret
+        return self.get_valid_actions(self.get_type_ids([typ]))[0].to(torch.uint8)
 
     def vocabs_finalized(self):
         return self.vocab_final
@@ -315,12 +432,9 @@ class FuncQueryEncoder(VocabBuilder):
         for out_type, rules in self.grammar.rules_by_type.items():
             self._add_to_vocabs(rules, seen=False)
 
-        self.vocab_tokens.stopgrowth()
-        self.vocab_actions.stopgrowth()
-
         self.vocab_final = True
-        self.vocab_tokens.do_rare(min_freq=min_freq, top_k=top_k)
-        self.vocab_actions.do_rare(min_freq=min_freq, top_k=top_k)
+        self.vocab_tokens.finalize(min_freq=min_freq, top_k=top_k)
+        self.vocab_actions.finalize(min_freq=min_freq, top_k=top_k)
 
         self.prebuild_valid_action_masks()
 
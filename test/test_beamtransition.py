@@ -0,0 +1,84 @@
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from parseq.decoding import BeamTransition
+
+
+def select_by_sort(actionprobs, bscores, is_term):
+    """ Beam candidate selection as it was done before the single topk, with two full sorts. """
+    batsize, beamsize = bscores.size()
+    logprobs, actionids = torch.sort(actionprobs, 1, descending=True)
+    scores = logprobs[:, :beamsize].clone()
+    scores[is_term, 0] = 0
+    scores[is_term, 1:] = -np.infty
+    scoreses = scores.reshape(batsize, beamsize * beamsize) + bscores.repeat_interleave(beamsize, 1)
+    actionidses = actionids[:, :beamsize].reshape(batsize, beamsize * beamsize)
+    scores, selection_ids = torch.sort(scoreses, 1, descending=True)
+    scores, selection_ids = scores[:, :beamsize], selection_ids[:, :beamsize]
+    return scores, torch.div(selection_ids, beamsize, rounding_mode="floor"), actionidses.gather(1, selection_ids)
+
+
+class TestBeamTransitionSelect(TestCase):
+    def candidates(self, scores, stateids, actionids, is_term, beamsize):
+        """ Sets of (beam element, action) of the selected finite-score candidates for every example.
+            Terminated beam elements are continued with padding whatever action is selected for them
+            (ties between their best actions are broken differently by sort and topk). """
+        ret = []
+        for i in range(scores.size(0)):
+            cands = set()
+            for score, stateid, actionid in zip(scores[i].tolist(), stateids[i].tolist(), actionids[i].tolist()):
+                if score > -np.infty:
+                    cands.add((stateid, 0 if is_term[i * beamsize + stateid] else actionid))
+            ret.append(cands)
+        return ret
+
+    def check(self, actionprobs, bscores, is_term, boundary_ties=()):
+        """ :param boundary_ties:   examples where candidates tie at the beam boundary, so which ones are selected is arbitrary """
+        beamsize = bscores.size(1)
+        bt = BeamTransition(None, beamsize=beamsize)
+        scores, stateids, actionids = bt.select(actionprobs, bscores, is_term)
+        rscores, rstateids, ractionids = select_by_sort(actionprobs, bscores, is_term)
+        print(scores)
+        print(rscores)
+        self.assertTrue(torch.equal(scores, rscores))
+        cands = self.candidates(scores, stateids, actionids, is_term, beamsize)
+        rcands = self.candidates(rscores, rstateids, ractionids, is_term, beamsize)
+        for i in range(len(cands)):
+            if i not in boundary_ties:
+                self.assertEqual(cands[i], rcands[i])
+            self.assertEqual(len(cands[i]), (scores[i] > -np.infty).sum().item())     # no candidate twice
+        return scores, stateids, actionids
+
+    def test_same_as_sort(self):
+        torch.manual_seed(1234)
+        batsize, beamsize, vocsize = 6, 4, 11
+        actionprobs = torch.log_softmax(torch.randn(batsize * beamsize, vocsize), -1)
+        bscores = torch.randn(batsize, beamsize)
+        is_term = torch.zeros(batsize * beamsize, dtype=torch.bool)
+        is_term[[1, 4, 5, 6, 7, 13]] = True        # example 1 is completely terminated
+        _, stateids, actionids = self.check(actionprobs, bscores, is_term)
+        # terminated beam elements are continued with their best action, as before the single topk
+        rows = torch.arange(batsize)[:, None] * beamsize + stateids
+        self.assertTrue(torch.equal(actionids[is_term[rows]], actionprobs.argmax(1)[rows][is_term[rows]]))
+
+    def test_ties(self):
+        batsize, beamsize, vocsize = 3, 3, 8
+        # example 0: everything ties, example 1: exactly beamsize candidates tie at the top,
+        # example 2: ties between a terminated element and continuations of another one
+        actionprobs = torch.full((batsize * beamsize, vocsize), -np.log(vocsize))
+        actionprobs[3:6] = -5.
+        actionprobs[3, [2, 5]] = -1.
+        actionprobs[4, 1] = -1.
+        actionprobs[6:9] = torch.log_softmax(torch.tensor([0., 1., 2., 3., 3., 2., 1., 0.]), -1)
+        bscores = torch.zeros(batsize, beamsize)
+        bscores[2, 0] = actionprobs[7, 3]
+        bscores[2, 2] = -10.
+        is_term = torch.zeros(batsize * beamsize, dtype=torch.bool)
+        is_term[6] = True
+        scores, stateids, actionids = self.check(actionprobs, bscores, is_term, boundary_ties=(0,))
+        self.assertTrue(torch.all(scores[0] == -np.log(vocsize)))
+        self.assertEqual(self.candidates(scores, stateids, actionids, is_term, beamsize)[1], {(0, 2), (0, 5), (1, 1)})
+        self.assertTrue(torch.all(scores[2] == actionprobs[7, 3]))
+        self.assertEqual(self.candidates(scores, stateids, actionids, is_term, beamsize)[2], {(0, 0), (1, 3), (1, 4)})
@@ -0,0 +1,346 @@
+from unittest import TestCase
+
+import torch
+
+from parseq.datasets import Dataset, FilteredDataset, MappedDataset
+
+
+class TestDataset(TestCase):
+    def get_ds(self):
+        return Dataset([(str(i), i, "train" if i % 3 else "test") for i in range(30)])
+
+    def test_filter_view(self):
+        ds = self.get_ds()
+        calls = []
+        def pred(x):
+            calls.append(x)
+            return x[2] == "test"
+        testds = ds.filter(pred)
+        self.assertTrue(isinstance(testds, FilteredDataset))
+        self.assertEqual(len(calls), 30)    # evaluated when filtering
+        print(testds.examples)
+        self.assertEqual(len(testds), 10)
+        self.assertEqual(len(calls), 30)
+        self.assertEqual(testds[1], ("3", 3, "test"))
+        self.assertEqual(len(calls), 30)    # evaluated once
+        self.assertEqual(testds[1:3], [("3", 3, "test"), ("6", 6, "test")])
+        sub = testds[lambda x: x[1] > 10]
+        self.assertEqual([x[1] for x in sub.examples], [12, 15, 18, 21, 24, 27])
+        self.assertTrue(sub.rootds is sub)     # a filtered dataset is its own root
+        self.assertTrue(sub.baseds.baseds is ds)
+        self.assertEqual(len(ds[(None, None, "train")]), 20)
+        self.assertEqual(len(Dataset([{"a": 1}, {"a": 2}])[{"a": 2}]), 1)
+
+    def test_filter_closure(self):
+        # filters see the values of the variables they close over at the time of filtering
+        ds = Dataset([(str(i), i, "abc"[i % 3]) for i in range(30)])
+        filtered = {}
+        for domain in "abc":
+            filtered[domain] = ds[lambda x: x[2] == domain].map(lambda x: x[2], passthrough=[2])
+        for domain in "abc":
+            print(domain, set(filtered[domain].examples))
+            self.assertEqual(set(filtered[domain].examples), {domain})
+        mds = ds.map(lambda x: x, passthrough=[0, 1, 2])
+        filtered = [mds[lambda x: x[1] == i] for i in range(3)]
+        self.assertEqual([fds[0][1] for fds in filtered], [0, 1, 2])
+
+    def test_pushdown_and_fusion(self):
+        ds = self.get_ds()
+        calls = []
+        def f(x):
+            calls.append(x)
+            return (x[0], x[1] * 10, x[2])
+        mds = ds.map(f, passthrough={0: 0, 2: 2})
+        testds = mds[lambda x: x[2] == "test"]
+        self.assertEqual(len(testds), 10)
+        self.assertEqual(len(calls), 0)     # only looks at a passthrough field
+        self.assertEqual(len(mds[(None, None, "train")]), 20)
+        self.assertEqual(len(calls), 0)
+        self.assertEqual(testds[1], ("3", 30, "test"))
+        self.assertEqual(len(calls), 1)
+        del calls[:]
+        bigds = mds[lambda x: x[1] > 100]   # not passed through: maps
+        self.assertEqual(len(bigds), 19)
+        self.assertEqual(len(calls), 30)
+
+        # without passthrough: same results
+        mds2 = ds.map(f)
+        self.assertEqual(mds2[lambda x: x[2] == "test"].examples, testds.examples)
+
+        # fused maps
+        mmds = mds.map(lambda x: x + ("x",), passthrough=[0, 1, 2]).map(lambda x: x[1:], passthrough={1: 2})
+        self.assertTrue(isinstance(mmds, MappedDataset))
+        self.assertEqual(mmds.baseds, ds)
+        self.assertEqual(len(mmds.f.fs), 3)
+        self.assertEqual(mmds.passthrough, {1: 2})
+        print(mmds[lambda x: x[1] == "test"].examples)
+        del calls[:]
+        self.assertEqual(mmds[lambda x: x[1] == "test"][0], (0, "test", "x"))
+        self.assertEqual(len(calls), 1)
+
+        # cached maps are not fused
+        cds = ds.map(f).cache()
+        self.assertEqual(cds.map(lambda x: x).baseds, cds)
+
+    def test_materialize(self):
+        ds = self.get_ds().map(lambda x: (x[0], x[1] * 10, x[2]), passthrough=[0, 2])[lambda x: x[2] == "test"]
+        for workers in [0, 1, 3]:
+            mds = ds.materialize(workers=workers)
+            self.assertTrue(isinstance(mds, Dataset))
+            self.assertEqual(mds.examples, ds.examples)
+            self.assertEqual(mds._examples, ds.examples)
+
+
+class TestExampleCache(TestCase):
+    def test_lru(self):
+        from parseq.datasets import ExampleCache
+        c = ExampleCache(maxsize=3)
+        for i in range(4):
+            self.assertFalse(i in c)
+            c[i] = str(i)
+        self.assertFalse(0 in c)
+        self.assertEqual(c[1], "1")     # 1 is now most recently used
+        c[4] = "4"
+        self.assertFalse(2 in c)
+        self.assertTrue(1 in c)
+        print(c.info())
+        self.assertEqual(c.info()["hits"], 1)
+        self.assertEqual(c.info()["misses"], 5)
+        self.assertEqual(c.info()["evictions"], 2)
+        self.assertEqual(len(c), 3)
+
+        c = ExampleCache(maxbytes=10000)
+        for i in range(100):
+            c[i] = torch.zeros(100)
+        self.assertTrue(c.nbytes <= 10000)
+        self.assertTrue(0 < len(c) < 100)
+
+    def test_spill(self):
+        import os
+        import numpy as np
+        ds = Dataset([(str(i), torch.arange(i), np.ones((2, i)), {"a": [i, "x"]}) for i in range(50)])
+        calls = []
+        def f(x):
+            calls.append(x)
+            return x
+        m = ds.map(f).cache(maxsize=5, spill=True)
+        a = [m[i] for i in range(50)]
+        b = [m[i] for i in range(50)]
+        print(m.cache_info())
+        self.assertEqual(len(calls), 50)
+        self.assertEqual(m.cache_info()["spilled"], 50)
+        self.assertEqual(m.cache_info()["spill_hits"], 50)
+        for x, y in zip(a, b):
+            self.assertEqual(x[0], y[0])
+            self.assertTrue(isinstance(y[1], torch.Tensor))
+            self.assertTrue(torch.equal(x[1], y[1]))
+            self.assertTrue(np.array_equal(x[2], y[2]))
+            self.assertEqual(x[3], y[3])
+        path = m._examples_cache.spillstore.path
+        self.assertTrue(os.path.isdir(path))
+        m.clear_cache()
+        self.assertEqual(m.cache_info()["spilled"], 0)
+        self.assertEqual(len([fp for fp in os.listdir(path) if fp.startswith("spill-")]), 0)
+
+    def test_spill_shared_dir(self):
+        import os
+        import tempfile
+        path = tempfile.mkdtemp()
+        ds = Dataset([(torch.arange(i),) for i in range(20)])
+        m1 = ds.map(lambda x: x).cache(maxsize=2, spill=path)
+        m2 = ds.map(lambda x: (x[0] + 1,)).cache(maxsize=2, spill=path)
+        for i in range(20):
+            m1[i], m2[i]
+        with open(os.path.join(path, "spill-other.bin"), "wb") as f:
+            f.write(b"x")
+        self.assertEqual(len(os.listdir(path)), 3)
+        m1.clear_cache()
+        print(os.listdir(path))
+        self.assertEqual(len(os.listdir(path)), 2)
+        self.assertTrue(torch.equal(m2[3][0], torch.arange(3) + 1))
+        m2.clear_cache()
+        self.assertEqual(os.listdir(path), ["spill-other.bin"])
+
+    def test_dataloader_workers(self):
+        from torch.utils.data import DataLoader
+        ds = Dataset([(torch.arange(i % 7 + 1) + i,) for i in range(100)])
+        m = ds.map(lambda x: (x[0] * 2,)).cache(maxsize=8, spill=True)
+        for i in range(50):
+            m[i]                # spilled in the main process, read by the workers
+        for epoch in range(2):
+            xs = [x[0] for x, in DataLoader(m, batch_size=1, num_workers=2)]
+            for i, x in enumerate(xs):
+                self.assertTrue(torch.equal(x, (torch.arange(i % 7 + 1) + i) * 2))
+
+
+class TestPCFGDataset(TestCase):
+    def get_pcfg(self):
+        import nltk
+        return nltk.PCFG.fromstring("""
+            S -> NT [1.0]
+            NT -> 'f' NT NT [0.3] | 'x' [0.7]
+        """)
+
+    def test_alias_table(self):
+        import numpy as np
+        from parseq.datasets import build_alias_table
+        probs = [0.1, 0.5, 0.05, 0.35]
+        prob, alias = build_alias_table(probs)
+        # exact probabilities implied by the table
+        implied = np.zeros(4)
+        for i in range(4):
+            implied[i] += prob[i] / 4
+            implied[alias[i]] += (1 - prob[i]) / 4
+        print(implied)
+        self.assertTrue(np.allclose(implied, probs))
+
+    def test_distribution(self):
+        import numpy as np
+        from collections import Counter
+        from parseq.datasets import PCFGDataset
+        # with maxlen=8, only (x) and (f x x) fit: every expansion of NT is sampled again until it fits,
+        # so P(x) = q with q = 0.7 / (0.7 + 0.3 * q^2)
+        q = [z.real for z in np.roots([0.3, 0, 0.7, -0.7]) if abs(z.imag) < 1e-9][0]
+        ds = PCFGDataset(self.get_pcfg(), N=2000, seed=3, maxlen=8)
+        xs = ds.generate_many(20000, seed=1)
+        counts = Counter([str(x) for x in xs])
+        print(q, counts)
+        self.assertEqual(set(counts.keys()), {"(x )", "(f (x ) (x ))"})
+        self.assertAlmostEqual(counts["(x )"] / 20000, q, delta=0.01)
+        counts = Counter([str(ds[i]) for i in range(2000)])
+        self.assertAlmostEqual(counts["(x )"] / 2000, q, delta=0.03)
+        counts = Counter([str(ds.generate_recursive(rng=np.random.RandomState(i))) for i in range(2000)])
+        self.assertAlmostEqual(counts["(x )"] / 2000, q, delta=0.03)
+
+    def test_deterministic(self):
+        from parseq.datasets import PCFGDataset
+        ds = PCFGDataset(self.get_pcfg(), N=100, seed=3, maxlen=50)
+        self.assertEqual([str(x) for x in ds.generate_many(50, seed=7)], [str(x) for x in ds.generate_many(50, seed=7)])
+        self.assertNotEqual([str(x) for x in ds.generate_many(50, seed=7)], [str(x) for x in ds.generate_many(50, seed=8)])
+        self.assertEqual(str(ds[5]), str(ds[5]))
+        bds = PCFGDataset(self.get_pcfg(), N=100, seed=3, maxlen=50, blocksize=30)
+        xs = [str(x) for x in bds.examples]
+        self.assertEqual(xs, [str(x) for x in bds.examples])
+        self.assertEqual(xs[30:60], [str(x) for x in bds.generate_many(30, seed=bds.seed + 1)])
+        bds.advance_seed()
+        self.assertNotEqual(xs, [str(x) for x in bds.examples])
+
+    def test_inside_table(self):
+        import numpy as np
+        from parseq.datasets import PCFGBuilder
+        # trees of NT have lengths 1 (x), 5 (f x x), 9 (two trees with two f's), ...
+        table = PCFGBuilder.build_inside_table(self.get_pcfg(), 10)
+        print(table.length_probs())
+        expected = np.zeros(10)
+        expected[1], expected[5], expected[9] = 0.7, 0.3 * 0.49, 2 * 0.3 * 0.3 * 0.49 * 0.7
+        self.assertTrue(np.allclose(table.length_probs(), expected))
+
+    def test_exact_length(self):
+        from collections import Counter
+        from parseq.datasets import PCFGDataset, tree_length
+        # conditioned on length < 10 as a whole (no nested rejection)
+        px, pf, pff = 0.7, 0.3 * 0.49, 0.3 * 0.3 * 0.49 * 0.7
+        z = px + pf + 2 * pff
+        ds = PCFGDataset(self.get_pcfg(), N=100, seed=3, maxlen=10, exact_length=True)
+        xs = ds.generate_many(20000, seed=1)
+        counts = Counter([str(x) for x in xs])
+        print(counts)
+        self.assertTrue(all([tree_length(x, count_brackets=True) < 10 for x in xs]))
+        self.assertAlmostEqual(counts["(x )"] / 20000, px / z, delta=0.01)
+        self.assertAlmostEqual(counts["(f (x ) (x ))"] / 20000, pf / z, delta=0.01)
+        self.assertAlmostEqual(counts["(f (x ) (f (x ) (x )))"] / 20000, pff / z, delta=0.01)
+        self.assertEqual([str(x) for x in xs[:50]], [str(x) for x in ds.generate_many(50, seed=1)])
+        # sampling to a given length distribution
+        ds = PCFGDataset(self.get_pcfg(), N=100, seed=3, maxlen=10, lengths=[0] * 5 + [1] * 5)
+        counts = Counter([tree_length(x, count_brackets=True) for x in ds.generate_many(2000, seed=1)])
+        print(counts)
+        self.assertEqual(counts[1], 0)
+        self.assertAlmostEqual(counts[5] / 2000, 0.5, delta=0.05)
+
+    def test_shard(self):
+        from parseq.datasets import PCFGDataset
+        ds = PCFGDataset(self.get_pcfg(), N=250, seed=3, maxlen=30)
+        ref = [ds[i] for i in range(len(ds))]
+        sds = ds.shard(workers=2, shardsize=40)
+        print(len(sds._shards), sds[0])
+        self.assertEqual(len(sds), 250)
+        self.assertEqual([sds[i] for i in range(len(sds))], ref)
+        self.assertEqual(sds[-1], ref[-1])
+        # blocked generation
+        bds = PCFGDataset(self.get_pcfg(), N=250, seed=3, maxlen=30, blocksize=30)
+        bsds = bds.shard(workers=0)
+        self.assertEqual([str(x) for x in bsds.examples], [str(x) for x in bds.examples])
+        # new seed: regenerated
+        sds.advance_seed()
+        self.assertEqual([str(sds[i]) for i in range(len(sds))], [str(ds[i]) for i in range(len(ds))])
+        self.assertNotEqual([str(sds[i]) for i in range(len(sds))], [str(x) for x in ref])
+
+
+class TestBinaryExamples(TestCase):
+    def test_roundtrip(self):
+        import os, pickle, tempfile
+        from nltk import Tree
+        from parseq.datasets import BinaryExamples, SequenceDataset
+        from parseq.grammar import lisp_to_tree
+        examples = [("what is  the answer", lisp_to_tree("(and (a b) (c \"quoted leaf\"))"), "train"),
+                    ("", Tree("x", []), "test"),
+                    ("one", Tree("f", ["s", Tree("g", ["t"])]), "valid")]
+        path = os.path.join(tempfile.mkdtemp(), "examples.bin")
+        BinaryExamples.write(path, examples)
+        bex = BinaryExamples(path)
+        print(bex.labels, list(bex))
+        self.assertEqual(len(bex), 3)
+        self.assertEqual(list(bex), examples)
+        self.assertEqual([type(x) for x in bex[2][1]], [str, Tree])
+        self.assertEqual(bex[-1], examples[-1])
+        self.assertEqual(pickle.loads(pickle.dumps(bex))[0], examples[0])
+        ds = SequenceDataset(bex)
+        self.assertEqual(len(ds[lambda x: x[2] == "train"]), 1)
+
+    def test_overnight_cache(self):
+        import os, tempfile
+        from parseq.datasets import OvernightDatasetLoader, SequenceDataset
+        pcache = tempfile.mkdtemp()
+        ref = OvernightDatasetLoader(simplify_mode="light").load("publications")
+        loader = OvernightDatasetLoader(simplify_mode="light", usecache=True, pcache=pcache)
+        loader.load("publications")
+        ds = loader.load("publications")
+        self.assertTrue(isinstance(ds, SequenceDataset))
+        self.assertEqual(ds.examples, ref.examples)
+        # other options: other cache file
+        OvernightDatasetLoader(simplify_mode="full", usecache=True, pcache=pcache).load("publications")
+        print(os.listdir(pcache))
+        self.assertEqual(len(os.listdir(pcache)), 2)
+
+    def test_overnight_load_many(self):
+        from parseq.datasets import OvernightDatasetLoader
+        loader = OvernightDatasetLoader(simplify_mode="light", validfrac=.1)
+        loaded = loader.load_many(["publications", "calendar"], workers=2, f=lambda d, ds: (d, ds.examples))
+        print(list(loaded.keys()))
+        self.assertEqual(list(loaded.keys()), ["publications", "calendar"])
+        for domain in ["publications", "calendar"]:
+            self.assertEqual(loaded[domain], (domain, loader.load(domain).examples))
+
+
+class TestBucketBatchSampler(TestCase):
+    def test_batches(self):
+        from torch.utils.data import DataLoader
+        from parseq.datasets import BucketBatchSampler, autocollate, padding_efficiency
+        ds = Dataset([(torch.arange(i % 13 + 1), torch.arange((i * 7) % 11 + 1), i) for i in range(103)])
+        sampler = BucketBatchSampler(ds, 10, megabatch=5, seed=3)
+        self.assertEqual(sampler.lengths[:2], [(1, 1), (2, 8)])
+        epoch0, epoch1 = list(sampler), list(sampler)
+        print(epoch0[:2])
+        self.assertEqual(len(epoch0), len(sampler))
+        self.assertEqual(sorted(sum(epoch0, [])), list(range(103)))
+        self.assertNotEqual(epoch0, epoch1)
+        # reproducible with the same seed
+        self.assertEqual(BucketBatchSampler(ds, 10, megabatch=5, seed=3).batches(0), epoch0)
+        self.assertEqual(sampler.batches(1), epoch1)
+        # less padding than batches in order
+        inorder = [list(range(i, min(i + 10, 103))) for i in range(0, 103, 10)]
+        print(padding_efficiency(epoch0, sampler.lengths), padding_efficiency(inorder, sampler.lengths))
+        self.assertGreater(padding_efficiency(epoch0, sampler.lengths)[0], padding_efficiency(inorder, sampler.lengths)[0])
+        self.assertEqual(len(BucketBatchSampler(ds, 10, drop_last=True, seed=3).batches()), 10)
+        dl = DataLoader(ds, batch_sampler=sampler, collate_fn=autocollate)
+        self.assertEqual(sum([len(batch[2]) for batch in dl]), 103)
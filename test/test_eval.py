@@ -96,3 +96,44 @@ class TestTreeAccuracy(TestCase):
         self.assertTrue(a["tree_acc_at5"] == 1)
         self.assertTrue(a["tree_acc_at_last"] == 1)
 
+
+    def test_batch_tensor2tree(self):
+        from parseq.grammar import batch_tensor2tree
+        x = ["( and ( got the walk ) ( got the talk ) ( and ( got thatstyle ) ( got thatsmile ) ) )",
+             "( and ( got the walk ) ( got talk the ) ( and ( got thatstyle ) ( got thatsmile ) ) )",
+             "( and ( got the walk ) ( got the walk ) ( and ( got thatstyle ) ( got thatsmile ) ) )",
+             "( and ( got the talk ) ( got the walk ) ( and ( got thatsmile ) ( got thatstyle ) ) )",
+             "( too_bad ( she ( has ( a penis ) ) ) )"]
+        D = Vocab()
+        for xe in x:
+            for xes in xe.split():
+                D.add_token(xes, seen=True)
+        D.finalize()
+        acc = TreeAccuracy(batch_tensor2tree=partial(batch_tensor2tree, vocab=D), orderless={"and"})
+        x = [[D[xes] for xes in xe.split()] + [D[D.endtoken]] for xe in x]
+        maxlen = max([len(xe) for xe in x])
+        x = torch.tensor([xe + [0]*(maxlen - len(xe)) for xe in x])
+
+        a = acc(None, x[torch.tensor([[1, 4, 2, 3, 0], [3, 3, 4, 4, 4]])], x[torch.tensor([0, 0])])
+        print(a)
+        self.assertEqual(a["tree_acc"], 0.5)
+        self.assertEqual([a[f"tree_acc_at{i}"] for i in range(1, 6)], [0.5, 0.5, 0.5, 1, 1])
+        a = acc(None, x[torch.tensor([1, 4, 3, 0])], x[torch.tensor([0, 4, 0, 3])])
+        print(a)
+        self.assertEqual(a["tree_acc"], 0.75)
+
+    def test_ragged_golds(self):
+        from parseq.grammar import batch_tensor2tree
+        x = ["( and ( got the walk ) ( got the talk ) )",
+             "( and ( got the talk ) ( got the walk ) )",
+             "( too_bad ( she ) )"]
+        D = Vocab()
+        for xe in x:
+            for xes in xe.split():
+                D.add_token(xes, seen=True)
+        D.finalize()
+        golds = [torch.tensor([D[xes] for xes in xe.split()] + [D[D.endtoken]]) for xe in x]
+        preds = torch.nn.utils.rnn.pad_sequence([golds[1], golds[0], golds[0]], batch_first=True)
+        acc = TreeAccuracy(batch_tensor2tree=partial(batch_tensor2tree, vocab=D), orderless={"and"})
+        a = acc(None, preds, golds)
+        self.assertAlmostEqual(a["tree_acc"], 2/3)
@@ -1,6 +1,9 @@
 from unittest import TestCase
 
-from parseq.grammar import lisp_to_pas, pas_to_tree, LispToPas, lisp_to_tree, are_equal_trees
+import time
+
+from parseq.grammar import lisp_to_pas, pas_to_tree, LispToPas, lisp_to_tree, are_equal_trees, prolog_to_tree, \
+    prolog_to_pas, tree_to_lisp, tree_to_prolog, ActionTree
 
 
 class Test_lisp_to_pas(TestCase):
@@ -92,6 +95,31 @@ class Test_lisp_to_pas(TestCase):
         self.print_(x, z)
         self.assertEqual(z, ("spouse", [("wife", [("director", ["'federal \"bureau\" of (investigations of )'"])])]))
 
+    def test_prolog(self):
+        x = "answer(city(loc_2(stateid('virginia'))))"
+        y = prolog_to_pas(x)
+        print(y)
+        self.assertEqual(y, ("answer", [("city", [("loc_2", [("stateid", ["'virginia'"])])])]))
+        self.assertEqual(str(prolog_to_tree(x)), "(answer (city (loc_2 (stateid 'virginia'))))")
+
+    def test_tree_class(self):
+        x = "(and (f x (g y)) (h z))"
+        y = lisp_to_tree(x, tree_class=ActionTree)
+        print(y)
+        self.assertTrue(isinstance(y, ActionTree))
+        self.assertTrue(isinstance(y[0][1], ActionTree))
+        self.assertTrue(y[0][1].parent() is y[0])
+        self.assertEqual(tree_to_lisp(y), tree_to_lisp(lisp_to_tree(x)))
+
+    def test_long_input(self):
+        for n in [1000, 10000, 100000]:
+            x = "(and " + " ".join(["(f x (g y))"] * n) + ")"
+            t0 = time.time()
+            y = lisp_to_tree(x)
+            print(n, time.time() - t0)
+            self.assertEqual(len(y), n)
+        self.assertEqual(tree_to_lisp(y), x)
+
 
 class TestEqualTrees(TestCase):
     def test_it(self):
@@ -113,3 +141,195 @@ class TestEqualTrees(TestCase):
         print(are_equal_trees(b, b))
         self.assertFalse(are_equal_trees(b, b))
         self.assertFalse(are_equal_trees(a, b))
+
+    def test_canonical(self):
+        from parseq.grammar import canonicalize_tree
+        a = lisp_to_tree("(and (f (or x y)) (g z) (f (or y x)))")
+        b = lisp_to_tree("(and (f (or y x)) (f (or x y)) (g z))")
+        c = lisp_to_tree("(and (f (or y x)) (g z) (g z))")
+        ka, kb, kc = canonicalize_tree(a), canonicalize_tree(b), canonicalize_tree(c)
+        print(ka)
+        self.assertEqual(ka, kb)
+        self.assertEqual(hash(ka), hash(kb))
+        self.assertNotEqual(ka, kc)
+        self.assertNotEqual(ka, canonicalize_tree(a, orderless=set()))
+        self.assertEqual(len({ka, kb, kc}), 2)
+        # terminator stays in place
+        a = lisp_to_tree("(and x y @END@)")
+        b = lisp_to_tree("(and y x @END@)")
+        c = lisp_to_tree("(and @END@ y x)")
+        self.assertTrue(are_equal_trees(a, b, use_terminator=True))
+        self.assertFalse(are_equal_trees(a, c, use_terminator=True))
+        self.assertTrue(are_equal_trees(a, c, use_terminator=False))
+        # unk never equal
+        u = canonicalize_tree(lisp_to_tree("(and x @UNK@)"))
+        self.assertNotEqual(u, u)
+
+
+class TestFuncGrammar(TestCase):
+    def test_compiled(self):
+        from parseq.grammar import FuncGrammar
+        g = FuncGrammar("<R>")
+        for rule in ["<R> -> answer :: <C>", "<C> -> city :: <C>", "<C> -> loc_2 :: <S>", "<S> -> stateid :: <N>",
+                     "<N> -> 'virginia'", "<N> -> 'texas'", "<C> -> intersect :: <C> <C>", "<C> -> all_cities"]:
+            g.add_rule(rule)
+        g.add_rule("<C> -> city :: <C>")      # duplicates are ignored
+        self.assertEqual(len(g.rules), 8)
+        rid = g.rule_ids["<C> -> intersect :: <C> <C>"]
+        self.assertEqual(g.symbol_names[g.rule_head[rid]], "intersect")
+        self.assertEqual(g.symbol_names[g.rule_type[rid]], "<C>")
+        self.assertEqual([g.symbol_names[t] for t in g.rule_argtypes[rid]], ["<C>", "<C>"])
+
+        queries = ["answer(city(loc_2(stateid('virginia'))))",
+                   "answer(intersect(all_cities , city(loc_2(stateid('texas')))))",
+                   "answer(city(loc_2(stateid('virginia'))))"]
+        actionses = g.actions_for(queries, format="prolog")
+        print(actionses)
+        self.assertEqual(actionses[0], ["<R> -> answer :: <C>", "<C> -> city :: <C>", "<C> -> loc_2 :: <S>",
+                                        "<S> -> stateid :: <N>", "<N> -> 'virginia'"])
+        self.assertEqual(actionses[0], actionses[2])
+        self.assertFalse(actionses[0] is actionses[2])
+        for query, actions in zip(queries, actionses):
+            self.assertEqual(actions, g.actions_for(query, format="prolog"))
+            tree = g.actions_to_tree(actions)
+            print(tree)
+            self.assertEqual(tree_to_prolog(tree).replace(" ", ""), query.replace(" ", ""))
+            self.assertEqual([t.action() for t in tree.subtrees()], actions)
+
+
+class TestBatchTensor2Tree(TestCase):
+    def test_it(self):
+        import torch
+        from parseq.grammar import batch_tensor2tree, PrologToTree
+        from parseq.vocab import Vocab
+        D = Vocab()
+        for token in "( ) and has service money answer( , 'new york'".split(" "):
+            D.add_token(token)
+        D.finalize()
+        seqs = ["( and ( has service ) ( has money ) ) @END@ ( has",
+                "( and ( has service @PAD@ ) ( has money @END@ ) )",        # missing closing brackets
+                "( has service ) ) ) @END@",                                # too many closing brackets
+                "( has 'new york' ) @END@",
+                "@END@ ( has )"]
+        seqs = [seq.split(" ") for seq in seqs]
+        maxlen = max([len(seq) for seq in seqs])
+        x = torch.tensor([[D[token] for token in seq] + [0] * (maxlen - len(seq)) for seq in seqs])
+        trees = batch_tensor2tree(x, D)
+        print(trees)
+        self.assertEqual(str(trees[0]), "(and (has (service )) (has (money )))")
+        self.assertEqual(str(trees[1]), "(and (has (service )) (has (money )))")
+        self.assertEqual(str(trees[2]), "(has (service ))")
+        self.assertEqual(str(trees[3]), "(has 'new york')")
+        self.assertEqual(trees[4], None)
+        for seq, tree in zip(x, trees):
+            self.assertEqual(str(batch_tensor2tree(seq, D)[0]), str(tree))
+
+        x = torch.tensor([[D[token] for token in "answer( has , money ) @END@".split(" ")]])
+        print(batch_tensor2tree(x, D, parser=PrologToTree))
+        self.assertEqual(str(batch_tensor2tree(x, D, parser=PrologToTree)[0]), "(answer (has ) (money ))")
+
+
+class TestTreePermutations(TestCase):
+    def test_it(self):
+        import random
+        from collections import Counter
+        from parseq.grammar import iter_tree_permutations, sample_tree_permutation, count_tree_permutations
+        a = lisp_to_tree("(x (a 1 2 3) (b 1 2) (a 1 1))")
+        orderless = {"a", "x"}
+        perms = [str(t) for t in iter_tree_permutations(a, orderless=orderless)]
+        print(len(perms), len(set(perms)))
+        self.assertEqual(len(perms), 3*2*1 * 3*2*1 * 2)
+        self.assertEqual(count_tree_permutations(a, orderless=orderless), len(perms))
+        self.assertEqual(count_tree_permutations(a, orderless=orderless, distinct=True), len(set(perms)))
+        for t in iter_tree_permutations(a, orderless=orderless):
+            self.assertTrue(are_equal_trees(a, t, orderless=orderless))
+
+        # identical (up to reordering) siblings with permutations of their own
+        b = lisp_to_tree("(and (or p q) (or q p) (r s))")
+        perms = [str(t) for t in iter_tree_permutations(b)]
+        self.assertEqual(count_tree_permutations(b), len(perms))
+        self.assertEqual(count_tree_permutations(b, distinct=True), len(set(perms)))
+
+        # lazy: first permutation of a huge orderless node is cheap
+        c = lisp_to_tree("(and " + " ".join([f"(f{i} x)" for i in range(30)]) + ")")
+        self.assertEqual(str(next(iter_tree_permutations(c))), str(c))
+        self.assertEqual(count_tree_permutations(c), 265252859812191058636308480000000)
+
+        # sampling: uniform over the enumeration
+        rng = random.Random(42)
+        counts = Counter([str(sample_tree_permutation(a, orderless=orderless, rng=rng)) for _ in range(7200)])
+        print(counts.most_common(3))
+        allperms = [str(t) for t in iter_tree_permutations(a, orderless=orderless)]
+        self.assertEqual(set(counts.keys()), set(allperms))
+        for k, v in counts.items():
+            self.assertAlmostEqual(v / 7200, allperms.count(k) / len(allperms), delta=0.015)
+        # seeded numpy rng is reproducible
+        import numpy as np
+        s1 = [str(sample_tree_permutation(c, rng=np.random.RandomState(3))) for _ in range(2)]
+        self.assertEqual(s1[0], s1[1])
+        self.assertTrue(are_equal_trees(c, sample_tree_permutation(c)))
+
+    def test_tree_permuter(self):
+        from parseq.datasets import Pipeline, TreePermuter
+        f = Pipeline().add(TreePermuter(orderless={"and"}, seed=1))
+        x = "(and (a 1) (b 2) (c 3))"
+        outs = set([f(x) for _ in range(100)])
+        print(outs)
+        self.assertEqual(len(outs), 6)
+        for out in outs:
+            self.assertTrue(are_equal_trees(lisp_to_tree(out), lisp_to_tree(x)))
+        f = TreePermuter(orderless={"and"}, p=0., seed=1)
+        self.assertEqual(f(x), x)
+
+
+class TestCompactTree(TestCase):
+    def test_it(self):
+        from parseq.grammar import CompactTree, canonicalize_tree, tree_size, tree_to_lisp_tokens
+        from parseq.vocab import Vocab
+        x = "(and (wife BO) (spouse (f BO)) (g))"
+        a = lisp_to_tree(x)
+        c = CompactTree.from_tree(a)
+        print(c, c.ids, c.parents, c.numchildren)
+        self.assertEqual(c.parents.tolist(), [-1, 0, 1, 0, 3, 4, 0])
+        self.assertEqual(c.numchildren.tolist(), [3, 1, 0, 1, 1, 0, 0])
+        self.assertEqual(c.ids[2], c.ids[5])        # BO
+        self.assertEqual(c.size(), tree_size(a))
+        self.assertEqual(c.depth(), a.height())
+        self.assertEqual(c.label(), "and")
+        self.assertEqual(c.children(0), [1, 3, 6])
+        self.assertEqual(c.to_lisp(), tree_to_lisp(a))
+        self.assertEqual(tree_to_lisp_tokens(c), tree_to_lisp_tokens(a))
+        self.assertEqual(c.to_tree(), a)
+        self.assertTrue(isinstance(c.to_tree(tree_class=ActionTree), ActionTree))
+
+        # canonical forms are interchangeable with those of nltk trees
+        b = lisp_to_tree("(and (g) (spouse (f BO)) (wife BO))")
+        self.assertEqual(canonicalize_tree(c), canonicalize_tree(b))
+        self.assertEqual(hash(canonicalize_tree(c)), hash(canonicalize_tree(a)))
+        self.assertNotEqual(canonicalize_tree(c, orderless=set()), canonicalize_tree(b, orderless=set()))
+        self.assertNotEqual(canonicalize_tree(CompactTree.from_lisp("(and x @UNK@)")),
+                            canonicalize_tree(CompactTree.from_lisp("(and x @UNK@)")))
+
+        # shared vocab
+        D = Vocab()
+        for token in tree_to_lisp_tokens(a):
+            D.add_token(token)
+        D.finalize()
+        c2 = CompactTree.from_tree(b, vocab=D)
+        self.assertEqual(c2.to_tree(), b)
+        self.assertEqual(c2.label(), "and")
+        self.assertEqual(c2.ids[0], D["and"])
+
+        # string leaves
+        s = lisp_to_tree("(has 'new york' (a \"b c\"))")
+        c = CompactTree.from_tree(s)
+        self.assertEqual(c.to_tree(), s)
+        self.assertEqual(c.to_lisp(), "(has 'new york' (a \"b c\"))")
+        self.assertEqual(canonicalize_tree(c), canonicalize_tree(s))
+        self.assertEqual(c.depth(), s.height())
+
+        # deep trees: no recursion
+        x = "(f " * 5000 + "x" + ")" * 5000
+        c = CompactTree.from_tree(lisp_to_tree(x))
+        self.assertEqual(c.depth(), 5001)
+        self.assertEqual(c.to_lisp(), x)
@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from parseq.transitions import LSTMCellTransition
+from parseq.transitions import LSTMCellTransition, LSTMTransition
 import torch
 
 
@@ -10,3 +10,33 @@ class TestLSTMCellTransition(TestCase):
         init_state = t.get_init_state(2)
         print(init_state)
         print(init_state.get(0).has())
+
+    def test_forward_sequence(self):
+        t = LSTMCellTransition(torch.nn.LSTMCell(4, 6), torch.nn.LSTMCell(6, 5), dropout=0.)
+        x = torch.randn(3, 7, 4)
+        state = t.get_init_state(3)
+        outs = []
+        for i in range(x.size(1)):
+            out, state = t(x[:, i], state)
+            outs.append(out)
+        outs = torch.stack(outs, 1)
+        seqouts, seqstate = t.forward_sequence(x, t.get_init_state(3))
+        self.assertTrue(torch.allclose(outs, seqouts, atol=1e-6))
+        self.assertTrue(torch.allclose(state.get(0).c, seqstate.get(0).c, atol=1e-6))
+        self.assertTrue(torch.allclose(state.get(1).h, seqstate.get(1).h, atol=1e-6))
+
+
+class TestLSTMTransition(TestCase):
+    def test_forward_sequence(self):
+        t = LSTMTransition(4, 5, num_layers=2)
+        x = torch.randn(3, 7, 4)
+        state = t.get_init_state(3)
+        outs = []
+        for i in range(x.size(1)):
+            out, state = t(x[:, i], state)
+            outs.append(out)
+        outs = torch.stack(outs, 1)
+        seqouts, seqstate = t.forward_sequence(x, t.get_init_state(3))
+        self.assertTrue(torch.allclose(outs, seqouts, atol=1e-6))
+        self.assertTrue(torch.allclose(state.h, seqstate.h, atol=1e-6))
+        self.assertTrue(torch.allclose(state.c, seqstate.c, atol=1e-6))
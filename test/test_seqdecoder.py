@@ -0,0 +1,123 @@
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from parseq.decoding import SeqDecoder
+from parseq.eval import CELoss, SeqAccuracies
+from parseq.states import BasicDecoderState, State
+from parseq.transitions import TransitionModel
+from parseq.vocab import SequenceEncoder
+
+
+def make_state(texts):
+    se = SequenceEncoder(tokenizer=lambda x: x.split())
+    for t in texts:
+        se.inc_build_vocab(t)
+    se.finalize_vocab()
+    return BasicDecoderState(texts, texts, sentence_encoder=se, query_encoder=se), se
+
+
+class TestSeqDecoderForwardSequence(TestCase):
+    def test_unsupported_model_steps_once(self):
+        texts = ["i went to chocolate @END@", "awesome is @END@", "the meaning of life @END@"]
+        x, se = make_state(texts)
+        calls = {"forward": 0, "forward_sequence": 0}
+
+        class Model(TransitionModel):
+            def forward(self, x:BasicDecoderState):
+                calls["forward"] += 1
+                return torch.rand(len(x), se.vocab.number_of_ids()), x
+
+            def forward_sequence(self, x, prev_actions):
+                calls["forward_sequence"] += 1
+                raise NotImplementedError()
+
+        dec = SeqDecoder(Model(), tf_ratio=1.)
+        _, y = dec(x)
+        print(calls)
+        self.assertEqual(calls["forward_sequence"], 0)
+        self.assertEqual(calls["forward"], 5)
+        self.assertTrue(torch.equal(y.followed_actions, y.gold_tensor[:, :y.followed_actions.size(1)]))
+
+    def test_supported_model_uses_sequence(self):
+        texts = ["i went to chocolate @END@", "awesome is @END@"]
+        x, se = make_state(texts)
+        calls = {"forward": 0, "forward_sequence": 0}
+
+        class Model(TransitionModel):
+            def forward(self, x:BasicDecoderState):
+                calls["forward"] += 1
+                return torch.rand(len(x), se.vocab.number_of_ids()), x
+
+            def supports_forward_sequence(self, x):
+                return True
+
+            def forward_sequence(self, x, prev_actions):
+                calls["forward_sequence"] += 1
+                return torch.rand(len(x), prev_actions.size(1), se.vocab.number_of_ids()), x
+
+        dec = SeqDecoder(Model(), tf_ratio=1.)
+        _, y, out, predactions, golds = dec(x, return_all=True)
+        print(calls)
+        self.assertEqual(calls, {"forward": 0, "forward_sequence": 1})
+        self.assertEqual(out.size()[:2], predactions.size())
+        self.assertTrue(torch.equal(y.followed_actions, golds[:, :y.followed_actions.size(1)]))
+        # the given state is stepped, like in the step-by-step loop
+        self.assertTrue(y is x)
+        self.assertTrue(x.all_terminated())
+
+
+class TestSeqDecoderCompact(TestCase):
+    def test_same_as_freerunning(self):
+        texts = ["i went to chocolate @END@", "awesome is @END@", "the meaning of life @END@",
+                 "life is @END@", "chocolate @END@"]
+        _, se = make_state(texts)
+        vocsize = se.vocab.number_of_ids()
+        endid = se.vocab["@END@"]
+
+        class Model(TransitionModel):
+            """ Small recurrent model that emits @END@ at a given step for every example. """
+            def __init__(self, stop_at, **kw):
+                super(Model, self).__init__(**kw)
+                self.stop_at = stop_at
+                self.emb = torch.nn.Embedding(vocsize, 6)
+                self.lin = torch.nn.Linear(6, vocsize)
+
+            def forward(self, x:BasicDecoderState):
+                if "mstate" not in x:
+                    x.mstate = State()
+                    x.mstate.h = torch.zeros(len(x), 6)
+                    x.mstate.t = torch.zeros(len(x), dtype=torch.long)
+                    x.mstate.stop_at = self.stop_at.clone()
+                mstate = x.mstate
+                mstate.h = torch.tanh(mstate.h + self.emb(x.prev_actions))
+                out = self.lin(mstate.h)
+                out[:, endid] = -1e3
+                out[mstate.t == mstate.stop_at, endid] = 1e3
+                mstate.t = mstate.t + 1
+                return torch.log_softmax(out, -1), x
+
+        torch.manual_seed(42)
+        model = Model(torch.tensor([1, 5, 0, 3, 7]))
+
+        x, _ = make_state(texts)
+        metrics, x, out, predactions, _ = SeqDecoder(model, eval=[CELoss(mode="logprobs"), SeqAccuracies()],
+                                                     tf_ratio=0.)(x, return_all=True)
+        cx, _ = make_state(texts)
+        cmetrics, cx, cout, cpredactions, _ = SeqDecoder(model, eval=[CELoss(mode="logprobs"), SeqAccuracies()],
+                                                         tf_ratio=0., compact=True)(cx, return_all=True)
+        print(predactions)
+        print(cpredactions)
+        self.assertEqual(out.size(), (5, 8, vocsize))
+        self.assertTrue(torch.equal(out, cout))
+        self.assertTrue(torch.equal(predactions, cpredactions))
+        self.assertTrue(torch.equal(x.followed_actions, cx.followed_actions))
+        self.assertTrue(torch.equal(x.followed_actions, predactions))
+        self.assertEqual(set(metrics.keys()), set(cmetrics.keys()))
+        for k in metrics:
+            self.assertEqual(float(metrics[k]), float(cmetrics[k]))
+        self.assertTrue(torch.equal(x.prev_actions, cx.prev_actions))
+        self.assertTrue(np.array_equal(x.is_terminated(), cx.is_terminated()))
+        self.assertTrue(np.array_equal(x._timesteps, cx._timesteps))
+        self.assertTrue(torch.equal(cx.mstate.t, x.mstate.stop_at + 1))
@@ -3,8 +3,10 @@ from unittest import TestCase
 import numpy as np
 import torch
 
-from parseq.states import State, BasicDecoderState
-from parseq.vocab import SequenceEncoder
+from parseq.grammar import lisp_to_tree
+from parseq.states import State, ListState, BasicDecoderState, HistoryState, TreeDecoderState, BeamState, \
+    TreeGrammarTable
+from parseq.vocab import SequenceEncoder, Vocab
 
 
 class Test_State(TestCase):
@@ -131,6 +133,185 @@ class Test_State(TestCase):
         print(x.k)
         print(y.k)
 
+    def test_copy_cow(self):
+        x = State(a=torch.rand(5, 3), s=np.asarray(["a", "b", "c", "d", "e"]), sub=State(b=torch.rand(5, 2)))
+        y = x.make_copy(deep="cow")
+        self.assertEqual(y.a.data_ptr(), x.a.data_ptr())
+        self.assertTrue(y.s is x.s)
+        self.assertEqual(y.sub.b.data_ptr(), x.sub.b.data_ptr())
+        a, b = x.a.clone(), x.sub.b.clone()
+        y[torch.tensor([1, 2])] = State(a=torch.zeros(2, 3), s=np.asarray(["q", "q"]), sub=State(b=torch.zeros(2, 2)))
+        print(x.a)
+        print(y.a)
+        self.assertTrue(torch.all(x.a == a))
+        self.assertTrue(torch.all(x.sub.b == b))
+        self.assertEqual(list(x.s), ["a", "b", "c", "d", "e"])
+        self.assertEqual(list(y.s), ["a", "q", "q", "d", "e"])
+        self.assertTrue(torch.all(y.a[1:3] == 0))
+        # original must own its values after a write too
+        x[torch.tensor([0])] = State(a=torch.ones(1, 3), s=np.asarray(["z"]), sub=State(b=torch.ones(1, 2)))
+        self.assertEqual(y.s[0], "a")
+        self.assertTrue(torch.all(y.a[0] == a[0]))
+
+    def test_copy_cow_history(self):
+        x = State(hist=HistoryState(2, 4))
+        x.hist.append(torch.tensor([1, 2]))
+        y = x.make_copy(deep="cow")
+        y.hist.append(torch.tensor([3, 4]))
+        self.assertEqual(list(x.hist.lens), [1, 1])
+        self.assertEqual(x.hist.buffer[:, 1].tolist(), [0, 0])
+        self.assertEqual(y.hist.filled().tolist(), [[1, 3], [2, 4]])
+
+    def test_copy_cow_setitem_same_object(self):
+        # reassigning a key to the same object (no padding needed, already on device) must keep it shared
+        x = State(a=torch.arange(6).view(3, 2), hist=HistoryState(3, 4))
+        x.hist.append(torch.tensor([1, 2, 3]))
+        ref_a, ref_buffer = x.a.clone(), x.hist.buffer.clone()
+        y = x.make_copy(deep="cow")
+        y.to(y.a.device)
+        other = State(a=torch.full((1, 2), 9), hist=HistoryState(1, 4))
+        other.hist.append(torch.tensor([7]))
+        y[[1]] = other
+        self.assertTrue(torch.equal(x.a, ref_a))
+        self.assertTrue(torch.equal(x.hist.buffer, ref_buffer))
+        self.assertEqual(y.a[1].tolist(), [9, 9])
+        self.assertEqual(y.hist.buffer[1, 0].item(), 7)
+
+    def test_copy_cow_mutations(self):
+        def make():
+            tokens = np.empty(3, dtype=object)
+            for i, t in enumerate([["a"], ["b", "c"], []]):
+                tokens[i] = t
+            return State(a=torch.arange(6).view(3, 2), tokens=tokens,
+                         lst=ListState(torch.zeros(3, 2), State(c=torch.ones(3))),
+                         sub=State(b=torch.ones(3, 4), subsub=State(d=torch.arange(3))))
+        x = make()
+        y = x.make_copy(deep="cow")
+
+        # in-place writes into the copy
+        y._own("a")[0] = 100
+        y._own("tokens")[1].append("q")
+        y.lst._own(0)[:] = 7
+        y.lst.get(1)._own("c")[2] = 0
+        y.sub._own("b").mul_(3)
+        y.sub.subsub._own("d")[:] = -1
+        y[torch.tensor([2])] = y[torch.tensor([0])]
+
+        ref = make()
+        self.assertTrue(torch.equal(x.a, ref.a))
+        self.assertEqual(list(x.tokens), [["a"], ["b", "c"], []])
+        self.assertTrue(torch.equal(x.lst.get(0), ref.lst.get(0)))
+        self.assertTrue(torch.equal(x.lst.get(1).c, ref.lst.get(1).c))
+        self.assertTrue(torch.equal(x.sub.b, ref.sub.b))
+        self.assertTrue(torch.equal(x.sub.subsub.d, ref.sub.subsub.d))
+
+        self.assertEqual(y.a[:, 0].tolist(), [100, 2, 100])
+        self.assertEqual(list(y.tokens), [["a"], ["b", "c", "q"], ["a"]])
+        self.assertTrue(torch.all(y.lst.get(0) == 7))
+        self.assertEqual(y.lst.get(1).c.tolist(), [1, 1, 1])
+        self.assertTrue(torch.all(y.sub.b == 3))
+        self.assertEqual(y.sub.subsub.d.tolist(), [-1, -1, -1])
+
+        # in-place writes into the original after copying
+        z = x.make_copy(deep="cow")
+        x._own("a")[1] = 42
+        x._own("tokens")[0].append("z")
+        x.sub.subsub._own("d")[0] = 9
+        self.assertTrue(torch.equal(z.a, ref.a))
+        self.assertEqual(list(z.tokens), [["a"], ["b", "c"], []])
+        self.assertTrue(torch.equal(z.sub.subsub.d, ref.sub.subsub.d))
+
+
+class TestHistoryState(TestCase):
+    def test_append_and_grow(self):
+        x = HistoryState(3, 2)
+        for t in range(5):
+            x.append(torch.tensor([t, t+1, t+2]))
+        print(x.filled())
+        self.assertTrue(x.capacity >= 5)
+        self.assertEqual(x.filled().size(), (3, 5))
+        self.assertTrue(torch.all(x.filled()[:, 0] == torch.tensor([0, 1, 2])))
+        self.assertTrue(torch.all(x.filled()[0] == torch.arange(5)))
+
+    def test_lens_in_place(self):
+        x = HistoryState(3, 4)
+        lens = x.lens
+        self.assertTrue(isinstance(lens, torch.Tensor))
+        self.assertEqual(lens.device, x.buffer.device)
+        for t in range(6):
+            x.append(torch.tensor([t, t, t]))
+        self.assertTrue(x.lens is lens)
+        self.assertEqual(lens.tolist(), [6, 6, 6])
+
+    def test_append_larger_elems(self):
+        x = HistoryState(2, 4, 3, dtype=torch.float)
+        x.append(torch.ones(2, 3))
+        x.append(torch.ones(2, 5) * 2)
+        print(x.filled())
+        self.assertEqual(x.filled().size(), (2, 2, 5))
+        self.assertEqual(x.filled()[0, 0, 4].item(), 0)
+        self.assertEqual(x.filled()[0, 1, 4].item(), 2)
+
+    def test_in_state(self):
+        x = State(data=torch.rand(3, 2), hist=HistoryState(3, 2))
+        for t in range(3):
+            x.hist.append(torch.tensor([t, t+1, t+2]))
+        y = x[torch.tensor([0, 2])]
+        self.assertTrue(torch.all(y.hist.filled() == x.hist.filled()[[0, 2]]))
+        z = x.make_copy()
+        z.hist.append(torch.tensor([9, 9, 9]))
+        self.assertEqual(x.hist.filled().size(1), 3)
+        self.assertEqual(z.hist.filled().size(1), 4)
+        x[[1]] = z[[1]]
+        print(x.hist.filled())
+        self.assertEqual(list(x.hist.lens), [3, 4, 3])
+        self.assertEqual(x.hist.filled()[1, 3].item(), 9)
+
+    def test_merge(self):
+        x = HistoryState(2, 2)
+        y = HistoryState(1, 8)
+        for t in range(3):
+            x.append(torch.tensor([t, t]))
+        y.append(torch.tensor([5]))
+        z = HistoryState.merge([x, y])
+        print(z.filled())
+        self.assertEqual(z.filled().size(), (3, 3))
+        self.assertEqual(list(z.lens), [3, 3, 1])
+        self.assertTrue(torch.all(z.filled()[2] == torch.tensor([5, 0, 0])))
+
+
+
+class TestBeamState(TestCase):
+    def test_fold(self):
+        states = [State(data=torch.arange(4)[:, None] * 10 + k, hist=HistoryState(4, 2)) for k in range(3)]
+        x = BeamState(states, scores=torch.rand(4, 3), predactions=torch.zeros(4, 3, 1, dtype=torch.long))
+        self.assertEqual(len(x), 4)
+        self.assertEqual(len(x.fstate), 12)
+        print(x.fstate.data[:, 0])
+        self.assertEqual(x.fstate.data[:, 0].tolist(), [0, 1, 2, 10, 11, 12, 20, 21, 22, 30, 31, 32])
+        for k in range(3):
+            self.assertTrue(torch.all(x.bstates.get(k).data == states[k].data))
+        y = x[torch.tensor([3, 1])]
+        self.assertEqual(y.fstate.data[:, 0].tolist(), [30, 31, 32, 10, 11, 12])
+        self.assertEqual(y.bstates.get(2).data[:, 0].tolist(), [32, 12])
+        x[torch.tensor([0])] = y[torch.tensor([0])]
+        self.assertEqual(x.fstate.data[:3, 0].tolist(), [30, 31, 32])
+        z = BeamState.merge([x[torch.tensor([0])], y])
+        self.assertEqual(z.fstate.data[:, 0].tolist(), [30, 31, 32, 30, 31, 32, 10, 11, 12])
+
+    def test_backtrack(self):
+        fstate = State(data=torch.zeros(4))
+        # one example, beam of 2: step 0 chooses actions 5 and 6, step 1 continues element 1 twice with 7 and 8
+        x = BeamState(fstate, beamsize=2,
+                      actions=torch.tensor([[[5, 7], [6, 8]]]),
+                      actionlogprobs=torch.tensor([[[-1., -2.], [-1.5, -3.]]]),
+                      backpointers=torch.tensor([[[0, 1], [0, 1]]]),
+                      scores=torch.tensor([[-3.5, -4.5]]))
+        actions, logprobs = x.backtrack()
+        print(actions)
+        self.assertEqual(actions.tolist(), [[[6, 7], [6, 8]]])
+        self.assertTrue(torch.allclose(logprobs.sum(-1), x.bscores))
+        self.assertEqual(x[0].backtrack()[0].tolist(), [[[6, 7], [6, 8]]])
 
 class TestBasicDecoderState(TestCase):
     def test_create(self):
@@ -202,3 +383,78 @@ class TestBasicDecoderState(TestCase):
         print(k)
         print(isinstance(k, np.ndarray))
 
+
+
+class TestTreeDecoderState(TestCase):
+    def make_state(self):
+        qv = Vocab()
+        for t in "( ) and wife spouse BO US answer".split():
+            qv.add_token(t)
+        qv.finalize()
+        sv = Vocab()
+        for t in "who is the wife of bo".split():
+            sv.add_token(t)
+        sv.finalize()
+        specs = {"answer": (1, 1), "wife": (1, 1), "spouse": (1, 1), "and": (1, np.infty), "BO": (0, 0), "US": (0, 0)}
+        lfs = ["(answer (wife BO))", "(answer (and (wife BO) (spouse US) BO))", "(answer BO)"]
+        states = []
+        for lf in lfs:
+            toks = lf.replace("(", " ( ").replace(")", " ) ").split() + ["@END@"]
+            inp = "who is the wife of bo".split()
+            states.append(TreeDecoderState([" ".join(inp)], [lisp_to_tree(lf)], torch.tensor([[sv[t] for t in inp]]),
+                                           torch.tensor([[qv[t] for t in toks]]), [inp], [toks], sv, qv,
+                                           token_specs=specs))
+        gl = max([state.gold_tensor.size(1) for state in states])
+        for state in states:
+            state.gold_tensor = torch.cat([state.gold_tensor, state.gold_tensor.new_zeros(1, gl - state.gold_tensor.size(1))], 1)
+        return TreeDecoderState.merge(states), qv
+
+    def test_out_mask_gold(self):
+        x, qv = self.make_state()
+        x.maxtime = 2       # forces the automaton stacks to grow
+        x.start_decoding()
+        for t in range(x.gold_tensor.size(1)):
+            mask = x.get_out_mask()
+            gold = x.gold_tensor[:, t]
+            self.assertTrue(torch.all(mask.gather(1, gold[:, None]) == 1))
+            x.step(gold)
+        print(x.followed_tokens)
+
+    def test_out_mask(self):
+        x, qv = self.make_state()
+        x.start_decoding()
+        allowed = lambda i: {qv(j) for j in x.get_out_mask()[i].nonzero()[:, 0].tolist()}
+        self.assertEqual(allowed(0), {"("})
+        x.step(["(", "(", "("])
+        self.assertEqual(allowed(0), {")", "and", "wife", "spouse", "answer"})
+        x.step(["answer", "answer", "answer"])
+        self.assertEqual(allowed(0), {"(", "BO", "US"})
+        x.step(["(", "(", "BO"])
+        self.assertEqual(allowed(2), {")"})
+        y = x.make_copy(deep="cow")
+        y.step(["wife", "and", ")"])
+        self.assertEqual(allowed(0), {")", "and", "wife", "spouse", "answer"})
+        x.step(["wife", "and", ")"])
+        self.assertEqual(allowed(0), {"(", "BO", "US"})
+        self.assertEqual(allowed(1), {"(", "BO", "US"})
+        self.assertEqual(allowed(2), {"@END@"})
+        x.step(["BO", "BO", "@END@"])
+        self.assertEqual(allowed(0), {")"})
+        self.assertEqual(allowed(1), {"(", ")", "BO", "US"})
+        self.assertEqual(allowed(2), {"@PAD@"})
+        # setting a row from a copy must carry the automaton state
+        x[torch.tensor([0])] = y[torch.tensor([1])]
+        self.assertEqual(allowed(0), {"(", "BO", "US"})
+
+    def test_grammar_table_min_children(self):
+        # min #children above every finite max #children: ")" must become allowed once min is reached
+        qv = Vocab()
+        for t in "( ) and BO US".split():
+            qv.add_token(t)
+        qv.finalize()
+        table = TreeGrammarTable({"and": (2, np.infty), "BO": (0, 0), "US": (0, 0)}, qv)
+        parents = torch.tensor([qv["and"]] * 5)
+        counts = torch.tensor([0, 1, 2, 3, 7])
+        masks = table.masks[table.get_rows(parents, counts)]
+        self.assertEqual(masks[:, qv[")"]].tolist(), [0, 0, 1, 1, 1])
+        self.assertTrue(torch.all(masks[:, qv["BO"]] == 1))
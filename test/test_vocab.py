@@ -0,0 +1,117 @@
+import random
+from unittest import TestCase
+import torch
+
+from parseq.grammar import FuncGrammar
+from parseq.vocab import SequenceEncoder, Vocab, FuncQueryEncoder
+
+
+class TestSequenceEncoder(TestCase):
+    def test_convert_batch(self):
+        se = SequenceEncoder(tokenizer=lambda x: x.split(), add_end_token=True)
+        xs = ["what is the capital of texas", "rivers in ohio", "how long is the mississippi"]
+        for x in xs:
+            se.inc_build_vocab(x)
+        se.finalize_vocab()
+        tensor, lens, tokens = se.convert_batch(xs + ["unknown words here"])
+        print(tensor)
+        print(lens)
+        self.assertEqual(tensor.size(), (4, 7))
+        self.assertEqual(lens.tolist(), [7, 4, 6, 4])
+        for i, x in enumerate(xs):
+            ref, reftokens = se.convert(x, return_what="tensor,tokens")
+            self.assertTrue(torch.all(tensor[i, :len(ref)] == ref))
+            self.assertTrue(torch.all(tensor[i, len(ref):] == se.vocab[se.vocab.padtoken]))
+            self.assertEqual(tokens[i], reftokens)
+        self.assertEqual(tensor[3, :3].tolist(), [se.vocab[se.vocab.unktoken]] * 3)
+
+    def test_tokenizer_cache(self):
+        calls = []
+        def tok(x):
+            calls.append(x)
+            return x.split()
+        se = SequenceEncoder(tokenizer=tok, add_end_token=True, cache_size=2)
+        se.inc_build_vocab("a b c")
+        se.finalize_vocab()
+        for x in ["a b", "a b", "b c", "a b", "c", "b c"]:
+            tokens = se.convert(x, return_what="tokens")
+            self.assertEqual(tokens[-1], se.vocab.endtoken)
+        print(se.cache_info())
+        self.assertEqual(calls, ["a b c", "a b", "b c", "c", "b c"])
+        self.assertEqual(se.cache_info(), {"hits": 2, "misses": 5, "size": 2, "maxsize": 2})
+        se.clear_cache()
+        self.assertEqual(se.cache_info()["size"], 0)
+
+
+class TestVocab(TestCase):
+    def test_finalize_frozen(self):
+        vocab = Vocab()
+        for t in "a b c d a b".split():
+            vocab.add_token(t)
+        vocab.finalize()
+        print(vocab.D)
+        self.assertEqual(vocab.number_of_ids(), max(vocab.D.values()) + 1)
+        self.assertEqual(vocab.ids(["a", "d", "zzz"]).tolist(), [vocab["a"], vocab["d"], vocab[vocab.unktoken]])
+        self.assertEqual(vocab.ids([["a", "b"], ["c", "d"]]).shape, (2, 2))
+        self.assertEqual(vocab.tokens(vocab.ids(["a", "b", "c"])).tolist(), ["a", "b", "c"])
+
+    def test_tostr(self):
+        vocab = Vocab()
+        for t in "a b c d".split():
+            vocab.add_token(t)
+        vocab.finalize()
+        x = torch.tensor(vocab.ids([["a", "b", "@END@", "c", "@PAD@"],
+                                    ["c", "@PAD@", "d", "@PAD@", "@PAD@"],
+                                    ["@END@", "a", "@PAD@", "@PAD@", "@PAD@"]]))
+        strs = vocab.tostr(x)
+        print(strs)
+        self.assertEqual(strs, ["a b @END@", "c d", "@END@"])
+        for xe, s in zip(x, strs):
+            self.assertEqual(vocab.tostr(xe), s)
+        self.assertEqual(vocab.tostr(x[0], return_tokens=True), ["a", "b", "@END@"])
+
+
+class TestFuncQueryEncoder(TestCase):
+    def dense_masks(self, qe):
+        # dense per-type masks as previously built by prebuild_valid_action_masks()
+        ret = {}
+        for typestr, rules in qe.grammar.rules_by_type.items():
+            action_mask = torch.zeros(qe.vocab_actions.number_of_ids(), dtype=torch.uint8)
+            for rule in rules:
+                action_mask[qe.vocab_actions[rule]] = 1
+            if typestr[-1] in "*+":
+                for rule in qe.grammar.rules_by_type.get(typestr[:-1], set()):
+                    action_mask[qe.vocab_actions[rule]] = 1
+            ret[typestr] = action_mask
+        return ret
+
+    def test_valid_actions(self):
+        random.seed(42)
+        g = FuncGrammar("<T0>")
+        types = [f"<T{i}>" for i in range(30)] + ["<T3>*", "<T7>+"]
+        for i in range(300):
+            t = random.choice(types)
+            if random.random() < 0.5:
+                g.add_rule(f"{t} -> f{i} :: " + " ".join(random.sample(types, random.randint(1, 3))))
+            else:
+                g.add_rule(f"{t} -> c{i}")
+        qe = FuncQueryEncoder(grammar=g, format="prolog")
+        qe.finalize_vocab()
+        numactions = qe.vocab_actions.number_of_ids()
+        print(numactions, qe._valid_action_bits.size())
+        self.assertEqual(qe._valid_action_bits.size(), (len(g.rules_by_type) + 1, (numactions + 7) // 8))
+
+        dense = self.dense_masks(qe)
+        for typestr, mask in dense.items():
+            self.assertTrue(torch.all(qe.get_action_mask_for(typestr) == mask))
+        unkmask = qe.get_action_mask_for("<NOTATYPE>")
+        self.assertEqual(unkmask.nonzero().view(-1).tolist(), [qe.vocab_actions[qe.none_action]])
+
+        typestrs = [random.choice(list(dense.keys()) + ["<NOTATYPE>"]) for _ in range(24)]
+        type_ids = qe.get_type_ids(typestrs).view(4, 6)
+        masks = qe.get_valid_actions(type_ids)
+        self.assertEqual(masks.size(), (4, 6, numactions))
+        self.assertEqual(masks.dtype, torch.bool)
+        for i, typestr in enumerate(typestrs):
+            ref = dense[typestr] if typestr in dense else unkmask
+            self.assertTrue(torch.all(masks.view(24, -1)[i] == ref.bool()))